@@ -1,63 +1,133 @@
+import errno
 import os
-import subprocess
-import gzip
 import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import fastx
+import minhash
+import scheduler
+import staging
+import subsample
+from readindex import ReadIndex
+from readstats import ReadStats
+from bgzf import BgzfWriter
+from cache import ResultCache, cached
+from discovery import SampleTable
+from planner import Planner
+from asmqc import QCLog
 
 
 class AssemblySample:
     """
     Sample class possessing features indicating relevant information for skesa, shasta, or spades assembly.
     """
+    # (threads, memory in GB) declared by each tool invocation, used to pack samples onto the node.
+    # Shasta in filesystem memory mode holds the whole read graph in huge pages, so it is the most memory hungry.
+    COSTS = {"shasta": (16, 96),
+             "spades": (16, 48),
+             "skesa": (8, 16)}
+
     def __init__(self, args):
         self.longread = False  # path file to the fastq.gz long read file
         self.fasta = False  # updated only for shasta, the path file for the fasta version of the longread samples
+        self.fastq = False  # only set in direct mode, the fastq.gz streamed into shasta instead of self.fasta
         self.r1 = False # path file to the for the forward illumina reads
         self.r2 = False  # path file to for the reverse illumina reads
         self.args = args  # arguments from arg_parse
         self.assembly = args.type  # I can't remember
         self.type = args.type  # type of assembly [long, contig, short]
-        self.minread = args.minr  # MUST CHANGE: only if it is a value in arg.minr (set default 0)
+        self.minread = args.minr  # minimum read length for shasta, "auto" is replaced using the read statistics
         self.contigs = False  # updated for spades assembly, the output of the shasta long read
         self.name = None  # based on the sample name, used for file naming
+        self.budget = None  # scheduler.ResourceBudget shared by the batch, None to run tools without reservation
+        self.exclusive = True  # if True, the sample has the node to itself and each tool gets the whole budget
+        self.cache = None  # cache.ResultCache, to reuse the outputs of assemblies that already ran on the same reads
+        self.planner = None  # planner.Planner sizing each tool from its input, None to use COSTS
+        # bases the reads are subsampled to before assembly (-depth times -genomesize), None to use every read
+        self.target_bases = subsample.target_bases(getattr(args, "genomesize", None), getattr(args, "depth", None))
+
+    def cost(self, tool):
+        """
+        :param tool: (str) key of AssemblySample.COSTS
+        :return: tuple (threads, memory in GB) the tool invocation should reserve, or None without a budget
+        """
+        if self.budget is None:
+            return None
+        if self.planner:
+            if tool == "shasta":
+                return self.budget.clamp(*self.planner.shasta(self.fastq if self.fastq else self.fasta)[:2])
+            return self.budget.clamp(*getattr(self.planner, tool)(self.r1, self.r2))
+        if self.exclusive:
+            return self.budget.threads, self.budget.memory
+        return self.budget.clamp(*AssemblySample.COSTS[tool])
 
     @staticmethod
-    def shasta_run(reads, args):
+    def shasta_run(reads, args, budget=None, cost=None, output=None, cache=None, source=None, min_length=None,
+                   memory=("filesystem", "2M"), target=None):
         """
         Will take a file and call shasta on it.
 
         :param reads: fasta file to have shasta run on it
         :param args: self.args
+        :param budget: scheduler.ResourceBudget the invocation reserves from, None to run it directly
+        :param cost: tuple (threads, memory in GB) declared for this invocation
+        :param output: directory ShastaRun is created in, defaults to the directory of reads
+        :param cache: cache.ResultCache or None
+        :param source: file the reads come from, used as the cache input when reads is a named pipe
+        :param min_length: (str) shasta's minimum read length, defaults to args.minr
+        :param memory: tuple (memory mode, memory backing), filesystem/2M needs root and enough free huge pages
+        :param target: (int) bases the reads streamed from source were subsampled to, None if they were not
         :returns: None. Output for all shasta ru
         ns. Shasta will be run in the output directory. Requires that shasta is
         """
         print(reads)
-        sample_path = "{}/{}".format("/".join(reads.split("/")[:-1]), "ShastaRun")
+        if output is None:
+            output = "/".join(reads.split("/")[:-1])
+        sample_path = "{}/{}".format(output, "ShastaRun")
+        source = source if source else reads
 
         cmd = ["shasta-Linux-0.1.0",
                "--input", reads,
-               "--memoryMode", "filesystem",
-               "--memoryBacking", "2M",
-               "--Reads.minReadLength", args.minr,
+               "--memoryMode", memory[0],
+               "--memoryBacking", memory[1],
+               "--Reads.minReadLength", str(min_length if min_length else args.minr),
                "--output", sample_path
                ]
-
-        subprocess.run(cmd)
-        os.remove(reads)
-        pass
+        # the memory mode does not change the assembly
+        key_cmd = [source if c == reads else c for c in cmd[:3] + cmd[7:]]
+        if target:
+            key_cmd.extend(["subsample", target, subsample.SEED])
+        if cost:
+            cmd.extend(["--threads", str(cost[0])])
+
+        def run():
+            # ShastaRun is written to scratch, if there is one. Its binary Data directory is not kept.
+            with staging.staged("shasta", outputs=[sample_path], need=staging.size(source),
+                                exclude=("Data",)) as area:
+                scheduler.run([area.path(c) if c == sample_path else c for c in cmd], cost, budget)
+
+        cached(cache, "shasta", cmd[0], key_cmd, [source], [sample_path], run)
+        if reads == source and os.path.exists(reads):
+            os.remove(reads)  # streamed reads are removed with their temporary directory, by streamed_fasta
 
     @staticmethod
-    def spades_run(r1, r2, long, assmb):
+    def spades_run(r1, r2, long, assmb, budget=None, cost=None, cache=None):
         """
 
         :param r1:
         :param r2:
         :param long:
         :param assmb:
+        :param budget: scheduler.ResourceBudget the invocation reserves from, None to run it directly
+        :param cost: tuple (threads, memory in GB) declared for this invocation
+        :param cache: cache.ResultCache or None
         :return:
         """
 
         output_dir = "{}/spades/".format("/".join(long.split("/")[:-1]))
-        os.mkdir(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
         cmd = ["python3", "/home/bioinfo/SPAdes-3.12.0-Linux/bin/spades.py",
                "-1", r1,
                "-2", r2,
@@ -65,44 +135,145 @@ class AssemblySample:
                "--only-assembler"]
         if assmb:
             cmd.extend(["--trusted-contigs", assmb])
+        key_cmd = list(cmd)
+        if cost:
+            cmd.extend(["-t", str(cost[0]), "-m", str(cost[1])])
+
+        def run():
+            # the k-mer passes run in scratch, if there is one, and the spades directory is moved back at the end
+            with staging.staged("spades", outputs=[output_dir.rstrip("/")], need=4 * staging.size(r1, r2),
+                                exclude=("tmp",)) as area:
+                scheduler.run([area.path(c) if c == output_dir else c for c in cmd], cost, budget)
 
-        subprocess.run(cmd)
+        cached(cache, "spades", cmd[1], key_cmd, [r1, r2, assmb], [output_dir.rstrip("/")], run)
 
     @staticmethod
-    def skesa(r1, r2, output):
+    def skesa(r1, r2, output, budget=None, cost=None, cache=None):
         """
         Figure out after you get some of your new code
         :param r1:
         :param r2:
         :param output:
-        :return:
+        :param budget: scheduler.ResourceBudget the invocation reserves from, None to run it directly
+        :param cost: tuple (threads, memory in GB) declared for this invocation
+        :param cache: cache.ResultCache or None
+        :return: (str) path of the assembly, after it was moved to the directory of the sample
         """
         cmd = ["skesa", "--fastq", "{},{}".format(r1, r2), "--contigs_out", output]
-        subprocess.run(cmd)
+        key_cmd = [r1, r2] + cmd[3:]
+        if cost:
+            cmd.extend(["--cores", str(cost[0]), "--memory", str(cost[1])])
+        cached(cache, "skesa", cmd[0], key_cmd, [r1, r2], [output], lambda: scheduler.run(cmd, cost, budget))
 
         sample_name = output.split("/")[-1].split("_")[0]
         path = '/'.join(output.split("/")[:-1])
         for sd in [f for f in os.listdir(path) if os.path.isdir("{}/{}".format(path, f))]:
             if sample_name in sd:
                 os.rename(output, "{}/{}/{}".format(path, sd, output.split("/")[-1]))
+                return "{}/{}/{}".format(path, sd, output.split("/")[-1])
+        return output
+
+    def shasta_input(self):
+        """
+        Runs shasta on the converted fasta file, or, in direct mode, on a fasta streamed from the fastq.gz file so
+        the uncompressed fasta is never written next to the reads. A compressed fasta is streamed the same way,
+        since shasta only reads plain fasta. In direct mode, the reads are subsampled on the way (the fasta files
+        were already subsampled when they were written).
+        :return: None.
+        """
+        source = self.fastq if self.fastq else self.fasta
+        memory = self.planner.shasta(source)[2:] if self.planner else ("filesystem", "2M")
+        if self.fastq or self.fasta.endswith(".gz"):
+            output = "/".join(self.fasta.split("/")[:-1])
+            target = self.target_bases if self.fastq else None
+            with FastqFasta.streamed_fasta(source, self.args.direct, target) as reads:
+                AssemblySample.shasta_run(reads, self.args, self.budget, self.cost("shasta"), output, self.cache,
+                                          source, self.minread, memory, target)
+        else:
+            AssemblySample.shasta_run(self.fasta, self.args, self.budget, self.cost("shasta"), cache=self.cache,
+                                      min_length=self.minread, memory=memory)
+
+    def subsample_short_reads(self, output_dir):
+        """
+        Replaces the short reads of the sample by pairs subsampled to self.target_bases, written to output_dir as
+        <name>_R1.subsampled.fastq.gz and <name>_R2.subsampled.fastq.gz.
+
+        :param output_dir: (str) directory of the subsampled reads
+        :return: None
+        """
+        if not (self.target_bases and self.r1 and self.r2):
+            return
+        r1 = "{}/{}_R1.subsampled.fastq.gz".format(output_dir, self.name)
+        r2 = "{}/{}_R2.subsampled.fastq.gz".format(output_dir, self.name)
+
+        def run():
+            sampler = subsample.Subsampler(self.target_bases).run_pairs(self.r1, self.r2)
+            sampler.write_pairs(r1, r2)
+            sampler.report(self.name)
+
+        cached(self.cache, "subsample", "subsample", ["pairs", self.r1, self.r2, self.target_bases, subsample.SEED],
+               [self.r1, self.r2], [r1, r2], run)
+        self.r1, self.r2 = r1, r2
+
+    def qc(self, stage, assembly, directory):
+        """
+        Adds the statistics of an assembly to the QC log of the sample.
+
+        :param stage: (str) assembler that produced it
+        :param assembly: (str) path to the assembly fasta, None if it was not found
+        :param directory: (str) directory of the sample, where the log is kept
+        :return: None
+        """
+        if assembly is None or not os.path.isfile(assembly):
+            print("{}: no {} assembly found at {}.".format(self.name, stage, assembly or directory))
+            return
+        QCLog(directory, self.name).add(stage, assembly)
+
+    def fastq_path(self):
+        """
+        :return: (str) path to the long read fastq(.gz) of the sample, None if it can't be found
+        """
+        if self.fastq:
+            return self.fastq
+        if self.longread and os.path.isdir(self.longread):
+            for f in sorted(os.listdir(self.longread)):
+                if ".fastq" in f or ".fq" in f:
+                    return "{}/{}".format(self.longread, f)
+        return None
 
     def assembly_run(self):
         """
         Decides which series of assembly stuff to run based on args, using long, r1, r2 or assembly as an input
-        :return: None.
+        :return: (str) path of the final assembly, None if the assembly type is unknown or spades wrote no assembly
         """
 
+        sample_dir = "/".join(self.fasta.split("/")[:-1]) if self.fasta else None
         if self.type == "long":
-            AssemblySample.shasta_run(self.fasta, self.args)
+            self.shasta_input()
+            self.qc("shasta", "{}/ShastaRun/Assembly.fasta".format(sample_dir), sample_dir)
+            return "{}/ShastaRun/Assembly.fasta".format(sample_dir)
         elif self.type.lower() == "contig":
-            AssemblySample.shasta_run(self.fasta, self.args)
-            self.contigs = "{}filtered_{}/ShastaRun/Assembly.fasta".format(self.longread, self.name)  # might not be the right file path
-            AssemblySample.spades_run(self.r1, self.r2, self.fasta, self.contigs)
+            self.shasta_input()
+            self.qc("shasta", "{}/ShastaRun/Assembly.fasta".format(sample_dir), sample_dir)
+            self.contigs = "{}/ShastaRun/Assembly.fasta".format(sample_dir)
+            self.subsample_short_reads(sample_dir)
+            AssemblySample.spades_run(self.r1, self.r2, self.fasta, self.contigs, self.budget, self.cost("spades"),
+                                      self.cache)
+            # the same assembly as the one polishing finds afterwards: spades/K<max>/final_contigs.fasta
+            found = SampleTable()
+            assembler, assembly = found.assembly(sample_dir, found.listing(sample_dir)[1])
+            assembly = assembly if assembler == "spades" else None
+            self.qc("spades", assembly, sample_dir)
+            return assembly
         elif self.type.lower() == "short":
             file_name = "{}/{}_skesa_assembly".format(os.getcwd(),self.name)
-            AssemblySample.skesa(self.r1, self.r2, file_name)
+            self.subsample_short_reads(os.getcwd())
+            assembly = AssemblySample.skesa(self.r1, self.r2, file_name, self.budget, self.cost("skesa"), self.cache)
+            self.qc("skesa", assembly, os.path.dirname(assembly))
+            return assembly
         else:
             print("Please input long for shasta assembly, contig for hybrid, and short for skesa assembly")
+        return None
 
 
 class AssemblyCall:
@@ -110,6 +281,7 @@ class AssemblyCall:
     The class with all the information for the assembly call. Does not distinguish between the samples in the input
     directories.
     """
+    AUTO_COVERAGE = 60  # coverage kept by the automatic shasta minimum read length
 
     def __init__(self, args):
         # self.assembly = False
@@ -119,32 +291,33 @@ class AssemblyCall:
         else:
             self.dirshort = False
         self.args = args
+        if args.cache:  # Directory where the results of previous runs are kept
+            self.cache = ResultCache(args.cache, args.cache_size)
+        else:
+            self.cache = None
+        # Files of each sample, found in one scan of the input directories
+        self.table = SampleTable(args.sample_pattern, args.sample_cache)
 
     @staticmethod
-    def samples_to_run(directory, sample_dir):
+    def samples_to_run(table, sample_dir):
 
         """
-        Sorts reads in the directories with short reads and long reads,
-        using the sample name and features to create a dictionary of Samples
-        :param directory: directory with short reads
+        Adds the short reads of the samples found in the sample table, matched on the exact sample name.
+        :param table: discovery.SampleTable the short read directory was added to
         :param sample_dir: dictionary to be added to.
         :return: Dictionary
         """
-        illum_samples = set(map(lambda x: x.split('_')[0], os.listdir(directory)))
-        for s in illum_samples:
-            if s in sample_dir:
-                for r in os.listdir(directory):
-                    if s in r and "R1" in r:
-                        sample_dir[s].r1 = "{}{}".format(directory, r)
-                    elif s in r and "R2" in r:
-                        sample_dir[s].r2 = "{}{}".format(directory, r)
+        for s, d in sample_dir.items():
+            if s in table.samples:
+                d.r1 = table.samples[s]["r1"]
+                d.r2 = table.samples[s]["r2"]
         return sample_dir
 
     def fasta_finder(self):
 
         """
         Go through subdirectories with copies of both fasta and fastq files. Will add fasta pathfile
-        to the sample class for shasta input.
+        to the sample class for shasta input. Each directory is listed once, by the SampleTable.
 
         :return: Dict
 
@@ -152,39 +325,89 @@ class AssemblyCall:
         """
 
         current_loc = self.dirlong
-        subdir = [f for f in os.listdir(current_loc) if os.path.isdir("{}/{}".format(current_loc, f))]
+        table = self.table
+        files, subdir = table.listing(current_loc)
         sample_dir = {}
 
         if len(subdir) != 0:
-            for sd in subdir:
-                for d in os.listdir("{}/{}".format(current_loc, sd)):
-                    if "fasta" in d:
-                        d_name = d.split("/")[-1].split("_")[1]
-                        sample_dir[d_name] = AssemblySample(self.args)
-                        sample_dir[d_name].fasta = "{}/{}/{}".format(current_loc, sd, d)
-                        sample_dir[d_name].longread = "{}/{}".format(current_loc, sd)
+            table.add_sample_dirs(current_loc)
+            for d_name, entry in table.samples.items():
+                if entry["fasta"]:
+                    sample_dir[d_name] = AssemblySample(self.args)
+                    sample_dir[d_name].fasta = entry["fasta"]
+                    sample_dir[d_name].longread = entry["dir"]
+                elif self.args.direct and entry["fastq"]:
+                    # direct mode: no fasta was written, shasta reads are streamed from the fastq.gz
+                    sd = os.path.basename(entry["dir"])
+                    sample_dir[d_name] = AssemblySample(self.args)
+                    sample_dir[d_name].fastq = entry["fastq"]
+                    sample_dir[d_name].fasta = "{}/{}.fasta".format(entry["dir"], sd)
+                    sample_dir[d_name].longread = entry["dir"]
 
         else:
-            for f in os.listdir(current_loc):
+            for f in files:
                 f_name = f.split("/")[-1].split("_")[-1]
                 sample_dir[f_name] = AssemblySample(self.args)
                 sample_dir[f_name].fasta = "{}{}/{}.fasta".format(current_loc, f, f)
                 sample_dir[f_name].longread = current_loc
 
+        selected = getattr(self.args, "samples", None)  # -samples, used by the work queue to run one sample
+        if selected:
+            sample_dir = {name: d for name, d in sample_dir.items() if name in selected}
         if self.dirshort:
-            sample_dir = AssemblyCall.samples_to_run(self.dirshort, sample_dir)
+            table.add_short_reads(self.dirshort)
+            if getattr(self.args, "check_pairs", None):
+                # pairing by name is checked against the k-mer content of the reads
+                minhash.check_pairs(table.samples, self.args.check_pairs, minhash.SketchCache(self.args.sketch_cache))
+            sample_dir = AssemblyCall.samples_to_run(table, sample_dir)
+        table.save()
 
         return sample_dir
 
     def assembly(self):
 
         """
-        Calls for the assemble of each sample object stored in the dictionary
-        :return:
+        Calls for the assemble of each sample object stored in the dictionary. Samples are run -jobs at a time,
+        within the -threads/-memory budget of the node. A failing sample does not stop the others, failures are
+        listed in a summary at the end.
+        :return: (int) number of failed samples
         """
         dictionary = AssemblyCall.fasta_finder(self)
-        for d in dictionary.values():
-            d.assembly_run()
+        if str(self.args.minr).lower() == "auto":
+            self.auto_min_read_length(dictionary)
+        budget = scheduler.ResourceBudget(self.args.threads, self.args.memory)
+        batch = scheduler.SampleScheduler(self.args.jobs, budget)
+        plan = Planner(budget.threads, budget.memory, batch.jobs)
+        for name, d in dictionary.items():
+            if d.name is None:
+                d.name = name
+            d.budget = budget
+            d.cache = self.cache
+            d.exclusive = batch.jobs == 1
+            d.planner = plan
+        batch.run({name: d.assembly_run for name, d in dictionary.items()})
+        return batch.summary()
+
+    def auto_min_read_length(self, dictionary):
+        """
+        Chooses shasta's minimum read length for each sample from its read statistics: the longest cut-off that
+        still leaves AssemblyCall.AUTO_COVERAGE fold coverage of -genomesize.
+
+        :param dictionary: dictionary of AssemblySample objects
+        :return: None
+        """
+        fastqs = {name: d.fastq_path() for name, d in dictionary.items() if d.type in ("long", "contig")}
+        fastqs = {name: path for name, path in fastqs.items() if path}
+        stats = ReadStats.from_files(list(fastqs.values()))
+        for name, path in fastqs.items():
+            min_length = stats[path].suggest_min_length(self.args.genomesize, AssemblyCall.AUTO_COVERAGE)
+            dictionary[name].minread = str(min_length)
+            stats[path].report(self.args.genomesize)
+            print("{}: shasta minimum read length set to {}.\n".format(name, dictionary[name].minread))
+        for name, d in dictionary.items():
+            if str(d.minread).lower() == "auto":
+                print("{}: no reads found to choose a minimum read length, using 1000.".format(name))
+                d.minread = "1000"
 
     def fasta_files(self):
 
@@ -200,41 +423,162 @@ class FastqFasta:
     def __init__(self, arg):
         self.path = arg.long  # location of long reads, can be in subdir or in dir directly
         self.args = arg
+        self.target = subsample.target_bases(arg.genomesize, getattr(arg, "depth", None))  # None: keep every read
+        self.samples = getattr(arg, "samples", None)  # only convert the reads of these samples, all if None
+        self.table = SampleTable(getattr(arg, "sample_pattern", None))
+
+    def selected(self, name):
+        """
+        :param name: (str) name of a sample directory or read file
+        :return: (bool) True if it belongs to one of the samples to convert
+        """
+        if not self.samples:
+            return True
+        return (self.table.sample_name(name, output=True) or self.table.sample_name(name)) in self.samples
 
     @staticmethod
-    def fastq_to_a(input_path):
+    def fastq_to_a(input_path, direct=None, level=None, target=None):
 
         """
         Results in a fastq file being converted to a fasta file. Will create a folder based on the sample ID name,
-        and place both the fastq and fasta file in it. The output of shasta and spades will be directed to this dir
+        and place both the fastq and fasta file in it. The output of shasta and spades will be directed to this dir.
+        The conversion works on large decompressed blocks, and records are sliced and written without decoding.
 
         :param input_path: (str) is the path to the long read file
+        :param direct: (str) fifo or temp. If set, the fasta file is not written, it is streamed at assembly time
+        :param level: (int) if set, the fasta is written as a multithreaded BGZF .fasta.gz with this compression level
+        :param target: (int) if set, the fasta only holds about this many bases, subsampled from the reads
         :returns: None.
         """
         acting_dir = '/'.join(input_path.split('/')[:-1])
         fastq_name = (input_path.split(".fastq")[0]).split('/')[-1]
-        fasta_name = "{}.fasta".format(fastq_name)
+        fasta_name = "{}/{}/{}.fasta".format(acting_dir, fastq_name, fastq_name)
 
         if not os.path.isdir("{}/{}".format(acting_dir, fastq_name)):
             os.mkdir("{}/{}".format(acting_dir, fastq_name))
 
-        counter = 0
-        with open(fasta_name, "w") as ftw:
-            with gzip.open(input_path, "rb") as ftr:
-                for line in ftr:
-                    if counter == 0:
-                        ftw.write(line.decode().replace("@", ">"))
-                        counter += 1
-                    elif counter == 1:
-                        ftw.write(line.decode())
-                        counter += 1
-                    elif counter == 2:
-                        counter += 1
-                    elif counter == 3:
-                        counter = 0
+        if not direct:
+            FastqFasta.fasta_file(input_path, fasta_name, level, target)
 
         shutil.move("{}/{}.fastq.gz".format(acting_dir, fastq_name), "{}/{}/".format(acting_dir, fastq_name)) # should not happen
-        shutil.move("{}".format(fasta_name), "{}/{}".format(acting_dir, fastq_name)) # should be in samples
+
+    @staticmethod
+    def fasta_file(input_path, fasta_name, level=None, target=None):
+        """
+        Writes the fasta version of a reads file.
+
+        :param input_path: (str) path to the fastq(.gz) file
+        :param fasta_name: (str) path of the fasta to write, .gz is appended when it is compressed
+        :param level: (int) if set, the fasta is written as a multithreaded BGZF .fasta.gz with this compression level
+        :param target: (int) if set, the fasta only holds about this many bases, subsampled from the reads
+        :return: (str) path of the fasta written
+        """
+        if level is not None:
+            with BgzfWriter("{}.gz".format(fasta_name), level=level) as ftw:
+                FastqFasta.write_fasta(input_path, ftw, target)
+            return "{}.gz".format(fasta_name)
+        with open(fasta_name, "wb", buffering=fastx.BLOCK_SIZE) as ftw:
+            FastqFasta.write_fasta(input_path, ftw, target)
+        return fasta_name
+
+    @staticmethod
+    def write_fasta(input_path, output, target=None):
+        """
+        Streams reads into a fasta file object, all of them or a subsample of about target bases.
+
+        :param input_path: (str) path to the fastq(.gz) or fasta(.gz) file, only fastq files can be subsampled
+        :param output: binary file object the fasta records are written to
+        :param target: (int) bases to keep, None to keep every read
+        :returns: None.
+        """
+        if target:
+            sampler = subsample.Subsampler(target).run(input_path)
+            sampler.write_fasta(output)
+            sampler.report(input_path)
+        else:
+            fastx.to_fasta(input_path, output)
+
+    @staticmethod
+    @contextmanager
+    def streamed_fasta(input_path, mode="temp", target=None):
+
+        """
+        Provides a fasta version of a fastq.gz (or fasta.gz) file for the duration of the with block, without staging
+        it in the working directory. With "fifo", the reads are streamed into a named pipe by a background thread.
+        With "temp", the fasta is written to a temporary directory (TMPDIR) and removed afterwards.
+
+        :param input_path: (str) path to the long read file
+        :param mode: (str) fifo or temp
+        :param target: (int) bases the reads are subsampled to, None to stream every read
+        :returns: (str) path to the fasta file or named pipe
+        """
+        temp_dir = tempfile.mkdtemp(prefix="fasta_")
+        reads = "{}/{}.fasta".format(temp_dir, input_path.split('/')[-1].split(".fastq")[0].split(".fasta")[0])
+        writer = None
+        stop = threading.Event()
+        try:
+            if mode == "fifo":
+                os.mkfifo(reads)
+                writer = threading.Thread(target=FastqFasta._fifo_writer, args=(input_path, reads, stop, target),
+                                          daemon=True)
+                writer.start()
+            else:
+                with open(reads, "wb", buffering=fastx.BLOCK_SIZE) as ftw:
+                    FastqFasta.write_fasta(input_path, ftw, target)
+            yield reads
+        finally:
+            try:
+                if writer is not None:
+                    # the reader is gone: a writer still waiting for it to open the pipe (cache hit, or a tool that
+                    # failed before reading) gives up, one that was writing gets a broken pipe
+                    stop.set()
+                    writer.join()
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _fifo_writer(input_path, fifo, stop, target=None):
+        """
+        Streams the reads into a named pipe. The pipe is opened without blocking, retrying until a reader opened it,
+        so the writer can be stopped even when nobody ever reads it, or the pipe was removed.
+        """
+        while True:
+            try:
+                fd = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except FileNotFoundError:
+                return
+            except OSError as e:
+                if e.errno != errno.ENXIO:  # ENXIO: no reader yet
+                    raise
+            if stop.wait(0.05):
+                return
+        os.set_blocking(fd, True)
+        try:
+            with open(fd, "wb", buffering=fastx.BLOCK_SIZE) as ftw:
+                FastqFasta.write_fasta(input_path, ftw, target)
+        except BrokenPipeError:
+            print("The reader of {} stopped before all the reads of {} were streamed.".format(fifo, input_path))
+
+    @staticmethod
+    def subset_to_a(input_path, output, read_ids=None, count=None, seed=None):
+
+        """
+        Writes a fasta file with only some of the reads of a fastq(.gz) file, pulled through its read index
+        (built on first use) instead of decompressing the whole file.
+
+        :param input_path: (str) path to the long read file
+        :param output: (str) path of the fasta file to write
+        :param read_ids: list of read IDs to extract
+        :param count: (int) number of random reads to extract, used when read_ids is not given
+        :param seed: (int) seed for the random subset
+        :returns: None.
+        """
+        index = ReadIndex.open(input_path)
+        records = index.fetch(read_ids) if read_ids is not None else index.sample(count, seed)
+        with open(output, "wb", buffering=fastx.BLOCK_SIZE) as ftw:
+            for record in records:
+                ftw.write(fastx.fastq_to_fasta_block(record.rstrip(b"\n").split(b"\n")))
 
     def fastq_convert(self):
 
@@ -248,22 +592,26 @@ class FastqFasta:
         if len(subdir) != 0:
             for sd in subdir:
                 # print(sd)
+                if not self.selected(sd):
+                    continue
                 files = [f for f in os.listdir("{}/{}".format(parent_path, sd)) if
                          os.path.isfile("{}/{}/{}".format(parent_path, sd, f))]
                 for f in files:
                     if "fastq" in f or "fq" in f:
                         if "filtering" in f:
-                            FastqFasta.fastq_to_a("{}/{}/{}".format(parent_path, sd, f))
+                            FastqFasta.fastq_to_a("{}/{}/{}".format(parent_path, sd, f), self.args.direct,
+                                              self.args.fasta_level, self.target)
                         else:
-                            FastqFasta.fastq_to_a("{}/{}/{}".format(parent_path, sd, f))
+                            FastqFasta.fastq_to_a("{}/{}/{}".format(parent_path, sd, f), self.args.direct,
+                                              self.args.fasta_level, self.target)
         else:
             files = [f for f in os.listdir(parent_path) if os.path.isfile("{}/{}".format(parent_path, f))]
             for f in files:
 
-                if "fastq" in f or "fq" in f:
+                if ("fastq" in f or "fq" in f) and self.selected(f):
                     if "filtering" in f:
-                        FastqFasta.fastq_to_a("{}/{}".format(parent_path, f))
+                        FastqFasta.fastq_to_a("{}/{}".format(parent_path, f), self.args.direct, self.args.fasta_level,
+                                              self.target)
                     else:
-                        FastqFasta.fastq_to_a("{}/{}".format(parent_path, f))
-
-if
+                        FastqFasta.fastq_to_a("{}/{}".format(parent_path, f), self.args.direct, self.args.fasta_level,
+                                              self.target)
@@ -1,29 +1,28 @@
-import os, subprocess, shutil, argparse
+import os, subprocess, shutil, argparse, gzip, re, time, zlib, json, difflib
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
+import fastx
+import telemetry
+from bgzf import BgzfWriter
+import filtering
 
-class GuppyBaseCallerRun:
+# Buffer used when a copy or a check has to go through python.
+COPY_BUFFER = 16 * 1024 * 1024
 
-    @staticmethod
-    def model_file(kit, flowcell):
-        cmd = ["guppy_basecaller", "--print_workflows"]
-        p1 = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = p1.communicate()
 
-        with open("workflows.txt", "wb") as ftw:
-            ftw.write(stdout)
+class GuppyBaseCallerRun:
 
-        with open("workflows.txt", "r") as ftr:
-            lines = ftr.readlines()
-            for l in lines:
-                try:
-                    k = l.split(" ")[1]
-                    f = l.split(" ")[0]
-                    if kit == k and flowcell == f:
-                        model_file = "/home/bioinfo/prog/ont-guppy/data/template" + (l.split(' ')[-1]).split()[0].split('dna')[-1] + ".jsn"
-                except IndexError:
-                    pass
-        return model_file
+    @staticmethod
+    def model_file(kit, flowcell, cache=None):
+        """
+        :param kit: (str) sequencing kit
+        :param flowcell: (str) flowcell
+        :param cache: (str) path of the workflow table cache, defaults to WorkflowTable.CACHE
+        :return: (str) path of the model file of the kit/flowcell combination
+        """
+        model = WorkflowTable.load("guppy_basecaller", cache).model(kit, flowcell)
+        return "/home/bioinfo/prog/ont-guppy/data/template" + model.split('dna')[-1] + ".jsn"
 
     def __init__(self, args):
         """
@@ -35,7 +34,7 @@ class GuppyBaseCallerRun:
         self.barcodekit = args.barcodekit
         self.kit = args.kit
         self.flowcell = args.flowcell
-        self.model_file = GuppyBaseCallerRun.model_file(self.kit, self.flowcell)
+        self.model_file = GuppyBaseCallerRun.model_file(self.kit, self.flowcell, args.workflow_cache)
         print("Model file {} is being used.\n".format(self.model_file))
         if int(args.threads) > len(os.sched_getaffinity(0)):
             self.threads = str(len(os.sched_getaffinity(0)))
@@ -51,21 +50,36 @@ class GuppyBaseCallerRun:
 
         :return: None.
         """
+        telemetry.run(self.guppy_command(), stage="guppy_basecaller", check=True)
+
+    def guppy_command(self, input_dir=None, output=None, device=None, threads=None):
+        """
+        :param input_dir: (str) fast5 directory, defaults to the run's
+        :param output: (str) output directory, defaults to the run's
+        :param device: (str) device, defaults to -device. cpu runs guppy on the CPU.
+        :param threads: (int) barcoding (and, on the CPU, basecalling) threads, defaults to -threads
+        :return: list, the guppy_basecaller command for the run information.
+        """
+        threads = threads if threads else self.threads
+        device = device if device else self.args.device
         cmd = ["guppy_basecaller",
-               "-i", self.input,  # MANDATORY INPUT
-               "-s", self.output,  # MANDATORY INPUT
+               "-i", input_dir if input_dir else self.input,  # MANDATORY INPUT
+               "-s", output if output else self.output,  # MANDATORY INPUT
                "--flowcell", self.flowcell,  # MANDATORY INPUT
                "--kit", self.kit,  # MANDATORY INPUT
                "--records_per_fastq", self.args.rpfq,
-               "--num_barcode_threads", str(self.threads),
+               "--num_barcode_threads", str(threads),
                '--calib_reference', self.args.calib_ref,
                "--model_file", self.model_file,  # ADJUST
                "--hp_correct", self.args.hp,
                "--num_caller", self.args.num_caller,
                "--gpu_runners_per_device", self.args.grpd,
                "--chunk_size", self.args.chunksize,
-               "--chunks_per_runner", self.args.chunkprun,
-               "--device", self.args.device]
+               "--chunks_per_runner", self.args.chunkprun]
+        if device == "cpu":
+            cmd.extend(["--cpu_threads_per_caller", str(max(1, int(threads) // int(self.args.num_caller)))])
+        else:
+            cmd.extend(["--device", device])
 
         if self.args.barcodekit != "None":
             cmd.extend(['--barcode_kits', self.barcodekit])
@@ -79,8 +93,144 @@ class GuppyBaseCallerRun:
             cmd.extend(["--trim_barcode"])
         if self.args.calib_detect == "Y":
             cmd.extend(["--calib_detect"])
-            
-        subprocess.run(cmd)
+        return cmd
+
+    def shards(self, count):
+        """
+        Splits the fast5 files into count shards of about the same total size (largest files first, each one to the
+        lightest shard), and links each shard's files into its own input directory.
+
+        :param count: (int) number of shards
+        :return: list of the shard input directories
+        """
+        files = []
+        for root, dirs, names in os.walk(self.input):
+            files.extend(os.path.join(root, n) for n in names if n.endswith(".fast5"))
+            if self.args.recursive != "Y":
+                break
+        files.sort(key=lambda f: (-os.path.getsize(f), f))
+        count = max(1, min(count, len(files)))
+        loads = [0] * count
+        shards = [[] for _ in range(count)]
+        for f in files:
+            i = loads.index(min(loads))
+            shards[i].append(f)
+            loads[i] += os.path.getsize(f)
+
+        inputs = []
+        for i, shard in enumerate(shards):
+            input_dir = "{}/shards/input_{}".format(self.output, i)
+            if os.path.isdir(input_dir):
+                shutil.rmtree(input_dir)
+            os.makedirs(input_dir)
+            for f in shard:
+                # the relative path is kept in the name, so files with the same name in different subdirectories
+                # do not collide
+                name = os.path.relpath(f, self.input).replace(os.sep, "_")
+                os.symlink(os.path.abspath(f), os.path.join(input_dir, name))
+            inputs.append(input_dir)
+            print("Shard {}: {} fast5 files, {:.1f} GB.".format(i, len(shard), loads[i] / 1e9))
+        return inputs
+
+    def guppy_sharded(self, count, devices=None):
+        """
+        Basecalls the run with count guppy_basecaller instances at the same time, each on its own shard of the fast5
+        files, device (round-robin over devices) and share of the threads, then merges their output trees into the
+        run's output directory, ready for concatenate_output.
+
+        :param count: (int) number of instances
+        :param devices: list of devices (cuda:0, cuda:1, cpu...), defaults to -device
+        :return: None
+        """
+        devices = devices if devices else [self.args.device]
+        inputs = self.shards(count)
+        threads = max(1, int(self.threads) // len(inputs))
+        instances = []
+        for i, input_dir in enumerate(inputs):
+            output = "{}/shards/output_{}".format(self.output, i)
+            cmd = self.guppy_command(input_dir, output, devices[i % len(devices)], threads)
+            instances.append(telemetry.start(cmd, stage="guppy_basecaller"))
+        codes = [m.wait() for m in instances]
+        failed = [i for i, c in enumerate(codes) if c != 0]
+        if failed:
+            raise subprocess.CalledProcessError(codes[failed[0]], "guppy_basecaller (shard {})".format(
+                ", ".join(map(str, failed))))
+        self.merge_shards(len(inputs))
+
+    def merge_shards(self, count):
+        """
+        Moves the pass/ and fail/ trees of the shards into the run's output directory. Chunk files get the shard
+        number after their fastq_runid prefix, so chunks of different shards never overwrite each other, and the
+        sequencing summaries are joined under a single header. The shards directory is removed at the end.
+
+        :param count: (int) number of shards
+        :return: None
+        """
+        summary = None
+        for i in range(count):
+            shard = "{}/shards/output_{}".format(self.output, i)
+            for root, dirs, names in os.walk(shard):
+                relative = os.path.relpath(root, shard)
+                top = relative.split(os.sep)[0]
+                for n in names:
+                    if top in ("pass", "fail"):
+                        target_dir = os.path.join(self.output, relative)
+                        os.makedirs(target_dir, exist_ok=True)
+                        target = n.replace("fastq_runid_", "fastq_runid_shard{}_".format(i), 1) \
+                            if n.startswith("fastq_runid_") else "shard{}_{}".format(i, n)
+                        os.rename(os.path.join(root, n), os.path.join(target_dir, target))
+                    elif relative == "." and n != "sequencing_summary.txt":
+                        # guppy's logs of the shard
+                        os.rename(os.path.join(root, n), os.path.join(self.output, "shard{}_{}".format(i, n)))
+                    elif relative == ".":
+                        if summary is None:
+                            summary = open("{}/sequencing_summary.txt".format(self.output), "wb")
+                            with open(os.path.join(root, n), "rb") as ftr:
+                                shutil.copyfileobj(ftr, summary, COPY_BUFFER)
+                        else:
+                            with open(os.path.join(root, n), "rb") as ftr:
+                                ftr.readline()  # header
+                                shutil.copyfileobj(ftr, summary, COPY_BUFFER)
+        if summary is not None:
+            summary.close()
+        # the chunks, summaries and logs were moved out: only the input links and empty trees are left
+        shutil.rmtree("{}/shards".format(self.output))
+
+    def watch(self, interval=30, ready_yield=None, on_part=None, on_done=None):
+        """
+        Runs guppy_basecaller, and while it is basecalling, appends every finished fastq_runid chunk to its barcode's
+        concatenated file. Once guppy is done, the remaining chunks are appended and barcodes are renamed, so there is
+        no need to call concatenate_output afterwards. Pass barcodes are post-processed while guppy is still running,
+        see BarcodeWatcher.hand_over.
+
+        :param interval: (int) seconds between two scans of the pass/ and fail/ trees
+        :param ready_yield: (int) bases after which a pass barcode is handed to on_part, None to disable
+        :param on_part: callable (barcode directory, concatenated fastq.gz, part, first part), run in the background on
+            the reads appended to a barcode since its previous part
+        :param on_done: callable (barcode directory, concatenated fastq.gz), run in the background once all the parts
+            of a barcode were processed
+        :return: None
+        """
+        watcher = BarcodeWatcher(self.output, ready_yield, on_part, on_done)
+        basecaller = telemetry.start(self.guppy_command(), stage="guppy_basecaller")
+        while not basecaller.done():
+            time.sleep(interval)
+            if not basecaller.done():
+                watcher.poll()
+        returncode = basecaller.wait()
+        if returncode != 0:
+            # the output is incomplete: nothing more is handed over, and barcodes keep their names
+            watcher.close(cancel=True)
+            raise subprocess.CalledProcessError(returncode, "guppy_basecaller")
+        watcher.poll(final=True)
+        watcher.close()
+
+        if self.args.ros != "None":
+            for i in ("pass", "fail"):
+                if os.path.isdir("{}/{}".format(self.output, i)):
+                    action_directory = FileTreatment("{}/{}".format(self.output, i))
+                    action_directory.csv = self.args.ros
+                    action_directory.file_renaming()
 
     def concatenate_output(self):
         """
@@ -92,7 +242,8 @@ class GuppyBaseCallerRun:
         directory_contents = os.listdir(self.output)
         for i in directory_contents:
             if os.path.isdir("{}/{}".format(self.output, i)) and (i == 'pass' or i == 'fail'):
-                action_directory = FileTreatment("{}/{}".format(self.output, i))
+                action_directory = FileTreatment("{}/{}".format(self.output, i), self.args.concat_threads,
+                                                 self.args.bgzf)
                 if self.args.ros != "None":
                     action_directory.csv = self.args.ros
                     action_directory.file_renaming()
@@ -100,10 +251,250 @@ class GuppyBaseCallerRun:
                 action_directory.concatenation()
 
 
+class WorkflowTable:
+    """
+    The kit/flowcell -> model table printed by guppy_basecaller --print_workflows, parsed once and cached on disk
+    under the path, size and mtime of the guppy binary, so it is rebuilt only when guppy is changed. The size and
+    mtime stand for the version: reading the version means launching guppy, which the cache is there to avoid. The
+    version printed with the workflows is kept with the table.
+    """
+    CACHE = os.path.join(os.path.expanduser("~"), ".cache", "guppy_workflows.json")
+
+    def __init__(self, workflows, version=None):
+        """
+        :param workflows: dictionary {(flowcell, kit): model}
+        :param version: (str) version of guppy the table comes from
+        """
+        self.workflows = workflows
+        self.version = version
+
+    @staticmethod
+    def parse(text):
+        """
+        :param text: (str) output of guppy_basecaller --print_workflows
+        :return: WorkflowTable
+        """
+        workflows = {}
+        version = re.search(r"[Vv]ersion\s+(\S+)", text)
+        for line in text.splitlines():
+            fields = line.split()
+            if len(fields) >= 3 and fields[0].startswith("FLO-"):
+                # the config name (dna_r9.4.1_450bps_hac), newer versions print the model version after it
+                workflows[(fields[0], fields[1])] = next((f for f in fields[2:] if f.startswith(("dna", "rna"))),
+                                                         fields[-1])
+        return WorkflowTable(workflows, version.group(1) if version else None)
+
+    @staticmethod
+    def load(binary="guppy_basecaller", cache=None):
+        """
+        Returns the cached table of this guppy binary, and runs --print_workflows only if it is missing or stale.
+
+        :param binary: (str) name or path of guppy_basecaller
+        :param cache: (str) path of the JSON cache, defaults to WorkflowTable.CACHE
+        :return: WorkflowTable
+        """
+        cache = cache if cache else WorkflowTable.CACHE
+        path = shutil.which(binary)
+        if path is None:
+            raise FileNotFoundError("{} was not found in the PATH".format(binary))
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+        entries = {}
+        if os.path.isfile(cache):
+            try:
+                with open(cache) as ftr:
+                    entries = json.load(ftr)
+            except ValueError:
+                entries = {}
+        entry = entries.get(path)
+        # an empty table is never written since, but may be left by an older version
+        if entry and entry["size"] == key["size"] and entry["mtime"] == key["mtime"] and entry["workflows"]:
+            return WorkflowTable({tuple(k.split(" ")): v for k, v in entry["workflows"].items()}, entry["version"])
+
+        p1 = telemetry.start([path, "--print_workflows"], stage="guppy_basecaller", stdout=subprocess.PIPE)
+        stdout = p1.process.stdout.read()
+        returncode = p1.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, [path, "--print_workflows"])
+        table = WorkflowTable.parse(stdout.decode(errors="replace"))
+        if not table.workflows:
+            # cached, it would fail every lookup until guppy is changed
+            raise ValueError("{} --print_workflows listed no workflows.".format(path))
+
+        entries[path] = dict(key, version=table.version,
+                             workflows={" ".join(k): v for k, v in table.workflows.items()})
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        tmp = "{}.{}.tmp".format(cache, os.getpid())
+        with open(tmp, "w") as ftw:
+            json.dump(entries, ftw, indent=1, sort_keys=True)
+        os.replace(tmp, cache)
+        return table
+
+    def model(self, kit, flowcell):
+        """
+        :return: (str) model of the kit/flowcell combination
+        """
+        try:
+            return self.workflows[(flowcell, kit)]
+        except KeyError:
+            pass
+        known = [" ".join(k) for k in self.workflows]
+        near = difflib.get_close_matches("{} {}".format(flowcell, kit), known, n=5, cutoff=0.6)
+        raise ValueError("No guppy {}workflow for flowcell {} and kit {}. {}".format(
+            "{} ".format(self.version) if self.version else "", flowcell, kit,
+            "Closest flowcell/kit combinations: {}.".format(", ".join(near)) if near else
+            "guppy knows {} combinations, none of them close.".format(len(known))))
+
+
+class BarcodeWatcher:
+    """
+    Follows the pass/ and fail/ trees while guppy is writing them. A fastq_runid chunk is appended to its barcode's
+    concatenated file as soon as it is complete (same size on two scans, and a fully readable gzip), and is then
+    removed. Scans are done with os.scandir, there is no inotify support in the standard library.
+    """
+
+    def __init__(self, output, ready_yield=None, on_part=None, on_done=None):
+        self.output = output
+        self.ready_yield = ready_yield  # bases after which a pass barcode is handed to on_part
+        self.on_part = on_part
+        self.on_done = on_done
+        self.sizes = {}  # chunk path: size on the previous scan
+        self.bases = {}  # barcode directory: bases appended so far
+        self.texts = {}  # barcode directory: its concatenated file
+        self.handed = {}  # barcode directory: bytes of its concatenated file already handed to on_part
+        self.last = {}  # barcode directory: future of its last job, the next one waits for it
+        self.parts = []  # part files handed to on_part, removed once processed
+        self.pool = ThreadPoolExecutor(max_workers=4)
+
+    def chunks(self):
+        """
+        :return: list of tuples (barcode directory, concatenated file, chunk path), in natural chunk order
+        """
+        found = []
+        for tree in ("pass", "fail"):
+            tree_dir = "{}/{}".format(self.output, tree)
+            if not os.path.isdir(tree_dir):
+                continue
+            for entry in os.scandir(tree_dir):
+                if entry.is_dir():
+                    text = "{}/{}_{}.fastq.gz".format(entry.path, tree, entry.name)
+                    found.extend((entry.path, text, c.path) for c in os.scandir(entry.path)
+                                 if c.is_file() and c.name.startswith("fastq_runid"))
+                elif entry.name.startswith("fastq_runid"):
+                    found.append((tree_dir, "{}/{}.fastq.gz".format(tree_dir, tree), entry.path))
+        return sorted(found, key=lambda c: FileTreatment.chunk_order(c[2]))
+
+    @staticmethod
+    def count_bases(chunk):
+        """
+        :param chunk: (str) path to a fastq(.gz) chunk
+        :return: (int) number of bases in the chunk, or None if the chunk is not complete yet
+        """
+        try:
+            return sum(sum(map(len, lines[1::4])) for lines in fastx.fastq_blocks(chunk))
+        except (EOFError, OSError, ValueError, zlib.error):
+            return None
+
+    def poll(self, final=False):
+        """
+        Appends the complete chunks to their concatenated files.
+
+        :param final: (bool) True once guppy has exited, every chunk left is then appended
+        :return: None
+        """
+        for barcode_dir, text, chunk in self.chunks():
+            size = os.stat(chunk).st_size
+            previous = self.sizes.get(chunk)
+            self.sizes[chunk] = size
+            if not final and (size != previous or size == 0 or not chunk.endswith(".gz")):
+                # still being written, or uncompressed (and so impossible to check): wait
+                continue
+            bases = BarcodeWatcher.count_bases(chunk)
+            if bases is None:
+                if final:
+                    print("{} is incomplete or corrupted, it was not concatenated.".format(chunk))
+                continue
+            with open(text, "ab", buffering=0) as ftw:
+                FileTreatment.append_file(chunk, ftw)
+            os.remove(chunk)
+            del self.sizes[chunk]
+            self.bases[barcode_dir] = self.bases.get(barcode_dir, 0) + bases
+            self.texts[barcode_dir] = text
+        self.hand_over(final)
+
+    def hand_over(self, final=False):
+        """
+        Hands the pass barcodes that reached ready_yield to on_part, a part at a time: the bytes appended to the
+        concatenated file since the previous part are copied to a part file, which is a valid gzip since only whole
+        chunks are appended. The parts of a barcode are processed in order, in the background, while guppy keeps
+        basecalling. Once guppy is done, the last part is handed over, then on_done runs on the complete file.
+
+        :param final: (bool) True once guppy has exited and every chunk was appended
+        :return: None
+        """
+        if self.on_part is None or self.ready_yield is None:
+            return
+        for barcode_dir, text in sorted(self.texts.items()):
+            if barcode_dir.split("/")[-2] != "pass" or self.bases[barcode_dir] < self.ready_yield:
+                continue
+            start = self.handed.get(barcode_dir, 0)
+            end = os.path.getsize(text)
+            if end > start:
+                if not start:
+                    print("{} reached {} bases, starting its post-processing.".format(barcode_dir,
+                                                                                       self.bases[barcode_dir]))
+                part = "{}/part_{}_{}".format(barcode_dir, start, os.path.basename(text))
+                with open(text, "rb") as ftr, open(part, "wb") as ftw:
+                    ftr.seek(start)
+                    shutil.copyfileobj(ftr, ftw, COPY_BUFFER)
+                self.handed[barcode_dir] = end
+                self.parts.append(part)
+                self.submit(barcode_dir, self._part, barcode_dir, text, part, start == 0)
+            if final and self.on_done is not None:
+                self.submit(barcode_dir, self.on_done, barcode_dir, text)
+
+    def submit(self, barcode_dir, function, *args):
+        """
+        Runs function(*args) in the background once the previous job of the barcode succeeded.
+        """
+        self.last[barcode_dir] = self.pool.submit(self._after, self.last.get(barcode_dir), function, *args)
+
+    @staticmethod
+    def _after(previous, function, *args):
+        if previous is not None:
+            previous.result()  # raises if a previous part failed, the barcode stops there
+        return function(*args)
+
+    def _part(self, barcode_dir, text, part, first):
+        try:
+            self.on_part(barcode_dir, text, part, first)
+        finally:
+            os.remove(part)
+
+    def close(self, cancel=False):
+        """
+        Waits for the background jobs to finish, and reports the barcodes whose post-processing failed.
+
+        :param cancel: (bool) drop the jobs that did not start yet
+        :return: None
+        """
+        self.pool.shutdown(wait=True, cancel_futures=cancel)
+        for part in self.parts:
+            if os.path.exists(part):
+                os.remove(part)  # part of a cancelled job
+        for barcode_dir, job in sorted(self.last.items()):
+            if not job.cancelled() and job.exception() is not None:
+                print("{}: post-processing failed: {}".format(barcode_dir, job.exception()))
+
+
 class FileTreatment:
-    def __init__(self, directory):
+    def __init__(self, directory, threads=1, bgzf_level=None):
         self.csv = None
         self.directory = directory
+        self.threads = max(1, int(threads))  # number of barcode directories concatenated at the same time
+        self.bgzf_level = bgzf_level  # if set, gzipped chunks are recompressed as BGZF with this compression level
 
     def file_renaming(self):
         """
@@ -133,13 +524,21 @@ class FileTreatment:
         for sd in subdirectory_list:
             if sd.lower() in df_dict.keys():
                 os.rename("{}/{}".format(working_dir, sd), "{}/{}".format(working_dir, df_dict[sd.lower()]))
+                # concatenated in watch mode, before the renaming: keep the file name in line with its directory
+                tree = working_dir.split('/')[-1]
+                concatenated = "{}/{}/{}_{}.fastq.gz".format(working_dir, df_dict[sd.lower()], tree, sd)
+                if os.path.isfile(concatenated):
+                    os.rename(concatenated, "{}/{}/{}_{}.fastq.gz".format(working_dir, df_dict[sd.lower()], tree,
+                                                                       df_dict[sd.lower()]))
             else:
                 print("{} could not be renamed. No replacement found in the csv file provided.".format(sd))
 
     def concatenation(self):
         """
         If subdirectories are present, concatenated all "fastq_runid" fastq.gz files. Otherwise, concatenates all
-        files starting with "fastq_runid" within the directory. Calls for the deletion of copied files.
+        files starting with "fastq_runid" within the directory. Barcode directories are concatenated in parallel
+        (self.threads), chunks are always appended in the same (natural) order so reruns give byte-identical files.
+        Calls for the deletion of copied files, only once the concatenated file has been verified.
 
         EDIT: Make for both non-gzipped and gzipped
 
@@ -148,40 +547,130 @@ class FileTreatment:
         :return: None.
         """
         starting_directory = self.directory
-        contents = os.listdir(starting_directory)
         directory_name = self.directory.split('/')[-1] # provides fail or pass
-        subdirectories = [c for c in contents if os.path.isdir('{}/{}'.format(starting_directory, c))]
+        subdirectories = sorted(e.name for e in os.scandir(starting_directory) if e.is_dir())
         if len(subdirectories) != 0:
-            for sd in subdirectories:
-                ref_dir = '{}/{}'.format(starting_directory, sd)
-                files = [f for f in os.listdir(ref_dir) if os.path.isfile('{}/{}'.format(ref_dir, f))]
-                text = "{}/{}/{}_{}.fastq.gz".format(starting_directory, sd, directory_name, sd)
-                with open(text, "wb") as ftw:
-                    for f in files:
-                        if f.startswith("fastq_runid"):
-                            with open("{}/{}/{}".format(starting_directory, sd, f), "rb") as ftr:
-                                shutil.copyfileobj(ftr, ftw)
-
-                # checks to see the size of the final concatenated file is greater than zero.
-                if os.stat(text).st_size != 0:
-                    FileTreatment.clean_up("{}/{}".format(starting_directory, sd))
+            jobs = [('{}/{}'.format(starting_directory, sd),
+                     "{}/{}/{}_{}.fastq.gz".format(starting_directory, sd, directory_name, sd))
+                    for sd in subdirectories]
+        else:
+            jobs = [(starting_directory, "{}/{}.fastq.gz".format(starting_directory, directory_name))]
+
+        # the cores left by the barcode pool go to the BGZF compression of each barcode
+        bgzf_threads = max(1, len(os.sched_getaffinity(0)) // self.threads)
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            results = pool.map(lambda job: FileTreatment.concatenate_directory(*job, self.bgzf_level, bgzf_threads),
+                               jobs)
+            for (ref_dir, text), verified in zip(jobs, results):
+                if verified:
+                    FileTreatment.clean_up(ref_dir)
                 else:
-                    print("The concatenated file seems to be empty. We won't delete any of the files in this folder.")
+                    print("The concatenated file {} seems to be empty or corrupted. We won't delete any of the files "
+                          "in this folder.".format(text))
+
+    @staticmethod
+    def chunk_order(name):
+        """
+        Natural sort key, so fastq_runid_x_2 comes before fastq_runid_x_10.
 
+        :param name: (str) file name
+        :return: list
+        """
+        return [int(t) if t.isdigit() else t for t in re.split(r"(\d+)", name)]
+
+    @staticmethod
+    def concatenate_directory(ref_dir, text, bgzf_level=None, bgzf_threads=1):
+        """
+        Concatenates the "fastq_runid" files of one directory into text, and checks the result.
+
+        :param ref_dir: (str) directory with the fastq_runid chunks
+        :param text: (str) path of the concatenated file
+        :param bgzf_level: (int) if set, gzipped chunks are recompressed into a BGZF file, allowing random access
+        :param bgzf_threads: (int) compression threads used for BGZF
+        :return: (bool) True if the concatenated file is non-empty and, for gzipped chunks, a valid multi-member gzip.
+        """
+        chunks = sorted((e.name for e in os.scandir(ref_dir) if e.is_file() and e.name.startswith("fastq_runid")),
+                        key=FileTreatment.chunk_order)
+        if bgzf_level is not None and chunks and all(f.endswith(".gz") for f in chunks):
+            try:
+                with BgzfWriter(text, bgzf_threads, bgzf_level) as ftw:
+                    for f in chunks:
+                        with gzip.open("{}/{}".format(ref_dir, f), "rb") as ftr:
+                            shutil.copyfileobj(ftr, ftw, COPY_BUFFER)
+            except (EOFError, OSError, zlib.error):
+                return False
         else:
-            text = "{}/{}.fastq.gz".format(starting_directory, directory_name)
-            files = [f for f in os.listdir(starting_directory) if os.path.isfile('{}/{}'.format(starting_directory, f))]
-            with open(text, "wb") as ftw:
-                for f in files:
-                    if f.startswith("fastq_runid"):
-                        with open("{}/{}".format(starting_directory, f), "rb") as ftr:
-                            shutil.copyfileobj(ftr, ftw)
-
-            # checks to see the size of the final concatenated file is greater than zero.
-            if os.stat(text).st_size != 0:
-                FileTreatment.clean_up(starting_directory)
-            else:
-                print("The concatenated file seems to be empty. We won't delete any of the files in this folder.")
+            with open(text, "wb", buffering=0) as ftw:
+                for f in chunks:
+                    FileTreatment.append_file("{}/{}".format(ref_dir, f), ftw)
+
+        # checks to see the size of the final concatenated file is greater than zero.
+        if os.stat(text).st_size == 0:
+            return False
+        if all(f.endswith(".gz") for f in chunks):
+            return FileTreatment.verify_gzip(text)
+        return True
+
+    @staticmethod
+    def append_file(source, ftw):
+        """
+        Appends source to the end of the unbuffered file ftw. Uses copy_file_range, then sendfile, so the data does
+        not go through python, and falls back on a large buffered copy if the kernel supports neither.
+
+        :param source: (str) path of the file to append
+        :param ftw: unbuffered binary file object opened for writing
+        :return: None.
+        """
+        with open(source, "rb") as ftr:
+            in_fd, out_fd = ftr.fileno(), ftw.fileno()
+            size = os.fstat(in_fd).st_size
+            offset = 0
+            for zero_copy in (FileTreatment._copy_file_range, FileTreatment._sendfile):
+                try:
+                    while offset < size:
+                        copied = zero_copy(in_fd, out_fd, offset, size - offset)
+                        if copied == 0:
+                            break
+                        offset += copied
+                except (AttributeError, OSError):
+                    pass
+                if offset >= size:
+                    return
+            ftr.seek(offset)
+            shutil.copyfileobj(ftr, ftw, COPY_BUFFER)
+
+    @staticmethod
+    def _copy_file_range(in_fd, out_fd, offset, count):
+        return os.copy_file_range(in_fd, out_fd, count, offset)
+
+    @staticmethod
+    def _sendfile(in_fd, out_fd, offset, count):
+        return os.sendfile(out_fd, in_fd, offset, count)
+
+    @staticmethod
+    def verify_gzip(path):
+        """
+        Decompresses the whole file, member after member, so the CRC and size of every member are checked.
+
+        :param path: (str) path to a gzip file
+        :return: (bool) True if the file is a complete, valid (multi-member) gzip
+        """
+        decompressor = None  # decompressor of the member being read, None between members
+        try:
+            with open(path, "rb") as ftr:
+                for block in iter(lambda: ftr.read(COPY_BUFFER), b""):
+                    while block:
+                        if decompressor is None:
+                            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        decompressor.decompress(block)
+                        if decompressor.eof:
+                            block = decompressor.unused_data
+                            decompressor = None
+                        else:
+                            block = b""
+        except zlib.error:
+            return False
+        return decompressor is None
 
     @staticmethod
     def clean_up(directory):
@@ -208,13 +697,13 @@ if __name__ == "__main__":
     parser.add_argument("-t", metavar="INT", type=str, help="Number of threads to be used for barcoding. Default 1.",
                         dest='threads', default="1")
 
-    parser.add_argument("-flowcell", metavar='F', type=str, required=True
+    parser.add_argument("-flowcell", metavar='F', type=str, required=True,
                         help="Flowcell ID of run. Required, write as a string in single quotations", dest='flowcell')
 
-    parser.add_argument("-kit", metavar='K', type=str, required=True
+    parser.add_argument("-kit", metavar='K', type=str, required=True,
                         help="Kit ID. Required, write as a string in single quotations", dest='kit')
 
-    parser.add_argument("-barcodekit", metavar="KIT", dest="barcodekit", type=str, default="None", required=True
+    parser.add_argument("-barcodekit", metavar="KIT", dest="barcodekit", type=str, default="None", required=True,
                         help="Barcode appropriate for used kit. Default is None. If there is a barcode input, write it within single quotation marks")
 
     parser.add_argument("-chunk_size", metavar="INT", type=str, help="Default is 1000", default="1000", dest="chunksize")  # chunk size
@@ -249,8 +738,74 @@ if __name__ == "__main__":
 
     parser.add_argument("-device", metavar="arg", dest="device", help="Default cudo:0", default="cuda:0")
 
+    parser.add_argument("-shards", metavar="INT", type=int, dest="shards", default=1,
+                        help="Number of guppy_basecaller instances run at the same time, each on a share of the fast5 "
+                             "files balanced by size. Default 1.")
+
+    parser.add_argument("-devices", metavar="LIST", dest="devices", default=None,
+                        help="Comma separated devices the shards are spread over (cuda:0,cuda:1 or cpu). "
+                             "Default: -device.")
+
+    parser.add_argument("-concat_threads", metavar="INT", type=int, dest="concat_threads", default=8,
+                        help="Number of barcode directories concatenated at the same time. Default 8.")
+
+    parser.add_argument("-bgzf", metavar="LEVEL", type=int, dest="bgzf", default=None,
+                        help="Recompress the concatenated files as BGZF with this compression level (0-9), "
+                             "allowing random access. Default: chunks are concatenated as they are.")
+
+    parser.add_argument("-watch", action="store_true", default=False, dest="watch",
+                        help="Concatenate chunks while guppy is basecalling, instead of after.")
+
+    parser.add_argument("-watch_interval", metavar="SEC", type=int, dest="watch_interval", default=30,
+                        help="Seconds between two scans of the output in watch mode. Default 30.")
+
+    parser.add_argument("-ready_yield", metavar="BASES", type=int, dest="ready_yield", default=None,
+                        help="Watch mode only: once a pass barcode has this many bases, start trimming its adapters, then trim its new reads at every scan while guppy is basecalling. Filtlong runs on all its trimmed reads once guppy is done.")
+
+    parser.add_argument("-minlen", metavar="NUM", dest="minlen", default="1000",
+                        help="Filtlong minimum read length used with -ready_yield. Default 1000.")
+
+    parser.add_argument("-genomesize", metavar="NUM", dest="genomesize", default=None,
+                        help="Genome size used by filtlong with -ready_yield.")
+
+    parser.add_argument("-workflow_cache", metavar="PATH", dest="workflow_cache", default=None,
+                        help="File caching the kit/flowcell models printed by guppy_basecaller --print_workflows. "
+                             "Default ~/.cache/guppy_workflows.json.")
+
+    parser.add_argument("-trace", metavar="PATH", dest="trace", default=None,
+                        help="Append the wall time, cpu time, peak RSS and I/O of every tool run to this JSONL file, and print a summary of the top consumers at the end.")
+
     args = parser.parse_args()
+    if args.watch and args.shards > 1:
+        parser.error("-watch follows the output of a single guppy instance, it can not be combined with -shards.")
+    telemetry.configure(args.trace)
 
     CurrentRun = GuppyBaseCallerRun(args)
-    CurrentRun.guppy()  # results in base calling
-    CurrentRun.concatenate_output()  # results in files being renamed, concatenated, and deleted if redundant
+    if args.watch:
+        def watched_sample(barcode_dir, reads):
+            sample = filtering.FilteringSample(barcode_dir.split("/")[-1])
+            sample.longread = reads
+            sample.minlen = args.minlen
+            sample.genomesize = args.genomesize
+            return sample
+
+        def trim_part(barcode_dir, reads, part, first):
+            sample = watched_sample(barcode_dir, reads)
+            with telemetry.context(sample=sample.name):
+                sample.trim_part(part, append=not first)
+
+        def filter_barcode(barcode_dir, reads):
+            sample = watched_sample(barcode_dir, reads)
+            with telemetry.context(sample=sample.name):
+                sample.filtlong(trimmed=True)
+
+        # basecalling, concatenation, and adapter trimming of the ready barcodes
+        CurrentRun.watch(args.watch_interval, args.ready_yield, trim_part, filter_barcode)
+    elif args.shards > 1:
+        CurrentRun.guppy_sharded(args.shards, args.devices.split(",") if args.devices else None)
+        CurrentRun.concatenate_output()
+    else:
+        CurrentRun.guppy()  # results in base calling
+        CurrentRun.concatenate_output()  # results in files being renamed, concatenated, and deleted if redundant
+    if args.trace:
+        telemetry.summary(args.trace)
@@ -0,0 +1,190 @@
+import json
+import os
+
+import numpy as np
+
+import fastx
+
+GC = np.zeros(256, dtype=bool)
+GC[list(b"GCgcSs")] = True
+AMBIGUOUS = np.zeros(256, dtype=bool)
+AMBIGUOUS[list(b"Nn")] = True
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[list(b"\r\n\t ")] = True
+
+
+def contig_table(path, block_size=fastx.BLOCK_SIZE):
+    """
+    Reads a multi-fasta(.gz) file in large blocks. The bases of each contig are counted with one bincount per
+    stretch of sequence, so contigs are never assembled into strings.
+
+    :param path: (str) path to the fasta(.gz) file
+    :param block_size: (int) number of decompressed bytes to read at a time
+    :return: tuple (names, lengths, GC counts, N counts), the counts being numpy arrays with one entry per contig
+    """
+    names, counts = [], []
+    current = None
+    leftover = b""
+    with fastx.open_reads(path) as ftr:
+        while True:
+            block = ftr.read(block_size)
+            buffer = leftover + block
+            leftover = b""
+            pos = 0
+            while pos < len(buffer):
+                start = buffer.find(b">", pos)
+                end = start if start != -1 else len(buffer)
+                if current is not None and end > pos:
+                    current += np.bincount(np.frombuffer(buffer, dtype=np.uint8, count=end - pos, offset=pos),
+                                           minlength=256)
+                if start == -1:
+                    break
+                line_end = buffer.find(b"\n", start)
+                if line_end == -1 and block:
+                    leftover = buffer[start:]  # header cut by the end of the block
+                    break
+                line_end = len(buffer) if line_end == -1 else line_end
+                header = buffer[start + 1:line_end].split(None, 1)
+                names.append(header[0].decode() if header else "")
+                current = np.zeros(256, dtype=np.int64)
+                counts.append(current)
+                pos = line_end + 1
+            if not block:
+                break
+    counts = np.array(counts, dtype=np.int64).reshape(-1, 256)
+    lengths = counts[:, ~WHITESPACE].sum(axis=1)
+    return names, lengths, counts[:, GC].sum(axis=1), counts[:, AMBIGUOUS].sum(axis=1)
+
+
+def n50(lengths, fraction=0.5):
+    """
+    :param lengths: numpy array of contig lengths
+    :param fraction: (float) 0.5 for N50/L50, 0.9 for N90/L90
+    :return: tuple (N50, L50): the length of the contig that brings the longest contigs to half of the assembly,
+        and their number
+    """
+    if not len(lengths):
+        return 0, 0
+    ordered = np.sort(lengths)[::-1]
+    index = int(np.searchsorted(np.cumsum(ordered), fraction * ordered.sum()))
+    return int(ordered[index]), index + 1
+
+
+def summary(path):
+    """
+    :param path: (str) path to an assembly fasta(.gz) file
+    :return: dictionary with the contig count, total length, N50, L50, longest contig, GC content and N count
+    """
+    names, lengths, gc, ambiguous = contig_table(path)
+    total = int(lengths.sum())
+    called = total - int(ambiguous.sum())
+    n50_length, l50 = n50(lengths)
+    return {"contigs": len(names),
+            "length": total,
+            "n50": n50_length,
+            "l50": l50,
+            "longest": int(lengths.max()) if len(lengths) else 0,
+            "gc": round(100 * int(gc.sum()) / called, 3) if called else 0.0,
+            "n": int(ambiguous.sum())}
+
+
+def delta(previous, current):
+    """
+    :param previous: summary of the previous assembly (or round)
+    :param current: summary of the current one
+    :return: dictionary of the differences (current - previous) of the contig count, length, N50 and GC content
+    """
+    return {"contigs": current["contigs"] - previous["contigs"],
+            "length": current["length"] - previous["length"],
+            "n50": current["n50"] - previous["n50"],
+            "gc": round(current["gc"] - previous["gc"], 3)}
+
+
+def count_changes(changes):
+    """
+    :param changes: (str) path to a pilon .changes file
+    :return: (int) number of changes pilon made, None if the file does not exist
+    """
+    if not changes or not os.path.isfile(changes):
+        return None
+    with open(changes) as ftr:
+        return sum(1 for line in ftr if line.strip())
+
+
+class QCLog:
+    """
+    Compact per-sample QC record: one entry per assembly and per polishing round, in the order they were made, each
+    with the summary of its fasta, the difference with the previous entry, and for pilon rounds the number of
+    changes. Kept as <sample dir>/<sample>_qc.json. An entry made again (rerun) replaces the old one and the entries
+    made after it.
+    """
+
+    def __init__(self, directory, name):
+        """
+        :param directory: (str) directory of the sample
+        :param name: (str) sample name
+        """
+        self.path = "{}/{}_qc.json".format(directory.rstrip("/"), name)
+        self.name = name
+        self.entries = []
+        if os.path.isfile(self.path):
+            with open(self.path) as ftr:
+                self.entries = json.load(ftr).get("entries", [])
+
+    def add(self, stage, assembly, changes=None):
+        """
+        Summarises an assembly, prints it and saves the log.
+
+        :param stage: (str) what produced the assembly: shasta, spades, skesa, medaka, pilon_<round>...
+        :param assembly: (str) path to its fasta(.gz)
+        :param changes: (str) path to the pilon .changes file of the round
+        :return: dictionary, the entry added
+        """
+        stages = [e["stage"] for e in self.entries]
+        if stage in stages:
+            del self.entries[stages.index(stage):]
+        entry = {"stage": stage, "path": assembly}
+        entry.update(summary(assembly))
+        if changes:
+            entry["changes"] = count_changes(changes)
+        if self.entries:
+            entry["delta"] = delta(self.entries[-1], entry)
+        self.entries.append(entry)
+        self.save()
+        QCLog.report(self.name, entry)
+        return entry
+
+    @staticmethod
+    def report(name, entry):
+        line = "{} {}: {} contigs, {} bp, N50 {} (L50 {}), longest {}, GC {:.2f}%, {} N".format(
+            name, entry["stage"], entry["contigs"], entry["length"], entry["n50"], entry["l50"], entry["longest"],
+            entry["gc"], entry["n"])
+        if entry.get("changes") is not None:
+            line += ", {} changes".format(entry["changes"])
+        if "delta" in entry:
+            d = entry["delta"]
+            line += " (contigs {:+d}, length {:+d}, N50 {:+d}, GC {:+.3f})".format(d["contigs"], d["length"],
+                                                                               d["n50"], d["gc"])
+        print(line)
+
+    @staticmethod
+    def converged(entry, max_changes, max_length_delta=None):
+        """
+        :param entry: entry of a pilon round
+        :param max_changes: (int) largest number of changes of a round that is considered converged
+        :param max_length_delta: (int) largest change of the assembly length (bp), defaults to max_changes
+        :return: (bool) True if the round changed at most max_changes positions, and the assembly length and N50 by
+            at most max_length_delta, without changing the contig count
+        """
+        if entry.get("changes") is None or "delta" not in entry:
+            return False
+        d = entry["delta"]
+        max_length_delta = max_changes if max_length_delta is None else max_length_delta
+        return (entry["changes"] <= max_changes and abs(d["length"]) <= max_length_delta
+                and abs(d["n50"]) <= max_length_delta and d["contigs"] == 0)
+
+    def save(self):
+        tmp = "{}.tmp".format(self.path)
+        with open(tmp, "w") as ftw:
+            json.dump({"sample": self.name, "entries": self.entries}, ftw, separators=(",", ":"))
+        os.replace(tmp, self.path)
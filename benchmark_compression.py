@@ -0,0 +1,42 @@
+import argparse
+import gzip
+import os
+import time
+
+from bgzf import BgzfWriter
+
+# Compares serial gzip (python's gzip module, single-threaded zlib) with the multithreaded BGZF writer used for the
+# project's outputs, on the decompressed content of a file.
+
+parser = argparse.ArgumentParser(description="Benchmark serial gzip against the multithreaded BGZF writer.")
+parser.add_argument("-input", metavar="PATH", dest="input", required=True, help="File to compress (gzipped files are decompressed first).")
+parser.add_argument("-output", metavar="DIR PATH", dest="output", default=".", help="Directory for the compressed files.")
+parser.add_argument("-level", metavar="LEVEL", dest="level", type=int, default=6, help="Compression level. Default 6.")
+parser.add_argument("-threads", metavar="INT", dest="threads", type=int, nargs="+",
+                    default=[1, 4, len(os.sched_getaffinity(0))], help="Thread counts tested for BGZF.")
+args = parser.parse_args()
+
+opener = gzip.open if args.input.endswith(".gz") else open
+with opener(args.input, "rb") as ftr:
+    data = ftr.read()
+print("{:.1f} MB of uncompressed data".format(len(data) / 1e6))
+print("writer\twall (s)\tMB/s\tratio")
+
+
+def report(name, wall, path):
+    print("{}\t{:.2f}\t{:.1f}\t{:.3f}".format(name, wall, len(data) / wall / 1e6, os.stat(path).st_size / len(data)))
+
+
+output = "{}/benchmark_serial.gz".format(args.output)
+start = time.time()
+with gzip.open(output, "wb", compresslevel=args.level) as ftw:
+    ftw.write(data)
+report("gzip", time.time() - start, output)
+
+for threads in args.threads:
+    output = "{}/benchmark_bgzf_{}.gz".format(args.output, threads)
+    start = time.time()
+    with BgzfWriter(output, threads, args.level) as ftw:
+        for i in range(0, len(data), 1024 * 1024):
+            ftw.write(data[i:i + 1024 * 1024])
+    report("bgzf x{}".format(threads), time.time() - start, output)
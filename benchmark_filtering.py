@@ -0,0 +1,60 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from readfilter import ReadFilter
+
+# Compares the throughput and peak memory of the filtlong and native long read filters, on reads that already
+# went through porechop. Each engine runs in its own process, so its peak RSS (and the one of the tools it starts)
+# is measured separately with wait4.
+
+parser = argparse.ArgumentParser(description="Benchmark the filtlong and native long read filtering engines.")
+parser.add_argument("-reads", metavar="PATH", dest="reads", required=True, help="Adapter-trimmed long reads (fastq or fastq.gz).")
+parser.add_argument("-minlen", metavar="NUM", dest="minlen", default="1000", help="Minimum read length. Default 1000.")
+parser.add_argument("-genomesize", metavar="NUM", dest="genomesize", default=None, help="Genome size, for the 100x target.")
+parser.add_argument("-output", metavar="DIR PATH", dest="output", default=".", help="Directory for the filtered reads.")
+parser.add_argument("-engines", metavar="ENGINE", dest="engines", nargs="+", default=["filtlong", "native"])
+parser.add_argument("-child", dest="child", default=None, help=argparse.SUPPRESS)
+args = parser.parse_args()
+
+
+def filter_reads(engine):
+    """
+    Runs the filtering step of FilteringSample.filtlong with the given engine, without porechop.
+    """
+    output = "{}/filtered_{}_benchmark".format(args.output, engine)
+    if engine == "native":
+        target = int(args.genomesize) * 100 if args.genomesize else None
+        ReadFilter(args.minlen, 90, target).run(args.reads, output)
+    else:
+        cmd = ["filtlong", "--min_length", args.minlen, "--keep_percent", "90"]
+        if args.genomesize:
+            cmd.extend(["--target_bases", str(int(args.genomesize) * 100)])
+        cmd.append(args.reads)
+        filt = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        gz = subprocess.Popen(["gzip"], stdin=filt.stdout, stdout=subprocess.PIPE)
+        filt.stdout.close()
+        data = gz.communicate()[0]
+        with open(output, "wb") as f:
+            f.write(data)
+
+
+if args.child:
+    filter_reads(args.child)
+    sys.exit(0)
+
+size = os.stat(args.reads).st_size
+print("engine\twall (s)\tMB/s\tpeak RSS (MB)\toutput (MB)")
+for engine in args.engines:
+    start = time.time()
+    process = subprocess.Popen([sys.executable] + sys.argv + ["-child", engine])
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.time() - start
+    if status != 0:
+        print("{}\tfailed with status {}".format(engine, os.waitstatus_to_exitcode(status)))
+        continue
+    output = os.stat("{}/filtered_{}_benchmark".format(args.output, engine)).st_size
+    print("{}\t{:.1f}\t{:.1f}\t{:.0f}\t{:.1f}".format(engine, wall, size / wall / 1e6, usage.ru_maxrss / 1024,
+                                                     output / 1e6))
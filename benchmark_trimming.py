@@ -0,0 +1,79 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import fastx
+from trimmer import Trimmer
+
+# Compares the native adapter trimmer with porechop: throughput and peak memory of each one, measured in its own
+# process with wait4, then the agreement of their outputs, read by read.
+
+parser = argparse.ArgumentParser(description="Benchmark the native adapter trimmer against porechop.")
+parser.add_argument("-reads", metavar="PATH", dest="reads", required=True, help="Basecalled long reads (fastq or fastq.gz).")
+parser.add_argument("-output", metavar="DIR PATH", dest="output", default=".", help="Directory for the trimmed reads.")
+parser.add_argument("-threads", metavar="INT", type=int, dest="threads", default=None, help="Threads of both trimmers. Default: all available cores.")
+parser.add_argument("-tolerance", metavar="BP", type=int, dest="tolerance", default=10, help="Largest difference of trimmed length for two trimmed reads to agree. Default 10.")
+parser.add_argument("-trimmers", metavar="TRIMMER", dest="trimmers", nargs="+", default=["porechop", "native"])
+parser.add_argument("-child", dest="child", default=None, help=argparse.SUPPRESS)
+args = parser.parse_args()
+threads = args.threads if args.threads else len(os.sched_getaffinity(0))
+
+
+def output_path(trimmer):
+    return "{}/trimmed_{}_benchmark.fastq{}".format(args.output, trimmer, ".gz" if trimmer == "native" else "")
+
+
+def trim_reads(trimmer):
+    if trimmer == "native":
+        Trimmer(threads).write(args.reads, output_path(trimmer))
+    else:
+        subprocess.run(["porechop", "-i", args.reads, "-o", output_path(trimmer), "--threads", str(threads)],
+                       stdout=subprocess.DEVNULL, check=True)
+
+
+def trimmed_lengths(path):
+    """
+    :return: dictionary {read ID: trimmed length}
+    """
+    lengths = {}
+    for lines in fastx.fastq_blocks(path):
+        for header, seq in zip(lines[0::4], lines[1::4]):
+            lengths[header[1:].split(maxsplit=1)[0]] = len(seq)
+    return lengths
+
+
+if args.child:
+    trim_reads(args.child)
+    sys.exit(0)
+
+size = os.stat(args.reads).st_size
+print("trimmer\twall (s)\tMB/s\tpeak RSS (MB)\tcpu (s)")
+for trimmer in args.trimmers:
+    start = time.time()
+    process = subprocess.Popen([sys.executable] + sys.argv + ["-child", trimmer])
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.time() - start
+    if status != 0:
+        print("{}\tfailed with status {}".format(trimmer, os.waitstatus_to_exitcode(status)))
+        continue
+    print("{}\t{:.1f}\t{:.1f}\t{:.0f}\t{:.1f}".format(trimmer, wall, size / wall / 1e6, usage.ru_maxrss / 1024,
+                                                     usage.ru_utime + usage.ru_stime))
+
+if all(os.path.isfile(output_path(t)) for t in ("porechop", "native")):
+    porechop, native = trimmed_lengths(output_path("porechop")), trimmed_lengths(output_path("native"))
+    common = sorted(set(porechop) & set(native))
+    differences = np.array([native[r] - porechop[r] for r in common], dtype=np.int64)
+    agree = np.count_nonzero(np.abs(differences) <= args.tolerance)
+    print("\n{} reads out of porechop, {} out of the native trimmer, {} in both.".format(
+        len(porechop), len(native), len(common)))
+    print("Only in porechop (dropped or split differently): {}".format(len(set(porechop) - set(native))))
+    print("Only in the native trimmer: {}".format(len(set(native) - set(porechop))))
+    if len(common):
+        print("Trimmed length within {} bp of porechop: {} ({:.2%})".format(
+            args.tolerance, agree, agree / len(common)))
+        print("Native minus porechop length, percentiles 1/5/50/95/99: {}".format(
+            " / ".join(str(int(v)) for v in np.percentile(differences, [1, 5, 50, 95, 99]))))
@@ -0,0 +1,103 @@
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Uncompressed bytes per BGZF block, as in htslib, so a compressed block always fits the 64 KiB limit.
+BLOCK_SIZE = 0xff00
+# Blocks compressed together by one task of the thread pool, to keep the per-task overhead low.
+BLOCKS_PER_TASK = 64
+# Empty block marking the end of a BGZF file.
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data, level):
+    """
+    :param data: bytes, at most BLOCK_SIZE bytes
+    :param level: (int) compression level
+    :return: bytes, data as one BGZF block (a gzip member with the BC extra field holding the block size)
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) > 65536 - 26:
+        # incompressible data: store it as is
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+def compress_blocks(data, level):
+    """
+    :param data: bytes, cut into BLOCK_SIZE blocks
+    :param level: (int) compression level
+    :return: bytes, the BGZF blocks of data
+    """
+    return b"".join(compress_block(data[i:i + BLOCK_SIZE], level) for i in range(0, len(data), BLOCK_SIZE))
+
+
+class BgzfWriter:
+    """
+    Multithreaded BGZF writer. Data is cut in 64 KiB blocks, compressed as independent gzip members on a thread pool
+    (zlib releases the GIL) and written in order. The output is a valid multi-member gzip that any gzip reader can
+    decompress, and that samtools/htslib tools can also read with random access.
+    """
+
+    def __init__(self, fileobj, threads=None, level=6):
+        """
+        :param fileobj: binary file object, or path of the file to create
+        :param threads: (int) compression threads, defaults to the number of available cores
+        :param level: (int) compression level
+        """
+        self.owned = isinstance(fileobj, str)
+        self.fileobj = open(fileobj, "wb") if self.owned else fileobj
+        self.threads = threads if threads else len(os.sched_getaffinity(0))
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = deque()  # compression tasks, in output order
+        self.buffer = bytearray()
+        self.task_size = BLOCK_SIZE * BLOCKS_PER_TASK
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+        while len(self.buffer) >= self.task_size:
+            self._submit(bytes(self.buffer[:self.task_size]))
+            del self.buffer[:self.task_size]
+        return len(data)
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(compress_blocks, data, self.level))
+        # bound the memory used by blocks waiting to be written
+        while len(self.pending) > 2 * self.threads:
+            self._write_one()
+
+    def _write_one(self):
+        blocks = self.pending.popleft().result()
+        self.fileobj.write(blocks)
+        self.bytes_out += len(blocks)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_one()
+        self.fileobj.write(EOF_BLOCK)
+        self.bytes_out += len(EOF_BLOCK)
+        self.pool.shutdown()
+        if self.owned:
+            self.fileobj.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,220 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+# Buffer used to compute file digests.
+DIGEST_BUFFER = 16 * 1024 * 1024
+
+
+class ResultCache:
+    """
+    Content-addressed cache of stage outputs. A stage is identified by its name, the identity of the tool (resolved
+    path, size and mtime of the executable), its argument vector and the digests of its input files. If a stage
+    with the same key already ran, its outputs are restored instead of running the tool again.
+
+    Outputs are kept in <directory>/objects/<key>/, hard linked when possible, and listed in manifest.json together
+    with their size and last use. Once the cache grows over max_size, the least recently used entries are evicted.
+    Because of the hard links, stage outputs must be treated as read-only once they are written.
+    """
+
+    def __init__(self, directory, max_size=None):
+        """
+        :param directory: (str) cache directory, created if needed
+        :param max_size: (float) maximum size of the cache in GB, None for no limit
+        """
+        self.directory = directory
+        self.objects = os.path.join(directory, "objects")
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.max_size = int(float(max_size) * 1024 ** 3) if max_size else None
+        self.thread_lock = threading.Lock()
+        os.makedirs(self.objects, exist_ok=True)
+
+    @contextmanager
+    def manifest(self):
+        """
+        Loads the manifest for a read-modify-write, locked against other threads and other processes.
+
+        :return: dict {"entries": {key: entry}, "digests": {path: [size, mtime_ns, digest]}}
+        """
+        with self.thread_lock, open(os.path.join(self.directory, "manifest.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.manifest_path) as ftr:
+                    manifest = json.load(ftr)
+            except (OSError, ValueError):
+                manifest = {"entries": {}, "digests": {}}
+            yield manifest
+            with open(self.manifest_path + ".tmp", "w") as ftw:
+                json.dump(manifest, ftw, indent=1, sort_keys=True)
+            os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    @staticmethod
+    def tool_identity(tool):
+        """
+        :param tool: (str) executable name or path
+        :return: list identifying this version of the tool
+        """
+        path = shutil.which(tool) or tool
+        try:
+            st = os.stat(path)
+        except OSError:
+            return [tool]
+        return [os.path.realpath(path), st.st_size, st.st_mtime_ns]
+
+    def digest(self, path):
+        """
+        SHA-256 of a file. Digests are remembered in the manifest for as long as the size and mtime of the file
+        do not change, so large inputs are only read once.
+
+        :param path: (str) path to the file
+        :return: (str) hex digest
+        """
+        real = os.path.realpath(path)
+        st = os.stat(real)
+        with self.manifest() as manifest:
+            known = manifest["digests"].get(real)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+
+        sha = hashlib.sha256()
+        with open(real, "rb") as ftr:
+            for block in iter(lambda: ftr.read(DIGEST_BUFFER), b""):
+                sha.update(block)
+        with self.manifest() as manifest:
+            manifest["digests"][real] = [st.st_size, st.st_mtime_ns, sha.hexdigest()]
+        return sha.hexdigest()
+
+    def key(self, stage, tool, argv, inputs):
+        """
+        :param stage: (str) name of the stage
+        :param tool: (str) executable of the stage
+        :param argv: list, arguments of the stage. Input paths are replaced by their digests.
+        :param inputs: list of input file paths (None entries are ignored)
+        :return: (str) cache key
+        """
+        digests = {i: self.digest(i) for i in inputs if i}
+        description = [stage, ResultCache.tool_identity(tool), [digests.get(a, a) for a in map(str, argv)],
+                       sorted(digests.values())]
+        return hashlib.sha256(json.dumps(description).encode()).hexdigest()
+
+    @staticmethod
+    def _link_or_copy(source, destination):
+        if os.path.isdir(source):
+            shutil.copytree(source, destination, copy_function=ResultCache._link_or_copy)
+            return
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
+    @staticmethod
+    def _size(path):
+        if os.path.isdir(path):
+            return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+        return os.path.getsize(path)
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def fetch(self, key, outputs):
+        """
+        Restores the outputs of a cached stage, replacing whatever is at the output paths.
+
+        :param key: (str) cache key
+        :param outputs: list of output paths (files or directories), in the order they were stored
+        :return: (bool) True if the stage was cached and its outputs were restored
+        """
+        # the outputs are linked under the lock, so another process can not evict the entry halfway through
+        with self.manifest() as manifest:
+            entry = manifest["entries"].get(key)
+            if entry is None or len(entry["outputs"]) != len(outputs):
+                return False
+            try:
+                for i, output in enumerate(outputs):
+                    ResultCache._remove(output)
+                    ResultCache._link_or_copy(os.path.join(self.objects, key, str(i)), output)
+            except FileNotFoundError:
+                # the objects of the entry are gone (removed by hand): a cache miss
+                for output in outputs:
+                    ResultCache._remove(output)
+                del manifest["entries"][key]
+                return False
+            entry["last_used"] = time.time()
+        return True
+
+    def store(self, key, outputs):
+        """
+        Adds the outputs of a stage that just ran to the cache, then evicts the least recently used entries if the
+        cache is over its size limit. Missing outputs mean the stage failed, nothing is stored then.
+
+        :param key: (str) cache key
+        :param outputs: list of output paths (files or directories)
+        :return: (bool) True if the outputs were stored
+        """
+        if not all(os.path.exists(o) for o in outputs):
+            return False
+        staging = os.path.join(self.objects, "{}.tmp{}".format(key, os.getpid()))
+        ResultCache._remove(staging)
+        os.mkdir(staging)
+        for i, output in enumerate(outputs):
+            ResultCache._link_or_copy(output, os.path.join(staging, str(i)))
+        size = ResultCache._size(staging)
+
+        with self.manifest() as manifest:
+            ResultCache._remove(os.path.join(self.objects, key))
+            os.rename(staging, os.path.join(self.objects, key))
+            manifest["entries"][key] = {"outputs": [os.path.abspath(o) for o in outputs], "size": size,
+                                        "last_used": time.time()}
+            self._evict(manifest, keep=key)
+        return True
+
+    def _evict(self, manifest, keep=None):
+        if self.max_size is None:
+            return
+        entries = manifest["entries"]
+        total = sum(e["size"] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]["size"]
+            ResultCache._remove(os.path.join(self.objects, key))
+            del entries[key]
+
+
+def cached(cache, stage, tool, argv, inputs, outputs, action):
+    """
+    Runs action, unless the cache already holds the outputs of the same stage, in which case they are restored.
+
+    :param cache: ResultCache, or None to always run the action
+    :param stage: (str) name of the stage
+    :param tool: (str) executable of the stage
+    :param argv: list, arguments that define the result of the stage
+    :param inputs: list of input file paths
+    :param outputs: list of output paths (files or directories) produced by action
+    :param action: callable with no arguments running the stage
+    :return: (bool) True if the outputs came from the cache
+    """
+    if cache is None:
+        action()
+        return False
+    key = cache.key(stage, tool, argv, inputs)
+    if cache.fetch(key, outputs):
+        print("{}: reusing cached outputs {}".format(stage, ", ".join(outputs)))
+        return True
+    # stale outputs of an earlier, interrupted run may be hard links into the cache: never write through them
+    for output in outputs:
+        ResultCache._remove(output)
+    action()
+    cache.store(key, outputs)
+    return False
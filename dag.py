@@ -0,0 +1,139 @@
+import subprocess
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import telemetry
+
+
+class Task:
+    """
+    One stage of one sample: runs once all the tasks it depends on succeeded.
+    """
+
+    def __init__(self, sample, stage, action, after=()):
+        """
+        :param sample: (str) sample name
+        :param stage: (str) stage name, the key of the concurrency limits
+        :param action: callable with no arguments
+        :param after: tasks that must succeed first
+        """
+        self.sample = sample
+        self.stage = stage
+        self.action = action
+        self.after = list(after)
+        self.waiting = len(self.after)
+        self.next = []
+        self.state = "waiting"  # waiting, running, done, failed or skipped
+        self.error = None
+
+
+class StageGraph:
+    """
+    Runs a dependency graph of per-sample stages. A sample moves to its next stage as soon as the previous one is
+    done, without waiting for the other samples, and each stage has its own concurrency limit, so e.g. filtering,
+    assembly and polishing all run at the same time on different samples. A failing task skips the stages that depend
+    on it, the other samples go on. Tasks can be added while the graph is running.
+    """
+
+    def __init__(self, limits, default=1):
+        """
+        :param limits: dictionary {stage: number of tasks of that stage running at the same time}
+        :param default: (int) limit of the stages missing from limits
+        """
+        self.limits = dict(limits)
+        self.default = default
+        self.pools = {}  # one pool per stage, so tasks waiting for a stage never hold up the other stages
+        self.tasks = []
+        self.condition = threading.Condition()
+        self.pending = 0
+
+    def _submit(self, task):
+        # called with self.condition held
+        if task.stage not in self.pools:
+            workers = max(1, int(self.limits.get(task.stage, self.default)))
+            self.pools[task.stage] = ThreadPoolExecutor(max_workers=workers)
+        self.pools[task.stage].submit(self._run, task)
+
+    def add(self, sample, stage, action, after=()):
+        """
+        :return: Task, to be given as a dependency of the next stages
+        """
+        task = Task(sample, stage, action, after)
+        with self.condition:
+            self.tasks.append(task)
+            self.pending += 1
+            for t in task.after:
+                if t.state == "done":
+                    task.waiting -= 1
+                elif t.state in ("failed", "skipped"):
+                    task.state = "skipped"
+                else:
+                    t.next.append(task)
+            if task.state == "skipped":
+                self._finish(task)
+            elif task.waiting == 0:
+                self._submit(task)
+        return task
+
+    def _run(self, task):
+        task.state = "running"
+        print("{}: {} started.".format(task.sample, task.stage))
+        try:
+            with telemetry.context(sample=task.sample):
+                task.action()
+            task.state = "done"
+        except subprocess.CalledProcessError as e:
+            task.state = "failed"
+            task.error = "{} exited with status {}".format(" ".join(map(str, e.cmd[:2])), e.returncode)
+        except Exception as e:
+            task.state = "failed"
+            task.error = "{}: {}".format(type(e).__name__, e)
+            traceback.print_exc()
+        print("{}: {} {}.".format(task.sample, task.stage, task.state))
+        with self.condition:
+            self._finish(task)
+
+    def _finish(self, task):
+        # called with self.condition held
+        for t in task.next:
+            if task.state == "done":
+                t.waiting -= 1
+                if t.waiting == 0 and t.state == "waiting":
+                    self._submit(t)
+            elif t.state == "waiting":
+                t.state = "skipped"
+                self._finish(t)
+        self.pending -= 1
+        self.condition.notify_all()
+
+    def wait(self):
+        """
+        Blocks until every task added so far ran, failed or was skipped.
+
+        :return: None
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+        for pool in self.pools.values():
+            pool.shutdown()
+
+    def summary(self):
+        """
+        Prints how many samples went through every stage, and the stages that failed or were skipped.
+
+        :return: (int) number of failed samples
+        """
+        samples = {}
+        for t in self.tasks:
+            samples.setdefault(t.sample, []).append(t)
+        failed = 0
+        for name in sorted(samples):
+            bad = [t for t in samples[name] if t.state != "done"]
+            if not bad:
+                continue
+            failed += 1
+            for t in bad:
+                print("  {} {}: {}{}".format(name, t.stage, t.state, ", {}".format(t.error) if t.error else ""))
+        print("{} of {} samples completed successfully.".format(len(samples) - failed, len(samples)))
+        return failed
@@ -0,0 +1,205 @@
+import json
+import os
+import re
+
+# Sample name of read files: the start of the name, up to the first "_" or "." (S1_L001_R1_001.fastq.gz -> S1).
+SAMPLE_PATTERN = r"(?P<sample>[^_.]+)"
+# Prefixes of the files and directories written by the pipeline (filtered_S1, adapter_removed_S1, pass_S1...).
+OUTPUT_PREFIXES = ("filtered", "adapter_removed", "assembly", "pass", "fail")
+# Sample name of the files and directories written by the pipeline: a prefix, then the name of the read files.
+OUTPUT_PATTERN = r"(?:{})_{}"
+# Prefixes of the outputs filtering writes next to the long reads.
+FILTERING_OUTPUTS = ("filtered_", "adapter_removed_")
+# Extensions of long read files.
+READ_EXTENSIONS = (".fastq", ".fq")
+# Read number of paired short reads, as its own field of the name (_R1_, _R2.).
+READ_PATTERN = r"(?:^|[_.])R(?P<read>[12])(?=[_.]|$)"
+
+
+class SampleTable:
+    """
+    Finds the files of every sample in one pass over each directory. Directories are listed once with os.scandir,
+    and names are parsed with exact patterns, so S1 never picks up the reads of S10. Listings are kept in a JSON
+    cache file with the directory mtimes, so the next step (filtering, assembly, polishing) only lists directories
+    that changed since.
+
+    Each sample is a dictionary with the keys longread, r1, r2, dir, fasta, fastq, assembly, assembler and polished,
+    None when not found.
+    """
+    FIELDS = ("longread", "r1", "r2", "dir", "fasta", "fastq", "assembly", "assembler", "polished")
+
+    def __init__(self, pattern=None, cache=None):
+        """
+        :param pattern: (str) regular expression matched at the start of the read file names, with a named group
+            sample (and optionally read, 1 or 2). Defaults to SAMPLE_PATTERN.
+        :param cache: (str) path of the JSON file keeping the directory listings and the table
+        """
+        self.pattern = re.compile(pattern if pattern else SAMPLE_PATTERN)
+        # outputs are named after the sample, so they are parsed with the same pattern
+        self.output_pattern = re.compile(OUTPUT_PATTERN.format("|".join(OUTPUT_PREFIXES), self.pattern.pattern))
+        self.read_pattern = re.compile(READ_PATTERN)
+        self.cache = cache
+        self.listings = {}
+        if cache and os.path.isfile(cache):
+            with open(cache) as ftr:
+                self.listings = json.load(ftr).get("listings", {})
+        self.samples = {}
+
+    def listing(self, directory):
+        """
+        :param directory: (str) path to a directory
+        :return: tuple (sorted file names, sorted directory names), empty if the directory does not exist
+        """
+        path = os.path.abspath(directory)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return [], []
+        cached = self.listings.get(path)
+        if cached is None or cached["mtime"] != mtime:
+            files, dirs = [], []
+            with os.scandir(path) as entries:
+                for e in entries:
+                    (dirs if e.is_dir() else files).append(e.name)
+            cached = {"mtime": mtime, "files": sorted(files), "dirs": sorted(dirs)}
+            self.listings[path] = cached
+        return cached["files"], cached["dirs"]
+
+    def sample_name(self, name, output=False):
+        """
+        :param name: (str) file or directory name
+        :param output: (bool) the name was written by the pipeline (OUTPUT_PATTERN) rather than being a read file
+        :return: (str) sample name, None if the name does not match
+        """
+        match = (self.output_pattern if output else self.pattern).match(name)
+        return match.group("sample") if match else None
+
+    def read_number(self, name):
+        """
+        :param name: (str) short read file name
+        :return: (int) 1 or 2, None if the name does not say
+        """
+        match = self.pattern.match(name)
+        if match and match.groupdict().get("read"):
+            return int(match.group("read"))
+        match = self.read_pattern.search(name)
+        return int(match.group("read")) if match else None
+
+    def sample(self, name):
+        """
+        :return: dictionary of the sample, created if needed
+        """
+        if name not in self.samples:
+            self.samples[name] = dict.fromkeys(SampleTable.FIELDS)
+        return self.samples[name]
+
+    def _set(self, name, field, path):
+        entry = self.sample(name)
+        if entry[field] is not None and entry[field] != path:
+            print("{}: both {} and {} match, keeping the first one.".format(name, entry[field], path))
+            return
+        entry[field] = path
+
+    def add_short_reads(self, directory):
+        """
+        Adds the R1 and R2 fastq files found in directory.
+
+        :return: SampleTable
+        """
+        files, _ = self.listing(directory)
+        for f in files:
+            name, read = self.sample_name(f), self.read_number(f)
+            if name and read:
+                self._set(name, "r{}".format(read), os.path.join(directory, f))
+        return self
+
+    def add_long_reads(self, directory):
+        """
+        Adds the long read files found directly in directory, one per sample. Only fastq(.gz) files are read files,
+        and the outputs filtering writes next to them (filtered_S1, adapter_removed_S1) are not. Concatenated guppy
+        outputs (pass_S1.fastq.gz) are named after their sample.
+
+        :return: SampleTable
+        """
+        files, _ = self.listing(directory)
+        for f in files:
+            if not any(e in f for e in READ_EXTENSIONS) or f.startswith(FILTERING_OUTPUTS):
+                continue
+            name = self.sample_name(f, output=True) or self.sample_name(f)
+            if name:
+                self._set(name, "longread", os.path.join(directory, f))
+        return self
+
+    def add_sample_dirs(self, directory):
+        """
+        Adds the per-sample directories of the previous steps (<sample>/ or <prefix>_<sample>/): their long reads
+        (<prefix>_<sample>.fastq.gz), the fasta made for shasta, the assembly and the latest polished assembly.
+
+        :return: SampleTable
+        """
+        _, dirs = self.listing(directory)
+        for sd in dirs:
+            location = os.path.join(directory, sd)
+            files, contents = self.listing(location)
+            name = self.sample_name(sd, output=True) or self.sample_name(sd)
+            if name is None:
+                continue
+            entry = self.sample(name)
+            entry["dir"] = location
+            for f in files:
+                path = os.path.join(location, f)
+                if self.sample_name(f, output=True) != name:
+                    continue  # files written by the tools (skesa.fasta...)
+                if ".fasta" in f and entry["fasta"] is None:
+                    entry["fasta"] = path
+                elif (".fastq" in f or ".fq" in f) and entry["fastq"] is None:
+                    entry["fastq"] = entry["longread"] = path
+            entry["assembler"], entry["assembly"] = self.assembly(location, contents)
+            entry["polished"] = self.polished(location, contents)
+        return self
+
+    def assembly(self, location, contents):
+        """
+        :param location: (str) directory of a sample
+        :param contents: list of its subdirectories
+        :return: tuple (assembler, path of the assembly), (None, None) if there is none
+        """
+        files, _ = self.listing(location)
+        if "spades" in contents:
+            kmers = [int(d.split("K")[-1]) for d in self.listing(os.path.join(location, "spades"))[1]
+                     if re.fullmatch(r"K\d+", d)]
+            if kmers:
+                return "spades", os.path.join(location, "spades", "K{}".format(max(kmers)), "final_contigs.fasta")
+        if "medaka_consensus" in contents:
+            return "medaka", os.path.join(location, "medaka_consensus", "consensus.fasta")
+        if "ShastaRun" in contents:
+            return "shasta", os.path.join(location, "ShastaRun", "Assembly.fasta")
+        if "skesa" in contents or "skesa.fasta" in files:
+            return "skesa", os.path.join(location, "skesa.fasta")
+        return None, None
+
+    def polished(self, location, contents):
+        """
+        :return: (str) path of the last pilon round of the sample, None if it was not polished with pilon
+        """
+        if "pilon" not in contents:
+            return None
+        rounds = []
+        for f in self.listing(os.path.join(location, "pilon"))[0]:
+            match = re.fullmatch(r".+_polished_(\d+)\.fasta", f)
+            if match:
+                rounds.append((int(match.group(1)), f))
+        return os.path.join(location, "pilon", max(rounds)[1]) if rounds else None
+
+    def save(self):
+        """
+        Writes the listings and the table to the cache file, if there is one.
+
+        :return: None
+        """
+        if not self.cache:
+            return
+        tmp = "{}.{}.tmp".format(self.cache, os.getpid())  # several processes (queue workers) may share the cache
+        with open(tmp, "w") as ftw:
+            json.dump({"listings": self.listings, "samples": self.samples}, ftw, indent=1, sort_keys=True)
+        os.replace(tmp, self.cache)
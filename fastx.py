@@ -0,0 +1,132 @@
+import gzip
+import shutil
+
+# Size of the decompressed blocks pulled from a reads file in one read() call.
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def open_reads(path, mode="rb"):
+    """
+    Opens a fastq/fasta file, transparently handling gzip compression based on the file extension, or, for files
+    without one (filtered_<sample>), on the gzip magic number.
+
+    :param path: (str) path to the reads file
+    :param mode: (str) mode the file will be opened with
+    :return: file object
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    if "r" in mode and "." not in path.split("/")[-1]:
+        with open(path, "rb") as ftr:
+            if ftr.read(2) == b"\x1f\x8b":
+                return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def fastq_blocks(path, block_size=BLOCK_SIZE):
+    """
+    Reads a fastq(.gz) file in large decompressed blocks, and yields the lines belonging to complete records only.
+    Lines are never decoded, and any incomplete record at the end of a block is carried over to the next one.
+
+    :param path: (str) path to the fastq or fastq.gz file
+    :param block_size: (int) number of decompressed bytes to read at a time
+    :return: generator of lists of lines (bytes, without newlines). Each list length is a multiple of 4.
+    """
+    leftover = b""
+    with open_reads(path) as ftr:
+        while True:
+            block = ftr.read(block_size)
+            if not block:
+                break
+            lines = (leftover + block).split(b"\n")
+            leftover = lines.pop()  # partial line, or b"" if the block ended on a newline
+            complete = len(lines) - len(lines) % 4
+            if complete:
+                if not lines[0].startswith(b"@"):
+                    raise ValueError("{} does not look like a fastq file (record starts with {!r})".format(
+                        path, lines[0][:20]))
+                yield lines[:complete]
+            if complete != len(lines):
+                leftover = b"\n".join(lines[complete:] + [leftover])
+
+    if leftover.strip():
+        lines = leftover.rstrip(b"\n").split(b"\n")
+        if len(lines) % 4 != 0:
+            raise ValueError("{} ends with a truncated fastq record".format(path))
+        yield lines
+
+
+def fastq_to_fasta_block(lines):
+    """
+    Converts the lines of complete fastq records into fasta formatted bytes. Only the leading '@' of each header
+    is replaced, the rest of the header is kept as is.
+
+    :param lines: list of fastq lines, as produced by fastq_blocks
+    :return: bytes
+    """
+    out = [None] * (len(lines) // 2)
+    out[0::2] = [b">" + h[1:] for h in lines[0::4]]
+    out[1::2] = lines[1::4]
+    out.append(b"")
+    return b"\n".join(out)
+
+
+def fastq_to_fasta(input_path, output, block_size=BLOCK_SIZE):
+    """
+    Streams a fastq(.gz) file into a fasta file object, one block at a time.
+
+    :param input_path: (str) path to the fastq or fastq.gz file
+    :param output: binary file object the fasta records are written to
+    :param block_size: (int) number of decompressed bytes to read at a time
+    :return: (int) number of records written
+    """
+    records = 0
+    for lines in fastq_blocks(input_path, block_size):
+        output.write(fastq_to_fasta_block(lines))
+        records += len(lines) // 4
+    return records
+
+
+def to_fasta(input_path, output, block_size=BLOCK_SIZE):
+    """
+    Streams reads into a fasta file object. Fastq(.gz) files are converted, fasta(.gz) files are only decompressed.
+
+    :param input_path: (str) path to the fastq(.gz) or fasta(.gz) file
+    :param output: binary file object the fasta records are written to
+    :param block_size: (int) number of decompressed bytes to read at a time
+    :return: None
+    """
+    name = input_path.split("/")[-1]
+    if ".fasta" in name or ".fa." in name or name.endswith(".fa"):
+        with open_reads(input_path) as ftr:
+            shutil.copyfileobj(ftr, output, block_size)
+    else:
+        fastq_to_fasta(input_path, output, block_size)
+
+
+def read_fasta(path):
+    """
+    :param path: (str) path to a fasta(.gz) file
+    :return: list of tuples (name, sequence), the name being the first word of the header, as str
+    """
+    records = []
+    with open_reads(path) as ftr:
+        for record in ftr.read().split(b">")[1:]:
+            header, _, seq = record.partition(b"\n")
+            records.append((header.split(None, 1)[0].decode() if header.strip() else "",
+                            seq.replace(b"\n", b"").replace(b"\r", b"").decode()))
+    return records
+
+
+def write_fasta(records, path, width=80):
+    """
+    :param records: iterable of tuples (name, sequence)
+    :param path: (str) path of the fasta file to write
+    :param width: (int) line length of the sequences
+    :return: None
+    """
+    with open(path, "w", buffering=BLOCK_SIZE) as ftw:
+        for name, seq in records:
+            ftw.write(">{}\n".format(name))
+            for i in range(0, len(seq), width):
+                ftw.write(seq[i:i + width] + "\n")
@@ -1,11 +1,25 @@
-import subprocess
 import os
+import shutil
+import subprocess
+
+import minhash
+import staging
+import telemetry
+import trimmer
+from cache import ResultCache, cached
+from readstats import ReadStats
+from readfilter import ReadFilter
+from pipeline import Pipeline
+from readindex import ReadIndex
+from bgzf import BgzfWriter
+from discovery import SampleTable
 
 
 class FilteringInput:
     """
     Creates samples based of off input directories
     """
+    AUTO_COVERAGE = 150  # coverage kept by the automatic minimum length, before filtlong's own 100x target
 
     def __init__(self, args):
         self.samples = {}  # A dictionary of samples
@@ -31,59 +45,46 @@ class FilteringInput:
         else:
             self.minlen = None
 
+        if args.cache:  # Directory where the results of previous runs are kept
+            self.cache = ResultCache(args.cache, args.cache_size)
+        else:
+            self.cache = None
+
+        # Files of each sample, found in one scan of the input directories
+        self.table = SampleTable(args.sample_pattern, args.sample_cache)
+
     def samples_sorting(self):
         """
         Using the pathfiles for the longread directory, the shortread directory, or both, initiates a Sample class
         object, and updates parameters. All samples are stored in a dictionary as values, with the corresponding
-        key being their sample name
+        key being their sample name. Files are matched to samples by exact name, through the SampleTable.
         :return: Dict {Sample Name: <Sample Object>}
         """
 
-        if self.londir and self.shortdir:
-            # Filtering will only be done with short reads that match samples for long reads
-            longdir = [f for f in os.listdir(self.londir) if os.path.isfile("{}/{}".format(self.londir, f))]
-            shortdir = [f for f in os.listdir(self.shortdir) if os.path.isfile("{}/{}".format(self.shortdir,
-                                                                                              f))]
-
-            # if '/' not in the end of the shortdir, add it!
-            samples_long = list(set(map(lambda x: x.split("_")[0], longdir)))
-            for f in samples_long:
-                self.samples[f] = FilteringSample(f)
-                self.samples[f].minlen = self.minlen
-                for r in shortdir:
-                    if f in r and "R1" in r:
-                        self.samples[f].sr1 = "{}/{}".format(self.shortdir, r)
-                    if f in r and "R2" in r:
-                        self.samples[f].sr2 = "{}/{}".format(self.shortdir, r)
-
-                for r in longdir:
-                    if f in r:
-                        self.samples[f].longread = "{}/{}".format(self.londir, r)
-                        # add minlen
-
-        elif self.londir:
-
-            longdir = [f for f in os.listdir(self.londir) if os.path.isfile("{}/{}".format(self.londir, f))]
-            # if '/' not in the end of the shortdir, add it!
-            for f in longdir:
-                name = f.split("/")[-1].split("_")[0]
-                self.samples[name] = FilteringSample(name)
-                self.samples[name].longread = "{}/{}".format(self.londir, f)
-                self.samples[name].minlen = self.minlen
-
-        elif self.shortdir:
-            shortdir = [f for f in os.listdir(self.shortdir) if os.path.isfile("{}{}".format(self.shortdir, f))]
-            # if '/' not in the end of the shortdir, add it!
-
-            names = set(map(lambda x: x.split("_")[0], shortdir))
-            for n in names:
-                self.samples[n] = FilteringSample(n)
-                for r in shortdir:
-                    if "R1" in r and n in r:
-                        self.samples[n].sr1 = "{}/{}".format(self.shortdir, r)
-                    elif "R2" in r and n in r:
-
-                        self.samples[n].sr2 = "{}/{}".format(self.shortdir, r)
+        table = self.table
+        if self.londir:
+            table.add_long_reads(self.londir)
+        if self.shortdir:
+            table.add_short_reads(self.shortdir)
+        if self.londir and self.shortdir and getattr(self.args, "check_pairs", None):
+            # pairing by name is checked against the k-mer content of the reads
+            minhash.check_pairs(table.samples, self.args.check_pairs, minhash.SketchCache(self.args.sketch_cache))
+        table.save()
+
+        selected = getattr(self.args, "samples", None)  # -samples, used by the work queue to run one sample
+        for name, entry in sorted(table.samples.items()):
+            if selected and name not in selected:
+                continue
+            if self.londir and not entry["longread"]:
+                continue  # Filtering will only be done with short reads that match samples for long reads
+            if not self.londir and not (entry["r1"] and entry["r2"]):
+                continue
+            self.samples[name] = FilteringSample(name)
+            self.samples[name].longread = entry["longread"]
+            self.samples[name].minlen = self.minlen
+            if self.shortdir:
+                self.samples[name].sr1 = entry["r1"]
+                self.samples[name].sr2 = entry["r2"]
 
         return self.samples
 
@@ -93,27 +94,59 @@ class FilteringInput:
         :return: None
         """
         dictionary = self.samples_sorting()
+        for v in dictionary.values():
+            v.cache = self.cache
+            v.engine = self.args.engine
+            v.trimmer = self.args.trimmer
+        if self.args.auto:
+            self.auto_parameters(dictionary)
 
         if self.shortdir and self.londir:
             for v in dictionary.values():
-                if self.shortdir:
-                    # Filter long reads with trimmed short reads as external reference
-                    v.genomesize = self.genomesize
-                    v.bbduk()
-                    v.filtlong()
-                else:
-                    # Filter long reads without the external reference
-                    v.genomesize = self.genomesize
-                    v.filtlong()
+                with telemetry.context(sample=v.name):
+                    if self.shortdir:
+                        # Filter long reads with trimmed short reads as external reference
+                        v.genomesize = self.genomesize
+                        v.bbduk()
+                        v.filtlong()
+                    else:
+                        # Filter long reads without the external reference
+                        v.genomesize = self.genomesize
+                        v.filtlong()
 
         elif self.shortdir:
             for v in dictionary.values():
-                v.bbduk()
+                with telemetry.context(sample=v.name):
+                    v.bbduk()
 
         elif self.londir:
             for v in dictionary.values():
                 v.genomesize = self.genomesize
-                v.filtlong()
+                with telemetry.context(sample=v.name):
+                    v.filtlong()
+
+
+    def auto_parameters(self, dictionary):
+        """
+        Computes the statistics of every long read file, and sets the filtlong minimum length of the samples that
+        were not given one: the longest cut-off that still leaves FilteringInput.AUTO_COVERAGE fold coverage.
+        Requires the genome size.
+
+        :param dictionary: Dict {Sample Name: <Sample Object>}
+        :return: None
+        """
+        paths = [v.longread for v in dictionary.values() if v.longread]
+        stats = ReadStats.from_files(paths)
+        for name, v in dictionary.items():
+            if not v.longread:
+                continue
+            print(name)
+            stats[v.longread].report(self.genomesize)
+            if not self.genomesize:
+                print("No genome size given, the minimum length can't be chosen automatically.\n")
+            elif not v.minlen:
+                v.minlen = str(stats[v.longread].suggest_min_length(self.genomesize, FilteringInput.AUTO_COVERAGE))
+                print("Filtlong minimum length set to {}.\n".format(v.minlen))
 
 
 class FilteringSample:
@@ -129,16 +162,61 @@ class FilteringSample:
         self.genomesize = None
         self.minlen = None
         self.chop = None
+        self.cache = None  # cache.ResultCache, to skip porechop/filtlong when they already ran on the same input
+        self.engine = "filtlong"  # filtlong, or native for the in-process readfilter.ReadFilter
+        self.trimmer = "porechop"  # porechop, or native for the in-process trimmer.Trimmer
+
+    def chop_command(self, reads=None, chop=None):
+        """
+        Sets self.chop, the adapter trimmed reads filtlong runs on.
+
+        :param reads: (str) reads to trim, defaults to self.longread
+        :param chop: (str) path of the trimmed reads, defaults to self.chop
+        :return: list, the trimming command
+        """
+        output_dir = '/'.join(self.longread.split('/')[:-1])
+        if self.trimmer == "native":
+            # filtlong reads its input twice, so it still gets a file, compressed in-process
+            self.chop = "{}/adapter_removed_{}.fastq.gz".format(output_dir, self.name)
+            return ["native_trim", reads if reads else self.longread, chop if chop else self.chop]
+        self.chop = "{}/adapter_removed_{}".format(output_dir, self.name)
+        return ["porechop", "-i", reads if reads else self.longread, "-o", chop if chop else self.chop]
 
-    def filtlong(self):
+    def trim_part(self, part, append=True):
+        """
+        Trims the adapters of part, some of the reads of self.longread, and appends them to self.chop. Used in watch
+        mode to trim a barcode piece by piece while guppy is still basecalling it; filtlong(trimmed=True) then filters
+        the whole of self.chop.
+
+        :param part: (str) fastq(.gz) with the reads appended to self.longread since the previous part
+        :param append: (bool) False for the first part, which replaces an older self.chop
+        :return: None
+        """
+        self.chop_command()  # sets self.chop
+        trimmed = "{}.part".format(self.chop)
+        try:
+            if self.trimmer == "native":
+                trimmer.Trimmer().write(part, trimmed)
+            else:
+                telemetry.run(self.chop_command(part, trimmed), check=True)
+            with open(self.chop, "ab" if append else "wb") as ftw, open(trimmed, "rb") as ftr:
+                shutil.copyfileobj(ftr, ftw, 16 * 1024 * 1024)
+        finally:
+            if os.path.exists(trimmed):
+                os.remove(trimmed)
+
+    def filtlong(self, trimmed=False):
         """
         Results in the filtering of longreads in the path, self.longread, and it can be with external references
-        or not. Writes a fastq.gz file.
+        or not. Writes a fastq.gz file. If the same reads were already filtered with the same arguments, the
+        outputs are taken from the cache. With the native trimmer and the native engine, the trimmed reads are
+        streamed into the filter without an intermediate file.
+
+        :param trimmed: (bool) self.chop already holds the adapter trimmed reads (see trim_part), only filter them
         :return: None
         """
         output_dir = '/'.join(self.longread.split('/')[:-1])
-        self.chop = "{}/adapter_removed_{}".format(output_dir, self.name)
-        cmd_chop = ["porechop", "-i", self.longread, "-o", self.chop]
+        cmd_chop = self.chop_command()
         filter_cmd = ["filtlong",
                       "--min_length", self.minlen,
                       "--keep_percent", "90"]
@@ -148,15 +226,77 @@ class FilteringSample:
         if self.genomesize:
             filter_cmd.extend(["--target_bases", str(int(self.genomesize) * 100)])
         filter_cmd.append(self.chop)
-
-        subprocess.run(cmd_chop)
-        filt = subprocess.Popen(filter_cmd, stdout=subprocess.PIPE)
-        gz = subprocess.Popen(["gzip"], stdin=filt.stdout,
-                              stdout=subprocess.PIPE)
-        output = gz.communicate()[0]
-        with open("{}/filtered_{}".format(output_dir, self.name), 'wb') as f:
-            f.write(output)
-
+        filtered = "{}/filtered_{}".format(output_dir, self.name)
+        # with a scratch directory, the adapter trimmed reads are only written there (uncompressed, up to about 4 times
+        # the size of the reads), and filtlong reads them from there
+        need = 4 * os.path.getsize(self.longread)
+        outputs = [filtered] if staging.ROOT else [self.chop, filtered]
+        # the trimmer is part of the result too: a new porechop (or native trimmer) version filters again
+        trim_tool = trimmer.__file__ if self.trimmer == "native" else "porechop"
+
+        if self.engine == "native":
+            if self.sr1 and self.sr2:
+                print("{}: the native engine does not use short reads as a reference, they are ignored.".format(
+                    self.name))
+            target = int(self.genomesize) * 100 if self.genomesize else None
+            native = ReadFilter(self.minlen, 90, target)
+
+            if self.trimmer == "native" and not trimmed:
+                # the trimmer module stands for the tool: changing the adapters or thresholds invalidates the cache
+                cached(self.cache, "native_filter", trimmer.__file__,
+                       ["native_trim", "native", self.minlen, 90, target], [self.longread], [filtered],
+                       lambda: native.run(self.longread, filtered, trimmer.Trimmer()))
+                return
+
+            def run():
+                with staging.staged("porechop", need=need) as area:
+                    if not trimmed:
+                        telemetry.run([area.path(c) if c == self.chop else c for c in cmd_chop], check=True)
+                    native.run(self.chop if trimmed else area.path(self.chop), filtered)
+
+            cached(self.cache, "native_filter", trim_tool, cmd_chop + ["native", self.minlen, 90, target],
+                   [self.longread], outputs, run)
+            return
+
+        def run():
+            with staging.staged("filtlong", need=need) as area:
+                chop = self.chop if trimmed else area.path(self.chop)
+                if not trimmed and self.trimmer == "native":
+                    trimmer.Trimmer().write(self.longread, chop)
+                elif not trimmed:
+                    telemetry.run([chop if c == self.chop else c for c in cmd_chop], check=True)
+                # filtlong's stdout is compressed in-process on all cores and streamed to disk
+                command = [chop if c == self.chop else c for c in filter_cmd]
+                filt = Pipeline([command], output=filtered, compress=True)
+                returncode = filt.run()
+                filt.report()
+                if returncode != 0:
+                    os.remove(filtered)  # a valid but truncated gzip, that must not pass for the filtered reads
+                    raise subprocess.CalledProcessError(returncode, command)
+
+        cached(self.cache, "filtlong", "filtlong", cmd_chop + filter_cmd + ResultCache.tool_identity(trim_tool),
+               [self.longread, self.sr1, self.sr2], outputs, run)
+
+
+    def subsample(self, count, output=None, seed=None, read_ids=None):
+        """
+        Writes a subset of the long reads, random or chosen by ID, pulled through the read index of self.longread
+        (built on first use) rather than by decompressing the whole file.
+
+        :param count: (int) number of random reads, ignored if read_ids is given
+        :param output: (str) path of the fastq.gz to write, defaults to subsample_<name>.fastq.gz next to the reads
+        :param seed: (int) seed for the random subset
+        :param read_ids: list of read IDs to extract
+        :return: (str) path of the written file
+        """
+        if output is None:
+            output = "{}/subsample_{}.fastq.gz".format('/'.join(self.longread.split('/')[:-1]), self.name)
+        index = ReadIndex.open(self.longread)
+        records = index.fetch(read_ids) if read_ids is not None else index.sample(count, seed)
+        with BgzfWriter(output) as ftw:
+            for record in records:
+                ftw.write(record)
+        return output
 
     def bbduk(self):
         """
@@ -178,5 +318,5 @@ class FilteringSample:
         self.sr1 = "{}/trimmed_reads/trimmed_{}".format(out_path, sr1_name)  # Not sure if there is an issue with directories?
         self.sr2 = "{}/trimmed_reads/trimmed_{}".format(out_path, sr2_name)  # Not sure if there is an issue with directories?
 
-        subprocess.run(cmd)
+        telemetry.run(cmd, stage="bbduk", check=True)
 
@@ -0,0 +1,264 @@
+import json
+import os
+
+import numpy as np
+
+import fastx
+from trimmer import CODES
+
+# k-mer length of the sketches: 21 bp k-mers are specific to a genome, and fit in 42 bits.
+K = 21
+# Number of hashes kept per sketch.
+SKETCH_SIZE = 2000
+# Bases read from the start of each file: enough for the genomic k-mers to be seen more than once.
+PREFIX_BASES = 50 * 1000 ** 2
+# Copies a k-mer needs in the prefix to be kept, so that k-mers made by sequencing errors are left out.
+MIN_COPIES = 2
+# A best match replaces the pairing by name only if its similarity is this many times higher.
+MARGIN = 1.5
+
+
+def mix(values):
+    """
+    64 bit finalizer of MurmurHash3, applied to a whole array: spreads the k-mer codes over the full 64 bit range.
+
+    :param values: numpy uint64 array
+    :return: numpy uint64 array of hashes
+    """
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+def kmer_hashes(seqs, k=K):
+    """
+    Hashes the canonical k-mers of a batch of reads at once: the reads are concatenated and encoded as one array,
+    and the k-mers containing an N or spanning two reads are dropped.
+
+    :param seqs: list of sequences (bytes)
+    :param k: (int) k-mer length, at most 32
+    :return: numpy uint64 array of the hashes of the k-mers
+    """
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    codes = CODES[np.frombuffer(b"".join(seqs), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    bases = (codes & 3).astype(np.uint64)
+    complements = (np.uint64(3) - bases) << np.uint64(2 * (k - 1))
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        np.left_shift(forward, np.uint64(2), out=forward)
+        np.bitwise_or(forward, bases[j:j + n], out=forward)
+        np.right_shift(reverse, np.uint64(2), out=reverse)
+        np.bitwise_or(reverse, complements[j:j + n], out=reverse)
+    ambiguous = np.concatenate(([0], np.cumsum(codes == 4)))
+    invalid = ambiguous[k:] > ambiguous[:n]
+    ends = np.cumsum(lengths)
+    spanning = ends[:-1, None] - np.arange(1, k)[None, :]  # k-mers starting in the last k - 1 bases of a read
+    invalid[spanning[(spanning >= 0) & (spanning < n)]] = True
+    return mix(np.minimum(forward, reverse)[~invalid])
+
+
+class Sketch:
+    """
+    Bottom-k MinHash sketch of a read set. The smallest distinct hashes are kept with their number of copies, a few
+    times more of them than the sketch size, so that the sketch can leave out the k-mers seen only once (sequencing
+    errors) and sketches of several files (R1 and R2) can be merged.
+    """
+
+    def __init__(self, size=SKETCH_SIZE, capacity=None):
+        """
+        :param size: (int) number of hashes of the sketch
+        :param capacity: (int) number of hashes kept with their counts, defaults to 8 times size
+        """
+        self.size = size
+        self.capacity = capacity if capacity else 8 * size
+        self.hashes = np.zeros(0, dtype=np.uint64)  # sorted
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.bases = 0
+
+    def _merge(self, hashes, counts):
+        hashes = np.concatenate((self.hashes, hashes))
+        unique, inverse = np.unique(hashes, return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate((self.counts, counts)), minlength=len(unique))
+        self.hashes = unique[:self.capacity]
+        self.counts = counts[:self.capacity].astype(np.int64)
+
+    def add(self, seqs):
+        """
+        :param seqs: list of sequences (bytes)
+        :return: None
+        """
+        hashes = kmer_hashes(seqs)
+        if len(self.hashes) == self.capacity:
+            hashes = hashes[hashes <= self.hashes[-1]]  # larger hashes can never enter the sketch
+        hashes, counts = np.unique(hashes, return_counts=True)
+        self._merge(hashes, counts)
+        self.bases += sum(len(s) for s in seqs)
+
+    def run(self, path, prefix_bases=PREFIX_BASES):
+        """
+        Sketches the first prefix_bases bases of a fastq(.gz) file.
+
+        :return: Sketch
+        """
+        for lines in fastx.fastq_blocks(path):
+            self.add(lines[1::4])
+            if prefix_bases and self.bases >= prefix_bases:
+                break
+        return self
+
+    def merge(self, other):
+        """
+        :param other: Sketch of another file of the same read set
+        :return: Sketch of both files
+        """
+        merged = Sketch(self.size, self.capacity)
+        merged.hashes, merged.counts, merged.bases = self.hashes, self.counts, self.bases + other.bases
+        merged._merge(other.hashes, other.counts)
+        return merged
+
+    def sketch(self, min_copies=MIN_COPIES):
+        """
+        :param min_copies: (int) copies a k-mer needs to be part of the sketch
+        :return: numpy uint64 array of the (at most size) smallest hashes, sorted
+        """
+        return self.hashes[self.counts >= min_copies][:self.size]
+
+    def to_dict(self):
+        return {"size": self.size, "capacity": self.capacity, "bases": self.bases,
+                "hashes": self.hashes.tolist(), "counts": self.counts.tolist()}
+
+    @staticmethod
+    def from_dict(data):
+        sketch = Sketch(data["size"], data["capacity"])
+        sketch.hashes = np.array(data["hashes"], dtype=np.uint64)
+        sketch.counts = np.array(data["counts"], dtype=np.int64)
+        sketch.bases = data["bases"]
+        return sketch
+
+
+def jaccard(a, b, size=SKETCH_SIZE):
+    """
+    :param a: sorted hashes of a sketch
+    :param b: sorted hashes of another sketch
+    :param size: (int) sketch size
+    :return: (float) estimated Jaccard similarity of the two k-mer sets
+    """
+    union = np.union1d(a, b)[:size]
+    if not len(union):
+        return 0.0
+    shared = np.isin(union, a, assume_unique=True) & np.isin(union, b, assume_unique=True)
+    return np.count_nonzero(shared) / len(union)
+
+
+class SketchCache:
+    """
+    Sketches of the read files, kept in a JSON file with the size and mtime of each file, so that a file is only
+    sketched again when it changed. Without a path, sketches are only kept for the run.
+    """
+
+    def __init__(self, path=None, prefix_bases=PREFIX_BASES):
+        """
+        :param path: (str) path of the JSON cache file
+        :param prefix_bases: (int) bases sketched at the start of each file
+        """
+        self.path = path
+        self.prefix_bases = prefix_bases
+        self.entries = {}
+        if path and os.path.isfile(path):
+            with open(path) as ftr:
+                self.entries = json.load(ftr)
+
+    def get(self, path):
+        """
+        :param path: (str) path of a fastq(.gz) file
+        :return: Sketch of its prefix
+        """
+        key = os.path.abspath(path)
+        st = os.stat(path)
+        identity = [st.st_size, st.st_mtime_ns, K, self.prefix_bases]
+        entry = self.entries.get(key)
+        if entry is not None and entry["identity"] == identity:
+            return Sketch.from_dict(entry["sketch"])
+        sketch = Sketch().run(path, self.prefix_bases)
+        self.entries[key] = {"identity": identity, "sketch": sketch.to_dict()}
+        return sketch
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as ftw:
+            json.dump(self.entries, ftw, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+
+def similarity_matrix(long_reads, short_reads, cache):
+    """
+    :param long_reads: dictionary {sample: long read file}
+    :param short_reads: dictionary {sample: (R1 file, R2 file)}
+    :param cache: SketchCache
+    :return: tuple (long read samples, short read samples, numpy matrix of Jaccard similarities between them)
+    """
+    longs, shorts = sorted(long_reads), sorted(short_reads)
+    long_sketches = [cache.get(long_reads[s]).sketch() for s in longs]
+    short_sketches = []
+    for s in shorts:
+        r1, r2 = short_reads[s]
+        short_sketches.append(cache.get(r1).merge(cache.get(r2)).sketch())
+    cache.save()
+    matrix = np.zeros((len(longs), len(shorts)), dtype=np.float64)
+    for i, a in enumerate(long_sketches):
+        for j, b in enumerate(short_sketches):
+            matrix[i, j] = jaccard(a, b)
+    return longs, shorts, matrix
+
+
+def report(longs, shorts, matrix):
+    print("Jaccard similarity of the long reads (rows) and the short reads (columns):")
+    print("\t".join([""] + shorts))
+    for name, row in zip(longs, matrix):
+        print("\t".join([name] + ["{:.3f}".format(v) for v in row]))
+
+
+def check_pairs(samples, mode="warn", cache=None):
+    """
+    Checks that the long and short reads paired by sample name come from the same genome. For every sample with long
+    reads, the short reads that share the most k-mers with them are found. When they belong to another sample, the
+    match is mutual, and it is MARGIN times better than the pairing by name, a warning is printed, and in repair mode
+    the sample is re-paired with those short reads.
+
+    :param samples: dictionary {sample: entry}, the entries of a discovery.SampleTable (longread, r1, r2)
+    :param mode: (str) warn, or repair to update the r1 and r2 of the entries
+    :param cache: SketchCache
+    :return: dictionary {sample: sample whose short reads it was re-paired with}, the mismatches found
+    """
+    cache = cache if cache is not None else SketchCache()
+    long_reads = {s: e["longread"] for s, e in samples.items() if e["longread"] and os.path.isfile(e["longread"])}
+    short_reads = {s: (e["r1"], e["r2"]) for s, e in samples.items() if e["r1"] and e["r2"]}
+    if not long_reads or not short_reads:
+        return {}
+    longs, shorts, matrix = similarity_matrix(long_reads, short_reads, cache)
+    report(longs, shorts, matrix)
+
+    mismatches = {}
+    for i, name in enumerate(longs):
+        best = int(np.argmax(matrix[i]))
+        own = matrix[i, shorts.index(name)] if name in shorts else 0.0
+        if matrix[i, best] == 0:
+            print("Warning: the long reads of {} share no k-mers with any short reads.".format(name))
+        elif shorts[best] != name and int(np.argmax(matrix[:, best])) == i and matrix[i, best] > MARGIN * own:
+            print("Warning: the long reads of {} match the short reads of {} (Jaccard {:.3f}), not its own ({:.3f})."
+                  .format(name, shorts[best], matrix[i, best], own))
+            mismatches[name] = shorts[best]
+    if mode == "repair" and mismatches:
+        paired = {s: (samples[s]["r1"], samples[s]["r2"]) for s in mismatches.values()}
+        for name, other in mismatches.items():
+            samples[name]["r1"], samples[name]["r2"] = paired[other]
+            print("{}: re-paired with the short reads of {}.".format(name, other))
+    return mismatches
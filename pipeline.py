@@ -0,0 +1,104 @@
+import os
+import subprocess
+import time
+
+from bgzf import BgzfWriter
+import telemetry
+from telemetry import StageMonitor
+
+# Size of the reads done on the last stage's stdout.
+PIPE_BUFFER = 1024 * 1024
+
+
+class Pipeline:
+    """
+    Chains external tools, stdout to stdin, without going through python. The stdout of the last tool goes directly
+    to the output file descriptor, or, if compression is requested, to an in-process multithreaded BgzfWriter.
+    Reports the wall time, cpu time, peak RSS and bytes written of every stage.
+    """
+
+    def __init__(self, commands, output=None, compress=False, threads=None, level=6):
+        """
+        :param commands: list of commands (lists), run as cmd1 | cmd2 | ...
+        :param output: (str) file the last stdout is written to, None if the last tool writes its own output
+        :param compress: (bool) compress the output in-process, as BGZF
+        :param threads: (int) compression threads
+        :param level: (int) compression level
+        """
+        self.commands = commands
+        self.output = output
+        self.compress = compress
+        self.threads = threads
+        self.level = level
+        self.monitors = []
+        self.compressor_stats = None
+
+    def run(self):
+        """
+        :return: (int) the first non-zero return code of the stages, 0 if they all succeeded
+        """
+        processes = []
+        out_file = open(self.output, "wb") if self.output else None
+        try:
+            for i, cmd in enumerate(self.commands):
+                last = i == len(self.commands) - 1
+                if not last or self.compress:
+                    stdout = subprocess.PIPE
+                else:
+                    stdout = out_file if out_file else None
+                stdin = processes[-1].stdout if processes else None
+                processes.append(subprocess.Popen(cmd, stdin=stdin, stdout=stdout))
+                if stdin is not None:
+                    stdin.close()  # only the next tool keeps the read end, so it gets SIGPIPE if it stops
+                self.monitors.append(StageMonitor(Pipeline.stage_name(cmd), processes[-1]))
+
+            if self.compress:
+                self._compress(processes[-1].stdout, out_file)
+            codes = [m.wait() for m in self.monitors]
+        finally:
+            if out_file:
+                out_file.close()
+        return next((c for c in codes if c != 0), 0)
+
+    @staticmethod
+    def stage_name(cmd):
+        """
+        :param cmd: list, command of the stage
+        :return: (str) name of the tool, with its subcommand if it has one (bwa mem, samtools sort...)
+        """
+        name = os.path.basename(str(cmd[0]))
+        if len(cmd) > 1 and not str(cmd[1]).startswith("-") and not os.path.exists(str(cmd[1])):
+            name = "{} {}".format(name, cmd[1])
+        return name
+
+    def _compress(self, stream, out_file):
+        start = time.time()
+        with BgzfWriter(out_file, self.threads, self.level) as gz:
+            for block in iter(lambda: stream.read(PIPE_BUFFER), b""):
+                gz.write(block)
+        stream.close()
+        wall = time.time() - start
+        self.compressor_stats = {"stage": "bgzf (in-process)", "returncode": 0, "wall": round(wall, 2),
+                                 "bytes_read": gz.bytes_in, "bytes_written": gz.bytes_out, "disk_written": gz.bytes_out,
+                                 "bytes_per_sec": round(gz.bytes_in / wall) if wall else 0}
+        telemetry.record(dict(self.compressor_stats, sample=telemetry.current().get("sample"), start=round(start, 3)))
+
+    def stats(self):
+        """
+        :return: list of dictionaries, one per stage
+        """
+        stats = [m.stats() for m in self.monitors]
+        if self.compressor_stats:
+            stats.append(self.compressor_stats)
+        return stats
+
+    def report(self):
+        """
+        Prints one line per stage.
+
+        :return: None
+        """
+        for s in self.stats():
+            print("{stage}: {wall} s, {mb:.1f} MB/s".format(mb=s["bytes_per_sec"] / 1e6, **s) +
+                  (", cpu {cpu} s, peak RSS {peak_rss_mb} MB".format(**s) if "cpu" in s else "") +
+                  (", exited with {}".format(s["returncode"]) if s["returncode"] else ""))
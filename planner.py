@@ -0,0 +1,116 @@
+import os
+from math import ceil
+
+import scheduler
+
+# Bytes on disk per sequenced base, used to estimate the read bases of a file from its size.
+BYTES_PER_BASE = {".fastq.gz": 0.6, ".fq.gz": 0.6, ".fasta.gz": 0.3, ".fa.gz": 0.3, ".fastq": 2.1, ".fq": 2.1}
+# Peak memory per input base (bytes): shasta keeps the reads and the marker graph in memory, spades and skesa
+# their de Bruijn graphs.
+SHASTA_BYTES_PER_BASE = 8
+SPADES_BYTES_PER_BASE = 2.5
+SKESA_BYTES_PER_BASE = 1.5
+# Pilon needs about 1 GB of heap per Mb of assembly, plus the JVM itself.
+PILON_GB_PER_MB = 1
+JVM_OVERHEAD_GB = 1
+MIN_HEAP_GB = 2
+
+
+def read_bases(*paths):
+    """
+    :param paths: read files (fastq, fasta, compressed or not), None entries are ignored
+    :return: (int) estimated number of bases in the files, from their size
+    """
+    bases = 0
+    for path in paths:
+        if not path or not os.path.isfile(path):
+            continue
+        ratio = next((r for ext, r in BYTES_PER_BASE.items() if path.endswith(ext)), 1.0)
+        if ratio == 1.0 and "." not in os.path.basename(path):
+            ratio = BYTES_PER_BASE[".fastq.gz"]  # filtered_<sample>: gzipped fastq without extension
+        bases += os.path.getsize(path) / ratio
+    return int(bases)
+
+
+def hugepages_free():
+    """
+    :return: (int) free 2 MB huge pages memory, in GB
+    """
+    try:
+        with open("/proc/meminfo") as ftr:
+            info = dict(line.split(":", 1) for line in ftr)
+        return int(info["HugePages_Free"].split()[0]) * int(info["Hugepagesize"].split()[0]) // (1024 ** 2)
+    except (OSError, KeyError, ValueError):
+        return 0
+
+
+class Planner:
+    """
+    Sizes the threads and memory of each tool invocation from the size of its input and the number of samples
+    running at the same time: each job gets an even share of the node, and a tool only takes from its share what its
+    input needs, so concurrent jobs neither get OOM killed nor leave cores idle.
+    """
+
+    def __init__(self, threads=None, memory=None, jobs=1):
+        """
+        :param threads: (int) threads of the node (or of the budget), defaults to the available cores
+        :param memory: (int) memory of the node (or of the budget) in GB, defaults to the physical memory
+        :param jobs: (int) number of jobs running at the same time
+        """
+        self.threads = int(threads) if threads else len(os.sched_getaffinity(0))
+        self.memory = int(memory) if memory else scheduler.total_memory()
+        self.jobs = max(1, int(jobs))
+
+    def share(self, split=1):
+        """
+        :param split: (int) number of parallel invocations the job itself runs
+        :return: tuple (threads, memory in GB) of one invocation
+        """
+        parts = self.jobs * max(1, int(split))
+        return max(1, self.threads // parts), max(1, self.memory // parts)
+
+    def shasta(self, reads):
+        """
+        :param reads: (str) shasta input
+        :return: tuple (threads, memory in GB, memory mode, memory backing). Huge pages are used when enough of them
+            are free, otherwise shasta runs in anonymous memory with 4K pages, which needs neither root nor huge pages.
+        """
+        threads, memory = self.share()
+        need = ceil(read_bases(reads) * SHASTA_BYTES_PER_BASE / 1e9) + 1
+        if need > memory:
+            print("{}: shasta may need {} GB, more than the {} GB available per job.".format(reads, need, memory))
+        need = min(need, memory)
+        if hugepages_free() >= need:
+            return threads, need, "filesystem", "2M"
+        return threads, need, "anonymous", "4K"
+
+    def spades(self, *reads):
+        """
+        :return: tuple (threads, memory in GB) for spades on the short reads
+        """
+        threads, memory = self.share()
+        return threads, min(memory, max(4, ceil(read_bases(*reads) * SPADES_BYTES_PER_BASE / 1e9)))
+
+    def skesa(self, *reads):
+        """
+        :return: tuple (threads, memory in GB) for skesa on the short reads
+        """
+        threads, memory = self.share()
+        return threads, min(memory, max(4, ceil(read_bases(*reads) * SKESA_BYTES_PER_BASE / 1e9)))
+
+    def pilon(self, assembly_bases, split=1):
+        """
+        :param assembly_bases: (int) bases pilon polishes (whole assembly, or the targeted contigs)
+        :param split: (int) number of pilon the job runs at the same time
+        :return: tuple (threads, heap in GB)
+        """
+        threads, memory = self.share(split)
+        heap = max(MIN_HEAP_GB, ceil(assembly_bases / 1e6 * PILON_GB_PER_MB) + JVM_OVERHEAD_GB)
+        return threads, min(heap, max(MIN_HEAP_GB, memory - JVM_OVERHEAD_GB))
+
+    def sort_memory(self):
+        """
+        :return: (int) samtools sort memory per thread, in MB: a quarter of the job's memory spread over its threads
+        """
+        threads, memory = self.share()
+        return min(4096, max(256, memory * 1024 // 4 // threads))
@@ -1,7 +1,18 @@
-import subprocess
 import os
-from psutil import virtual_memory
-from math import ceil
+import json
+import subprocess
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import fastx
+import staging
+import telemetry
+from asmqc import QCLog
+from cache import ResultCache, cached
+from discovery import SampleTable
+from pipeline import Pipeline
+from planner import Planner
 
 # Incorporate "__main__" maybe?
 
@@ -10,6 +21,12 @@ class InputArg:
     def __init__(self, args):
         self.samples = {}
         self.args = args
+        if args.cache:  # Directory where the results of previous runs are kept
+            self.cache = ResultCache(args.cache, args.cache_size)
+        else:
+            self.cache = None
+        # Files of each sample, found in one scan of the input directories
+        self.table = SampleTable(args.sample_pattern, args.sample_cache)
 
     def initialize(self):
         """
@@ -19,43 +36,40 @@ class InputArg:
         short_dir = self.args.shortdir  # Directory with short reads
         longdir = self.args.longdir  # Directory with subdirectories and assemblies
 
-        for sd in os.listdir(longdir):  # will always have a subdir, because of the output of assembly.
-            location = os.path.join(longdir, sd)
-            f = sd.split("_")[1]
+        # will always have a subdir, because of the output of assembly.
+        table = self.table.add_sample_dirs(longdir)
+        if short_dir:
+            table.add_short_reads(short_dir)
+        table.save()
+
+        selected = getattr(self.args, "samples", None)  # -samples, used by the work queue to run one sample
+        for f, entry in sorted(table.samples.items()):
+            if entry["dir"] is None:
+                continue  # short reads without an assembly
+            if selected and f not in selected:
+                continue
             self.samples[f] = Sample(f)
-            self.samples[f].dir = "{}".format(location)
-
-            for files in os.listdir(os.path.join(longdir, sd)):
-                if ".fastq" in files:
-                    self.samples[f].lr = "{}/{}".format(location, files)
-
-            for r in os.listdir(short_dir):
-                if f in r and "R1" in r:
-                    self.samples[f].sr1 = "{}{}".format(short_dir, r)
-                elif f in r and "R2" in r:
-                    self.samples[f].sr2 = "{}{}".format(short_dir, r)
-
-            location = "{}{}".format(longdir, sd)
-            contents = os.listdir(location)
-
-            if "spades" in contents:
-                max_kmer = max(list(map(lambda x: int(x.split("K")[-1]),
-                                        filter(lambda x: "K" in x, os.listdir("{}/spades".format(location))))))
-
-                self.samples[f].short = "{}/spades/K{}/final_contigs.fasta".format(location, max_kmer)
-            elif "medaka_consensus" in contents:
-                self.samples[f].long = "{}/medaka_consensus/consensus.fasta".format(location)
-            elif "ShastaRun" in contents:
-                self.samples[f].long = "{}/ShastaRun/Assembly.fasta".format(location)  #
-            elif "skesa" in contents:
-                self.samples[f].short = "{}/skesa.fasta".format(location)
+            self.samples[f].dir = entry["dir"]
+            self.samples[f].lr = entry["fastq"]
+            self.samples[f].sr1 = entry["r1"]
+            self.samples[f].sr2 = entry["r2"]
+            if entry["assembler"] in ("spades", "skesa"):
+                self.samples[f].short = entry["assembly"]
+            elif entry["assembler"] in ("medaka", "shasta"):
+                self.samples[f].long = entry["assembly"]
         return self.samples
 
     def run_polishing(self):
         samples_dict = self.initialize()
 
         for f in samples_dict.values():
-            f.polishing()
+            f.cache = self.cache
+            f.sharded = self.args.sharded
+            f.medaka_jobs = self.args.medaka_jobs
+            f.planner = Planner()
+            f.converge = self.args.converge
+            with telemetry.context(sample=f.name):
+                f.polishing()
 
 
 class Sample:
@@ -68,6 +82,11 @@ class Sample:
         self.dir = None  # The directory where the polished assemblies will go!
         self.name = name
         self.enum = 0
+        self.cache = None  # cache.ResultCache, so an interrupted run resumes from the last finished pilon round
+        self.sharded = 0  # if set, number of parallel per-contig pilon jobs of iterate_pilon_sharded
+        self.medaka_jobs = 0  # if set, number of parallel medaka consensus jobs of medaka_regions
+        self.planner = None  # planner.Planner giving the threads and memory of each tool, the whole node if None
+        self.converge = None  # if set, pilon stops once a round makes at most this many changes (asmqc.QCLog)
 
     def polishing(self):
         """
@@ -81,14 +100,21 @@ class Sample:
         # must switch btw environments
         # is it worth it to do Shasta -> Medaka, Spades -> Pilon
 
-        if "medaka" in self.long or self.short:
-            os.mkdir("{}/pilon/".format(self.dir))
-            self.iterate_pilon()
+        if (self.long and "medaka" in self.long) or self.short:
+            os.makedirs("{}/pilon/".format(self.dir), exist_ok=True)
+            if self.sharded:
+                self.iterate_pilon_sharded(self.sharded)
+            else:
+                self.iterate_pilon()
             # Use Pilon on skesa/spades assembly
 
+        elif self.long and self.medaka_jobs:
+            self.medaka_regions(self.medaka_jobs)
+            QCLog(self.dir, self.name).add("medaka", "{}/medaka_consensus/consensus.fasta".format(self.dir))
         elif self.long:
             self.medaka()
             # Use Medaka on shasta assembly
+            QCLog(self.dir, self.name).add("medaka", "{}/medaka_consensus/consensus.fasta".format(self.dir))
 
     def medaka(self):
         """
@@ -98,66 +124,200 @@ class Sample:
         """
         cmd = ["medaka_consensus", "-i", self.lr, "-d", self.long, "-o", "{}/medaka_consensus".format(self.dir),
                "-m", "r941_min_high_g344"]
-        subprocess.run(cmd)
+        telemetry.run(cmd, check=True)
 
         os.remove("{}/medaka_consensus/calls_to_draft.bam".format(self.dir))
         os.remove("{}/medaka_consensus/calls_to_draft.bam.bai".format(self.dir))
         os.remove("{}/medaka_consensus/consensus_probs.hdf".format(self.dir))
 
+    @staticmethod
+    def region_batches(contigs, count):
+        """
+        Groups contigs into count batches of about the same total length, largest contigs first.
+
+        :param contigs: list of tuples (name, length)
+        :param count: (int) number of batches
+        :return: list of lists of contig names, empty batches removed
+        """
+        loads = [0] * max(1, count)
+        batches = [[] for _ in loads]
+        for name, length in sorted(contigs, key=lambda x: (-x[1], x[0])):
+            i = loads.index(min(loads))
+            batches[i].append(name)
+            loads[i] += length
+        return [b for b in batches if b]
+
+    def medaka_regions(self, jobs, model="r941_min_high_g344"):
+        """
+        Region-parallel version of medaka: the reads are aligned to the draft once (mini_align), the contigs are
+        split into jobs * 2 batches balanced by length, medaka consensus runs on the batches, jobs at a time with their
+        share of the cores, and medaka stitch joins them into medaka_consensus/consensus.fasta, as medaka_consensus
+        does. The wall time of every batch is written to medaka_consensus/region_timings.json.
+
+        :param jobs: (int) number of medaka consensus running at the same time
+        :param model: (str) medaka model
+        :return: None
+        """
+        out = "{}/medaka_consensus".format(self.dir)
+        os.makedirs(out, exist_ok=True)
+        planner = self.planner if self.planner else Planner()
+        cores = planner.share()[0]
+        threads = planner.share(jobs)[0]
+        bam = "{}/calls_to_draft".format(out)
+        telemetry.run(["mini_align", "-i", self.lr, "-r", self.long, "-P", "-m", "-p", bam, "-t", str(cores)],
+                      stage="mini_align", check=True)
+
+        contigs = [(n, len(seq)) for n, seq in fastx.read_fasta(self.long)]
+        batches = Sample.region_batches(contigs, 2 * jobs)
+        lengths = dict(contigs)
+        sample = telemetry.current().get("sample")  # the pool threads do not inherit the telemetry context
+
+        def consensus(i):
+            hdf = "{}/consensus_probs_{}.hdf".format(out, i)
+            cmd = ["medaka", "consensus", "{}.bam".format(bam), hdf, "--model", model, "--threads", str(threads),
+                   "--regions"] + batches[i]
+            start = time.time()
+            code = telemetry.run(cmd, stage="medaka consensus", sample=sample).returncode
+            return {"batch": i, "regions": batches[i], "bases": sum(lengths[r] for r in batches[i]),
+                    "wall": round(time.time() - start, 2), "returncode": code, "hdf": hdf}
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            timings = list(pool.map(consensus, range(len(batches))))
+        with open("{}/region_timings.json".format(out), "w") as ftw:
+            json.dump(timings, ftw, indent=1)
+        failed = [t["batch"] for t in timings if t["returncode"] != 0]
+        if failed:
+            raise RuntimeError("{}: medaka consensus failed on batches {}".format(self.name, failed))
+
+        telemetry.run(["medaka", "stitch"] + [t["hdf"] for t in timings] + [self.long,
+                      "{}/consensus.fasta".format(out)], stage="medaka stitch", check=True)
+
+        for t in timings:
+            os.remove(t["hdf"])
+        os.remove("{}.bam".format(bam))
+        os.remove("{}.bam.bai".format(bam))
+
+    def round_qc(self, log):
+        """
+        Adds pilon round self.enum to the QC log of the sample.
+
+        :param log: asmqc.QCLog of the sample
+        :return: (bool) True if the round converged (see Sample.converge)
+        """
+        prefix = "{}/pilon/{}_polished_{}".format(self.dir, self.name, self.enum)
+        entry = log.add("pilon_{}".format(self.enum), "{}.fasta".format(prefix), "{}.changes".format(prefix))
+        if self.converge is not None and QCLog.converged(entry, self.converge):
+            print("{}: pilon round {} made {} changes, polishing has converged.".format(
+                self.name, self.enum, entry["changes"]))
+            return True
+        return False
+
     def iterate_pilon(self):
         """
-        Calls pilon x times or until the changes file is empty.
+        Calls pilon x times or until the changes file is empty, or, with self.converge, until a round barely
+        changes the assembly. Every round is added to the QC log of the sample.
         TO DO: incorporate putting everything in a pilon directory
         :return: None.
         """
         # Be more elegant
-        if "medaka" in self.long:
+        if self.long and "medaka" in self.long:
             assembly_file = self.long
         else:
             assembly_file = self.short
+        log = QCLog(self.dir, self.name)
+        converged = False
 
         while self.enum < 6:
 
             if self.enum == 0:
-                Sample.pilon(assembly_file, self.dir, self.name, self.sr1, self.sr2, self.enum)
+                Sample.pilon(assembly_file, self.dir, self.name, self.sr1, self.sr2, self.enum, self.cache,
+                             self.planner)
+                converged = self.round_qc(log)
                 self.enum += 1
             elif os.stat("{}/pilon/{}_polished_{}.changes".format(self.dir, self.name, (int(self.enum) - 1))).st_size == 0:
                 break
+            elif converged:
+                break
             else:
                 variable = "{}/pilon/{}_polished_{}.fasta".format(self.dir, self.name, int(self.enum) - 1)
-                Sample.pilon(variable, self.dir, self.name, self.sr1, self.sr2, self.enum)
+                Sample.pilon(variable, self.dir, self.name, self.sr1, self.sr2, self.enum, self.cache,
+                             self.planner)
+                converged = self.round_qc(log)
                 self.enum += 1
 
     @staticmethod
-    def pilon(assembly, out, name, sr1, sr2, enum):
+    def align(assembly, out, name, sr1, sr2, enum, planner=None):
         """
-        Requires that reads are pre-processed before use. Utilizes bwa, samtools, and pilon. Will produce the
-        required bam file and index the assemblies. Requires being run in a virtual environment with bwa, samtools,
-        and pilon installed.
+        Indexes the assembly, aligns the short reads to it, and produces the sorted, deduplicated and indexed bam
+        file pilon uses. Threads and sort memory are the job's share given by the planner (the whole node without).
 
-        :return: None.
+        :return: (str) path to the final bam file.
         """
-        limit = ceil(virtual_memory().total / (10 ** 9) * .65)
-
         if not os.path.isdir(out):
             os.mkdir(out)
-        # add pilon directory!
-        rmdup_name = "{}/{}_nd_{}.bam".format(out, name, enum)
         final_bam = "{}/{}_final_{}.bam".format(out, name, enum)
-        polished_file = "{}/pilon/{}_polished_{}".format(out, name, enum)
-        print(assembly)
+        planner = planner if planner else Planner()
+        threads = planner.share()[0]
+        sort_memory = planner.sort_memory()
         # index assembly
         bw_index_cmd = ["bwa", "index", "{}".format(assembly)]
         # align short reads to indexed assembly
-        bwa_mem_cmd = ["bwa", "mem", "-M", "-t", "{}".format(len(os.sched_getaffinity(0))), assembly, sr1, sr2]
-        # remove unmapped reads and return a bam file with the appropriate header
-        st_view_cmd = ["samtools", "view", "-h", "-b", "-F", "4"]
-        # sort .bam file based on position
-        st_sort_cmd = ["samtools", "sort", "-o", rmdup_name]
-        # remove duplicates from bam file
-        rm_dup_cmd = ["samtools", "rmdup", rmdup_name, final_bam]
-        # index final bam file
-        st_index = ["samtools", "index", final_bam]
+        bwa_mem_cmd = ["bwa", "mem", "-M", "-t", "{}".format(threads), assembly, sr1, sr2]
+        # add the mate score and mate cigar tags markdup needs, on the name-grouped bwa output
+        fixmate_cmd = ["samtools", "fixmate", "-m", "-u", "-", "-"]
+        # remove unmapped reads
+        st_view_cmd = ["samtools", "view", "-u", "-F", "4"]
+        # sort based on position, with explicit memory per thread and temporary files next to the outputs
+        st_sort_cmd = ["samtools", "sort", "-u", "-@", str(threads), "-m", "{}M".format(sort_memory),
+                       "-T", "{}/{}_sort_{}".format(out, name, enum)]
+        # remove duplicates, and index the final bam file while it is written
+        markdup_cmd = ["samtools", "markdup", "-r", "-@", str(threads), "--write-index", "-",
+                       "{0}##idx##{0}.bai".format(final_bam)]
+
+        telemetry.run(bw_index_cmd, check=True)
+        # bwa | fixmate | unmapped reads removed | sort | markdup: the only bam written is the final one
+        alignment = Pipeline([bwa_mem_cmd, fixmate_cmd, st_view_cmd, st_sort_cmd, markdup_cmd])
+        returncode = alignment.run()
+        alignment.report()
+        if returncode != 0:
+            # markdup may have written a truncated bam, that pilon must not polish with
+            for path in (final_bam, "{}.bai".format(final_bam)):
+                if os.path.exists(path):
+                    os.remove(path)
+            failed = next(c for c, m in zip(alignment.commands, alignment.monitors) if m.process.returncode != 0)
+            raise subprocess.CalledProcessError(returncode, failed)
+        # write_bytes only counts what reaches the file system, not the pipes between the stages
+        print("{}: {:.1f} MB written to disk by the alignment stages.".format(
+            name, sum(s["disk_written"] for s in alignment.stats()) / 1e6))
+        return final_bam
+
+    @staticmethod
+    def remove_alignment(assembly, final_bam):
+        """
+        Removes the bam file and the bwa index produced by Sample.align.
+
+        :return: None.
+        """
+        os.remove(final_bam)
+        os.remove("{}.bai".format(final_bam))
+        for ext in ("amb", "ann", "pac", "bwt", "sa"):
+            os.remove("{}.{}".format(assembly, ext))
+
+    @staticmethod
+    def pilon(assembly, out, name, sr1, sr2, enum, cache=None, planner=None):
+        """
+        Requires that reads are pre-processed before use. Utilizes bwa, samtools, and pilon. Will produce the
+        required bam file and index the assemblies. Requires being run in a virtual environment with bwa, samtools,
+        and pilon installed. A round that already ran on the same assembly and reads is taken from the cache.
+        The JVM heap is sized from the assembly length, within the job's share of the memory.
+
+        :return: None.
+        """
+        planner = planner if planner else Planner()
+        threads, limit = planner.pilon(os.path.getsize(assembly))
+        final_bam = "{}/{}_final_{}.bam".format(out, name, enum)
+        polished_file = "{}/pilon/{}_polished_{}".format(out, name, enum)
+        print(assembly)
         # command for Pilon
         pilon_cmd = ["java", "-Xmx{}G".format(limit),
                      "-jar", "pilon-1.23.jar",
@@ -165,29 +325,137 @@ class Sample:
                      "--frags", final_bam,
                      "--vcf",
                      "--output", polished_file,
-                     "--threads", "{}".format(len(os.sched_getaffinity(0))),
+                     "--threads", "{}".format(threads),
                      "--changes"]
 
-        # runs listed commands
-        subprocess.run(bw_index_cmd)
-        bwa = subprocess.Popen(bwa_mem_cmd,
-                               stdout=subprocess.PIPE)  # pipe out bwa alignment with short reads to assembly
-        st_view = subprocess.Popen(st_view_cmd, stdin=bwa.stdout,
-                                   stdout=subprocess.PIPE)  # pipe out unmapped reads removed bam file
-        bwa.stdout.close()
-        st_sort = subprocess.Popen(st_sort_cmd, stdin=st_view.stdout, stdout=subprocess.PIPE)
-        st_view.stdout.close()
-        st_sort.communicate()[0]
-        subprocess.run(rm_dup_cmd)
-        subprocess.run(st_index)
-        subprocess.run(pilon_cmd)
-
-        # remove temporary files produced
-        os.remove(final_bam)
-        os.remove(rmdup_name)
-        os.remove("{}.amb".format(assembly))
-        os.remove("{}.ann".format(assembly))
-        os.remove("{}.pac".format(assembly))
-        os.remove("{}.bwt".format(assembly))
-        os.remove("{}.sa".format(assembly))
-        os.remove("{}.bai".format(final_bam))
+        outputs = ["{}.{}".format(polished_file, ext) for ext in ("fasta", "changes", "vcf")]
+
+        def run():
+            # the index, the bam, the sort temporary files and pilon's outputs are written to scratch, if there is one
+            need = 2 * staging.size(assembly) + 2 * staging.size(sr1, sr2)
+            with staging.staged("pilon", [assembly], outputs, need) as area:
+                local = area.path(assembly)
+                bam = Sample.align(local, area.location(out), name, sr1, sr2, enum, planner)
+                telemetry.run([area.path(c) if c in (assembly, final_bam, polished_file) else c for c in pilon_cmd],
+                              stage="pilon", check=True)
+                # remove temporary files produced
+                Sample.remove_alignment(local, bam)
+
+        # a round is defined by the assembly, the reads and the pilon options (the thread count does not matter)
+        cached(cache, "pilon", "pilon-1.23.jar", [assembly, sr1, sr2] + pilon_cmd[4:-3], [assembly, sr1, sr2],
+               outputs, run)
+
+    @staticmethod
+    def changed_contigs(changes):
+        """
+        :param changes: (str) path to a pilon .changes file
+        :return: set of the (original) names of the contigs pilon changed
+        """
+        changed = set()
+        with open(changes) as ftr:
+            for line in ftr:
+                if line.strip():
+                    changed.add(Sample.contig_name(line.split()[0].rsplit(":", 1)[0]))
+        return changed
+
+    @staticmethod
+    def contig_name(name):
+        """
+        :param name: (str) contig name, possibly with the _pilon suffixes added by each round
+        :return: (str) the original contig name
+        """
+        while name.endswith("_pilon"):
+            name = name[:-len("_pilon")]
+        return name
+
+    @staticmethod
+    def pilon_targets(assembly, final_bam, prefix, contigs, jobs, planner=None):
+        """
+        Runs one pilon per contig (--targets), jobs at a time, each with its share of the heap and of the cores.
+
+        :param assembly: (str) assembly the reads were aligned to
+        :param final_bam: (str) alignment of the reads to the whole assembly
+        :param prefix: (str) output prefix, the contig index is appended to it
+        :param contigs: list of contig names to polish
+        :param jobs: (int) number of pilon running at the same time
+        :param planner: planner.Planner, the heap is sized for the longest contig
+        :return: list of output prefixes, in the order of contigs
+        """
+        jobs = max(1, min(jobs, len(contigs)))
+        planner = planner if planner else Planner()
+        targets = set(contigs)
+        longest = max((len(seq) for n, seq in fastx.read_fasta(assembly) if n in targets), default=0)
+        threads, heap = planner.pilon(longest, jobs)
+        outputs = ["{}_{}".format(prefix, i) for i in range(len(contigs))]
+        commands = [["java", "-Xmx{}G".format(heap),
+                     "-jar", "pilon-1.23.jar",
+                     "--genome", assembly,
+                     "--frags", final_bam,
+                     "--targets", contig,
+                     "--output", output,
+                     "--threads", str(threads),
+                     "--changes"] for contig, output in zip(contigs, outputs)]
+        sample = telemetry.current().get("sample")  # the pool threads do not inherit the telemetry context
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(lambda cmd: telemetry.run(cmd, stage="pilon", sample=sample, check=True), commands))
+        return outputs
+
+    def iterate_pilon_sharded(self, jobs=4):
+        """
+        Incremental version of iterate_pilon. The first round polishes the whole assembly; after that, only the
+        contigs listed in the previous round's .changes file are polished again, one pilon per contig (--targets) run
+        in parallel with a smaller heap. Contigs pilon stopped changing are frozen. The reads are still aligned to
+        the whole assembly, so reads from frozen contigs do not pile up on the ones being polished. Each round writes
+        the complete <name>_polished_<n>.fasta and .changes, like iterate_pilon, and is taken from the cache when it
+        already ran on the same assembly, reads and contigs.
+
+        :param jobs: (int) number of per-contig pilon running at the same time
+        :return: None.
+        """
+        if self.long and "medaka" in self.long:
+            assembly_file = self.long
+        else:
+            assembly_file = self.short
+
+        Sample.pilon(assembly_file, self.dir, self.name, self.sr1, self.sr2, 0, self.cache, self.planner)
+        log = QCLog(self.dir, self.name)
+        self.enum = 0
+        converged = self.round_qc(log)
+        self.enum = 1
+        prefix = "{}/pilon/{}_polished_{}".format(self.dir, self.name, 0)
+        contigs = [(Sample.contig_name(n), seq) for n, seq in fastx.read_fasta("{}.fasta".format(prefix))]
+        changed = Sample.changed_contigs("{}.changes".format(prefix))
+
+        while self.enum < 6 and changed and not converged:
+            print("Pilon round {}: polishing {} of {} contigs.".format(self.enum, len(changed), len(contigs)))
+            prefix = "{}/pilon/{}_polished_{}".format(self.dir, self.name, self.enum)
+            current = "{}/pilon/{}_input_{}.fasta".format(self.dir, self.name, self.enum)
+            fastx.write_fasta(contigs, current)
+
+            targets = [n for n, _ in contigs if n in changed]
+
+            def run():
+                final_bam = Sample.align(current, self.dir, self.name, self.sr1, self.sr2, self.enum, self.planner)
+                outputs = Sample.pilon_targets(current, final_bam, prefix, targets, jobs, self.planner)
+                Sample.remove_alignment(current, final_bam)
+
+                # stitch the polished contigs back into the assembly
+                polished = {}
+                with open("{}.changes".format(prefix), "w") as ftw:
+                    for output in outputs:
+                        for n, seq in fastx.read_fasta("{}.fasta".format(output)):
+                            polished[Sample.contig_name(n)] = seq
+                        with open("{}.changes".format(output)) as ftr:
+                            ftw.write(ftr.read())
+                        for ext in ("fasta", "changes"):
+                            os.remove("{}.{}".format(output, ext))
+                fastx.write_fasta([(n, polished.get(n, seq)) for n, seq in contigs], "{}.fasta".format(prefix))
+
+            # like the rounds of iterate_pilon, a round is defined by its input assembly, the reads and the contigs
+            cached(self.cache, "pilon", "pilon-1.23.jar", [current, self.sr1, self.sr2, "--targets"] + targets,
+                   [current, self.sr1, self.sr2], ["{}.{}".format(prefix, ext) for ext in ("fasta", "changes")], run)
+            contigs = [(Sample.contig_name(n), seq) for n, seq in fastx.read_fasta("{}.fasta".format(prefix))]
+            changed = Sample.changed_contigs("{}.changes".format(prefix))
+            os.remove(current)
+            converged = self.round_qc(log)
+            self.enum += 1
@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+
+import fastx
+from bgzf import BgzfWriter
+from readstats import block_stats
+
+
+class ReadFilter:
+    """
+    In-process alternative to filtlong. Works in two passes over the streamed reads: the first pass only keeps a
+    compact array of lengths and scores (a few bytes per read), the second pass streams the reads again and writes
+    the selected ones, compressed, as they come. Memory does not depend on the size of the reads.
+
+    As with filtlong, a read's score is the geometric mean of a length score and a quality score (its mean identity,
+    from the mean error probability). Reads under min_length are dropped, then the best scoring reads are kept up to
+    keep_percent of all the bases, and up to target_bases.
+    """
+
+    def __init__(self, min_length=None, keep_percent=None, target_bases=None):
+        self.min_length = int(min_length) if min_length else 0
+        self.keep_percent = float(keep_percent) if keep_percent else None
+        self.target_bases = int(target_bases) if target_bases else None
+        self.lengths = None
+        self.scores = None
+        self.selected = None
+
+    def score(self, path, blocks=None):
+        """
+        First pass: lengths and scores of every read of the file.
+
+        :param path: (str) fastq(.gz) file
+        :param blocks: iterable of blocks of fastq lines to score instead of the reads of path (trimmed reads)
+        :return: None
+        """
+        lengths, identities = [], []
+        for lines in (blocks if blocks is not None else fastx.fastq_blocks(path)):
+            block_lengths, qualities = block_stats(lines)
+            lengths.append(block_lengths.astype(np.uint32))
+            identities.append((1 - 10 ** (-qualities / 10)).astype(np.float32))
+        self.lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.uint32)
+        identities = np.concatenate(identities) if identities else np.zeros(0, dtype=np.float32)
+
+        # length score: 0 for a 1 bp read, 100 for the longest read of the file, on a log scale
+        log_lengths = np.log(np.maximum(self.lengths, 1).astype(np.float64))
+        longest = log_lengths.max() if len(log_lengths) and log_lengths.max() > 0 else 1.0
+        length_scores = 100 * log_lengths / longest
+        self.scores = np.sqrt(length_scores * 100 * identities).astype(np.float32)
+
+    def select(self):
+        """
+        Chooses the reads to keep from the scores of the first pass.
+
+        :return: (int) number of bases kept
+        """
+        lengths = self.lengths.astype(np.int64)
+        limit = lengths.sum()
+        if self.keep_percent is not None:
+            limit = min(limit, int(lengths.sum() * self.keep_percent / 100))
+        if self.target_bases is not None:
+            limit = min(limit, self.target_bases)
+
+        candidates = np.nonzero(lengths >= self.min_length)[0]
+        order = candidates[np.argsort(-self.scores[candidates], kind="stable")]
+        kept = np.cumsum(lengths[order]) <= limit
+        self.selected = np.zeros(len(lengths), dtype=bool)
+        self.selected[order[kept]] = True
+        return int(lengths[order[kept]].sum())
+
+    def write(self, path, output, compresslevel=6, threads=None, blocks=None):
+        """
+        Second pass: streams the reads again, and writes the selected ones block by block to a BGZF file
+        compressed on several threads. The file is written next to output and renamed once complete, so an error
+        never leaves a valid but truncated gzip at output.
+
+        :param path: (str) fastq(.gz) file that was scored
+        :param output: (str) path of the filtered fastq.gz
+        :param compresslevel: (int) gzip compression level
+        :param threads: (int) compression threads, defaults to the number of available cores
+        :param blocks: iterable of the same blocks that were scored, when they did not come from path
+        :return: (int) number of reads written
+        """
+        written = 0
+        index = 0
+        partial = "{}.tmp".format(output)
+        try:
+            with BgzfWriter(partial, threads, compresslevel) as ftw:
+                for lines in (blocks if blocks is not None else fastx.fastq_blocks(path)):
+                    records = len(lines) // 4
+                    keep = np.nonzero(self.selected[index:index + records])[0]
+                    index += records
+                    if len(keep):
+                        out = [lines[4 * k + j] for k in keep for j in range(4)]
+                        out.append(b"")
+                        ftw.write(b"\n".join(out))
+                        written += len(keep)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, output)
+        return written
+
+    def run(self, path, output, trimmer=None):
+        """
+        Filters path into output.
+
+        :param path: (str) fastq(.gz) file
+        :param output: (str) path of the filtered fastq.gz
+        :param trimmer: trimmer.Trimmer, to remove the adapters of the reads on the way in. The trimmed reads go
+            straight into both passes, without an intermediate file.
+        :return: None
+        """
+        if trimmer is not None:
+            self.score(path, trimmer.trim(path))
+            trimmer.report(path)
+        else:
+            self.score(path)
+        bases = self.select()
+        written = self.write(path, output, blocks=trimmer.replay(path) if trimmer is not None else None)
+        print("{}: kept {} of {} reads ({} bases).".format(path, written, len(self.lengths), bases))
@@ -0,0 +1,204 @@
+import os
+import zlib
+
+import numpy as np
+
+# Compressed bytes read at a time when scanning or fetching.
+READ_SIZE = 1024 * 1024
+# Suffix of the index file written next to the reads.
+INDEX_SUFFIX = ".rdx.npy"
+
+
+class ReadIndex:
+    """
+    Random access to the reads of a fastq(.gz) file. Every read is recorded as (read ID, block offset, in-block
+    offset, length): the block offset is the compressed offset of the gzip member the read starts in (a BGZF block,
+    or a guppy chunk for concatenated files), the in-block offset its position in that member once decompressed.
+    For uncompressed files, the block offset is the position of the read and the in-block offset is 0.
+
+    The index is a numpy structured array sorted by read ID, saved next to the reads and memory-mapped when loaded,
+    so a lookup is a binary search and nothing is held in a python dict.
+    """
+
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self.compressed = path.endswith(".gz")
+
+    @staticmethod
+    def _gzip_stream(path):
+        """
+        Decompresses a (multi-member) gzip file.
+
+        :param path: (str) path to the gzip file
+        :return: generator of tuples (decompressed data, list of (compressed offset, decompressed offset) of the
+            members starting in that data)
+        """
+        position = 0  # compressed offset of the data given to the decompressor
+        produced = 0  # decompressed bytes so far
+        decompressor = None
+        with open(path, "rb") as ftr:
+            for block in iter(lambda: ftr.read(READ_SIZE), b""):
+                members = []
+                out = []
+                while block:
+                    if decompressor is None:
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        members.append((position, produced))
+                    data = decompressor.decompress(block)
+                    out.append(data)
+                    produced += len(data)
+                    if decompressor.eof:
+                        position += len(block) - len(decompressor.unused_data)
+                        block = decompressor.unused_data
+                        decompressor = None
+                    else:
+                        position += len(block)
+                        block = b""
+                yield b"".join(out), members
+
+    @staticmethod
+    def _plain_stream(path):
+        with open(path, "rb") as ftr:
+            for block in iter(lambda: ftr.read(READ_SIZE), b""):
+                yield block, []
+
+    @staticmethod
+    def build(path):
+        """
+        Scans the reads once and writes the index next to them.
+
+        :param path: (str) path to the fastq or fastq.gz file
+        :return: ReadIndex
+        """
+        ids, starts, lengths = [], [], []
+        member_offsets, member_starts = [], []
+        stream = ReadIndex._gzip_stream(path) if path.endswith(".gz") else ReadIndex._plain_stream(path)
+
+        carry = b""
+        carry_start = 0  # decompressed offset of carry
+        for data, members in stream:
+            for offset, start in members:
+                member_offsets.append(offset)
+                member_starts.append(start)
+            lines = (carry + data).split(b"\n")
+            complete = (len(lines) - 1) // 4 * 4  # the last element is a partial (or empty) line
+            position = carry_start
+            for i in range(0, complete, 4):
+                record = len(lines[i]) + len(lines[i + 1]) + len(lines[i + 2]) + len(lines[i + 3]) + 4
+                ids.append(lines[i][1:].split(None, 1)[0] if len(lines[i]) > 1 else b"")
+                starts.append(position)
+                lengths.append(record)
+                position += record
+            carry = b"\n".join(lines[complete:])
+            carry_start = position
+
+        starts = np.array(starts, dtype=np.uint64)
+        if path.endswith(".gz"):
+            member_offsets = np.array(member_offsets, dtype=np.uint64)
+            member_starts = np.array(member_starts, dtype=np.uint64)
+            member = np.searchsorted(member_starts, starts, side="right") - 1
+            blocks = member_offsets[member]
+            in_block = starts - member_starts[member]
+        else:
+            blocks = starts
+            in_block = np.zeros(len(starts), dtype=np.uint64)
+
+        width = max((len(i) for i in ids), default=1)
+        table = np.zeros(len(ids), dtype=[("id", "S{}".format(max(width, 1))), ("block", np.uint64),
+                                         ("offset", np.uint64), ("length", np.uint32)])
+        table["id"] = ids
+        table["block"] = blocks
+        table["offset"] = in_block
+        table["length"] = lengths
+        table.sort(order="id")
+        np.save(path + INDEX_SUFFIX, table)
+        return ReadIndex(path, table)
+
+    @staticmethod
+    def load(path):
+        """
+        :param path: (str) path to the indexed fastq(.gz) file
+        :return: ReadIndex, memory-mapped
+        """
+        return ReadIndex(path, np.load(path + INDEX_SUFFIX, mmap_mode="r"))
+
+    @staticmethod
+    def open(path):
+        """
+        Loads the index of the file, and builds it first if it is missing or older than the file.
+
+        :param path: (str) path to the fastq(.gz) file
+        :return: ReadIndex
+        """
+        index = path + INDEX_SUFFIX
+        if os.path.isfile(index) and os.stat(index).st_mtime >= os.stat(path).st_mtime:
+            return ReadIndex.load(path)
+        return ReadIndex.build(path)
+
+    def __len__(self):
+        return len(self.table)
+
+    def lookup(self, read_id):
+        """
+        :param read_id: (str or bytes) read ID, without the '@'
+        :return: row of the index, None if the read is not in the file
+        """
+        key = read_id.encode() if isinstance(read_id, str) else read_id
+        i = np.searchsorted(self.table["id"], key)
+        if i < len(self.table) and self.table["id"][i] == key:
+            return self.table[i]
+        return None
+
+    def _read(self, ftr, block, offset, length):
+        ftr.seek(block)
+        if not self.compressed:
+            return ftr.read(length)
+        out = bytearray()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while len(out) < offset + length:
+            data = ftr.read(READ_SIZE)
+            if not data:
+                break
+            while data and len(out) < offset + length:
+                out += decompressor.decompress(data)
+                if decompressor.eof:  # the read continues in the next member
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    data = b""
+        return bytes(out[offset:offset + length])
+
+    def fetch_rows(self, rows):
+        """
+        :param rows: rows of the index
+        :return: generator of fastq records (bytes), in file order
+        """
+        rows = np.sort(rows, order=["block", "offset"])
+        with open(self.path, "rb") as ftr:
+            for row in rows:
+                yield self._read(ftr, int(row["block"]), int(row["offset"]), int(row["length"]))
+
+    def fetch(self, read_ids):
+        """
+        :param read_ids: iterable of read IDs
+        :return: generator of the fastq records (bytes) of the reads found in the file, in file order
+        """
+        width = self.table["id"].dtype.itemsize
+        keys = [r.encode() if isinstance(r, str) else r for r in read_ids]
+        keys = np.array([k for k in keys if len(k) <= width], dtype=self.table["id"].dtype)
+        positions = np.searchsorted(self.table["id"], keys)
+        valid = positions < len(self.table)
+        positions, keys = positions[valid], keys[valid]
+        found = positions[self.table["id"][positions] == keys]
+        return self.fetch_rows(self.table[np.unique(found)])
+
+    def sample(self, count, seed=None):
+        """
+        :param count: (int) number of reads
+        :param seed: (int) seed of the random generator, for a reproducible subsample
+        :return: generator of the fastq records (bytes) of count random reads, in file order
+        """
+        rng = np.random.default_rng(seed)
+        chosen = rng.choice(len(self.table), size=min(int(count), len(self.table)), replace=False)
+        return self.fetch_rows(self.table[np.sort(chosen)])
@@ -0,0 +1,201 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import fastx
+
+# Probability of error for each phred score (offset 33 already removed).
+ERROR_PROBABILITY = 10 ** (-np.arange(94, dtype=np.float64) / 10)
+# Mean read qualities are histogrammed in bins of 0.1 phred, from 0 to 60.
+QUALITY_RESOLUTION = 10
+QUALITY_MAX = 60
+# Log-spaced read length bins used for the reported length histogram.
+LENGTH_EDGES = np.unique(np.round(np.logspace(0, 7, 71)).astype(np.int64))
+
+
+def block_stats(lines):
+    """
+    Read lengths and mean qualities of a block of fastq records, computed on the whole block at once.
+    The mean quality of a read is the phred score of its mean error probability.
+
+    :param lines: list of fastq lines, as produced by fastx.fastq_blocks
+    :return: tuple (lengths, qualities) of numpy arrays, one entry per read
+    """
+    seqs = lines[1::4]
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    scores = np.frombuffer(b"".join(lines[3::4]), dtype=np.uint8).astype(np.intp) - 33
+    errors = ERROR_PROBABILITY[np.clip(scores, 0, len(ERROR_PROBABILITY) - 1)]
+
+    qualities = np.zeros(len(lengths), dtype=np.float64)
+    non_empty = lengths > 0
+    if errors.size:
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        sums = np.add.reduceat(errors, starts[non_empty])
+        qualities[non_empty] = -10 * np.log10(np.maximum(sums / lengths[non_empty], 1e-10))
+    return lengths, qualities
+
+
+class ReadStats:
+    """
+    Summary of a read set, kept in bounded memory: reads are only stored as a count per read length and a count per
+    mean quality bin, whatever the number of reads.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.length_counts = np.zeros(1, dtype=np.int64)  # number of reads of each length
+        self.quality_counts = np.zeros(QUALITY_MAX * QUALITY_RESOLUTION + 1, dtype=np.int64)
+        self.quality_sum = 0.0  # sum of the mean qualities of all reads
+
+    def add(self, lengths, qualities):
+        """
+        Adds the reads of one block.
+
+        :param lengths: numpy array of read lengths
+        :param qualities: numpy array of mean read qualities
+        :return: None
+        """
+        if not len(lengths):
+            return
+        counts = np.bincount(lengths)
+        if len(counts) > len(self.length_counts):
+            counts[:len(self.length_counts)] += self.length_counts
+            self.length_counts = counts
+        else:
+            self.length_counts[:len(counts)] += counts
+        bins = np.clip(np.round(qualities * QUALITY_RESOLUTION).astype(np.intp), 0, len(self.quality_counts) - 1)
+        self.quality_counts += np.bincount(bins, minlength=len(self.quality_counts))
+        self.quality_sum += float(qualities.sum())
+
+    def merge(self, other):
+        """
+        :param other: ReadStats of another read set
+        :return: ReadStats of both read sets
+        """
+        merged = ReadStats(self.name)
+        merged.length_counts = np.zeros(max(len(self.length_counts), len(other.length_counts)), dtype=np.int64)
+        merged.length_counts[:len(self.length_counts)] += self.length_counts
+        merged.length_counts[:len(other.length_counts)] += other.length_counts
+        merged.quality_counts = self.quality_counts + other.quality_counts
+        merged.quality_sum = self.quality_sum + other.quality_sum
+        return merged
+
+    @staticmethod
+    def from_fastq(path, block_size=fastx.BLOCK_SIZE):
+        """
+        :param path: (str) path to a fastq or fastq.gz file
+        :param block_size: (int) decompressed bytes parsed at a time
+        :return: ReadStats of the file
+        """
+        stats = ReadStats(path)
+        for lines in fastx.fastq_blocks(path, block_size):
+            stats.add(*block_stats(lines))
+        return stats
+
+    @staticmethod
+    def from_files(paths, processes=None):
+        """
+        Computes the statistics of several files, one file per process.
+
+        :param paths: list of fastq(.gz) paths
+        :param processes: (int) number of processes, defaults to the number of available cores
+        :return: dictionary {path: ReadStats}
+        """
+        processes = processes if processes else len(os.sched_getaffinity(0))
+        with ProcessPoolExecutor(max_workers=max(1, min(processes, len(paths)))) as pool:
+            return dict(zip(paths, pool.map(ReadStats.from_fastq, paths)))
+
+    @property
+    def reads(self):
+        return int(self.length_counts.sum())
+
+    @property
+    def bases(self):
+        return int(np.dot(np.arange(len(self.length_counts)), self.length_counts))
+
+    def bases_above(self):
+        """
+        :return: numpy array, for each length L, the number of bases in reads of length L or more
+        """
+        return np.cumsum((np.arange(len(self.length_counts)) * self.length_counts)[::-1])[::-1]
+
+    def n50(self):
+        """
+        :return: (int) length L such that reads of length L or more hold half of the bases
+        """
+        if not self.bases:
+            return 0
+        return int(np.nonzero(self.bases_above() >= self.bases / 2)[0][-1])
+
+    def mean_quality(self):
+        return self.quality_sum / self.reads if self.reads else 0.0
+
+    def coverage(self, genome_size):
+        """
+        :param genome_size: (int) estimated genome size
+        :return: (float) estimated coverage
+        """
+        return self.bases / int(genome_size) if genome_size else None
+
+    def length_histogram(self):
+        """
+        :return: list of tuples (bin start, bin end, number of reads), on log-spaced bins
+        """
+        counts, _ = np.histogram(np.arange(len(self.length_counts)), bins=LENGTH_EDGES, weights=self.length_counts)
+        return [(int(LENGTH_EDGES[i]), int(LENGTH_EDGES[i + 1]), int(c)) for i, c in enumerate(counts) if c]
+
+    def quality_histogram(self):
+        """
+        :return: list of tuples (mean quality, number of reads), one per integer phred score
+        """
+        whole = np.add.reduceat(self.quality_counts, np.arange(0, len(self.quality_counts), QUALITY_RESOLUTION))
+        return [(q, int(c)) for q, c in enumerate(whole) if c]
+
+    def suggest_min_length(self, genome_size, coverage, floor=500):
+        """
+        Longest minimum read length that still keeps the requested coverage.
+
+        :param genome_size: (int) estimated genome size
+        :param coverage: (float) coverage that should be left after the length cut-off
+        :param floor: (int) the suggestion is never below this length
+        :return: (int) minimum read length, rounded down to the hundred
+        """
+        if not genome_size or not self.bases:
+            return floor
+        keep = np.nonzero(self.bases_above() >= int(genome_size) * coverage)[0]
+        if not len(keep):
+            return floor
+        return max(floor, int(keep[-1]) // 100 * 100)
+
+    def summary(self, genome_size=None):
+        """
+        :param genome_size: (int) estimated genome size, to report the coverage
+        :return: dictionary with the main statistics of the read set
+        """
+        lengths = np.nonzero(self.length_counts)[0]
+        return {"file": self.name,
+                "reads": self.reads,
+                "bases": self.bases,
+                "n50": self.n50(),
+                "mean_length": self.bases / self.reads if self.reads else 0,
+                "max_length": int(lengths[-1]) if len(lengths) else 0,
+                "mean_quality": round(self.mean_quality(), 2),
+                "coverage": self.coverage(genome_size)}
+
+    def report(self, genome_size=None):
+        """
+        Prints the statistics and histograms of the read set.
+
+        :param genome_size: (int) estimated genome size, to report the coverage
+        :return: None
+        """
+        for k, v in self.summary(genome_size).items():
+            if v is not None:
+                print("{}: {}".format(k, round(v, 2) if isinstance(v, float) else v))
+        print("length histogram:")
+        for start, end, count in self.length_histogram():
+            print("  {}-{}\t{}".format(start, end - 1, count))
+        print("mean quality histogram:")
+        for q, count in self.quality_histogram():
+            print("  Q{}\t{}".format(q, count))
@@ -1,5 +1,7 @@
 import argparse
 import Assembler
+import staging
+import telemetry
 
 parser = argparse.ArgumentParser(description="RIGHT NOW: Will take an input directory and convert all the \
 fasta files either within the directory or within its subdirectories.\n All outputs will be put in the directories where their reads belong.")
@@ -9,17 +11,71 @@ parser.add_argument("-longreads",
                     dest="long", help="Path to directory with all reads.", required=False)
 parser.add_argument("-minreads",
                     metavar="READ CUTOFF", type=str,
-                    dest="minr", help= "Minimum required read length", default=False, required=True)
+                    dest="minr", help= "Minimum required read length, or auto to choose it from the read statistics (requires -genomesize)", default=False, required=True)
 parser.add_argument("-shortreads",
                     metavar="illumina_path", type=str,
-                    dest="sr", help="Directory containing all short reads in fastq.gz files.", required=Fase)
+                    dest="sr", help="Directory containing all short reads in fastq.gz files.", required=False)
 parser.add_argument("-assembly_type",
                     metavar="[contig, long, short]", required=True,
                     type=str, dest="type", help="Contig corresponds to hybrid assembly, long to long read assembly, and short to read read assembly.")
-
+parser.add_argument("-direct",
+                    metavar="[fifo, temp]", choices=["fifo", "temp"], default=None,
+                    type=str, dest="direct", help="Stream long reads into shasta through a named pipe (fifo) or a temporary file (temp) instead of writing a fasta file next to the reads.")
+parser.add_argument("-fasta_level",
+                    metavar="LEVEL", type=int, default=None,
+                    dest="fasta_level", help="Write the converted long reads as BGZF-compressed fasta (.fasta.gz) with this compression level. They are decompressed on the fly for shasta.")
+parser.add_argument("-genomesize",
+                    metavar="NUM", type=int, default=None,
+                    dest="genomesize", help="Estimated genome size, used with -minreads auto and -depth.")
+parser.add_argument("-depth",
+                    metavar="X", type=float, default=None,
+                    dest="depth", help="Subsample the long reads and the short read pairs to this coverage of -genomesize before assembly, favouring longer and better reads. Default: use every read.")
+parser.add_argument("-jobs",
+                    metavar="INT", type=int, default=1,
+                    dest="jobs", help="Number of samples assembled at the same time. Default 1.")
+parser.add_argument("-threads",
+                    metavar="INT", type=int, default=None,
+                    dest="threads", help="Threads shared by all running assemblies. Default: all available cores.")
+parser.add_argument("-memory",
+                    metavar="GB", type=int, default=None,
+                    dest="memory", help="Memory (GB) shared by all running assemblies. Default: all of the node's memory.")
+parser.add_argument("-cache",
+                    metavar="PATH", type=str, default=None,
+                    dest="cache", help="Directory caching assembly results, so reruns skip assemblies already done.")
+parser.add_argument("-cache_size",
+                    metavar="GB", type=float, default=None,
+                    dest="cache_size", help="Maximum size of the cache directory, least recently used results are evicted first.")
+parser.add_argument("-sample_pattern",
+                    metavar="REGEX", type=str, default=None,
+                    dest="sample_pattern", help="Regular expression matched at the start of read file names, with a named group sample (and optionally read). Default: the name up to the first _ or .")
+parser.add_argument("-sample_cache",
+                    metavar="PATH", type=str, default=None,
+                    dest="sample_cache", help="JSON file caching the directory listings and the sample table, so later steps only rescan directories that changed.")
+parser.add_argument("-scratch",
+                    metavar="PATH", type=str, default=None,
+                    dest="scratch", help="Node-local scratch directory (local disk or tmpfs): tools run there on copies of their inputs and only their final outputs are moved back. Stages without enough free space run in place.")
+parser.add_argument("-scratch_reserve",
+                    metavar="GB", type=float, default=1,
+                    dest="scratch_reserve", help="Free space (GB) always left on the scratch file system. Default 1.")
+parser.add_argument("-check_pairs",
+                    metavar="[warn, repair]", choices=["warn", "repair"], default=None,
+                    dest="check_pairs", help="Compare MinHash sketches of the long and short reads of every sample, warn when long reads match another sample's short reads better than their own, and with repair re-pair them before assembly.")
+parser.add_argument("-sketch_cache",
+                    metavar="PATH", type=str, default=None,
+                    dest="sketch_cache", help="JSON file caching the sketches of the read files for -check_pairs, so unchanged files are not sketched again.")
+parser.add_argument("-samples",
+                    metavar="NAME", nargs="+", default=None,
+                    dest="samples", help="Only process these samples (names as found by the sample table). Used by the work queue workers to run one sample per task. Default: every sample.")
+parser.add_argument("-trace",
+                    metavar="PATH", type=str, default=None,
+                    dest="trace", help="Append the wall time, cpu time, peak RSS and I/O of every tool run to this JSONL file, and print a summary of the top consumers at the end.")
 
 args = parser.parse_args()
+telemetry.configure(args.trace)
+staging.configure(args.scratch, args.scratch_reserve)
 directory = Assembler.AssemblyCall(args)
 
 directory.fasta_files()
 directory.assembly()
+if args.trace:
+    telemetry.summary(args.trace)
@@ -1,4 +1,6 @@
 import filtering
+import staging
+import telemetry
 import argparse
 
 parser = argparse.ArgumentParser(description="Providing long reads or short reads, filters reads for quality.")
@@ -7,8 +9,25 @@ parser.add_argument("-shortreads", metavar="DIR PATH", dest="SR", type=str, help
 parser.add_argument("-genomesize", metavar="NUM", dest="genomesize", help="Use integer values for size of genome.", default=False)
 parser.add_argument("-filter", action="store_true", default=False, dest="shortreads", help="Specify if short reads should be filtered with bbduk before acting as a reference for Filtlong.")
 parser.add_argument("-minlen", metavar="NUM", dest="minlen", help="For Filtlong only: minimum length of reads to filter.")
+parser.add_argument("-auto", action="store_true", default=False, dest="auto", help="Report read statistics, and choose -minlen from them when it is not given (requires -genomesize).")
+parser.add_argument("-engine", metavar="[filtlong, native]", dest="engine", choices=["filtlong", "native"], default="filtlong", help="Long read filter: filtlong, or native for the built-in two-pass filter that streams its output to disk. Default filtlong.")
+parser.add_argument("-trimmer", metavar="[porechop, native]", dest="trimmer", choices=["porechop", "native"], default="porechop", help="Adapter trimmer: porechop, or native for the built-in k-mer trimmer running on all cores. With the native engine, its trimmed reads are streamed into the filter without an intermediate file. Default porechop.")
+parser.add_argument("-cache", metavar="DIR PATH", dest="cache", default=None, help="Directory caching filtering results, so reruns skip samples already filtered.")
+parser.add_argument("-cache_size", metavar="GB", dest="cache_size", default=None, help="Maximum size of the cache directory, least recently used results are evicted first.")
+parser.add_argument("-sample_pattern", metavar="REGEX", dest="sample_pattern", default=None, help="Regular expression matched at the start of read file names, with a named group sample (and optionally read). Default: the name up to the first _ or .")
+parser.add_argument("-sample_cache", metavar="PATH", dest="sample_cache", default=None, help="JSON file caching the directory listings and the sample table, so later steps only rescan directories that changed.")
+parser.add_argument("-scratch", metavar="DIR PATH", dest="scratch", default=None, help="Node-local scratch directory (local disk or tmpfs): tools run there on copies of their inputs and only their final outputs are moved back. Stages without enough free space run in place.")
+parser.add_argument("-scratch_reserve", metavar="GB", type=float, dest="scratch_reserve", default=1, help="Free space (GB) always left on the scratch file system. Default 1.")
+parser.add_argument("-check_pairs", metavar="[warn, repair]", dest="check_pairs", choices=["warn", "repair"], default=None, help="Compare MinHash sketches of the long and short reads of every sample, warn when long reads match another sample's short reads better than their own, and with repair re-pair them before filtering.")
+parser.add_argument("-sketch_cache", metavar="PATH", dest="sketch_cache", default=None, help="JSON file caching the sketches of the read files for -check_pairs, so unchanged files are not sketched again.")
+parser.add_argument("-samples", metavar="NAME", nargs="+", dest="samples", default=None, help="Only process these samples (names as found by the sample table). Used by the work queue workers to run one sample per task. Default: every sample.")
+parser.add_argument("-trace", metavar="PATH", dest="trace", default=None, help="Append the wall time, cpu time, peak RSS and I/O of every tool run to this JSONL file, and print a summary of the top consumers at the end.")
 
 args = parser.parse_args()
+telemetry.configure(args.trace)
+staging.configure(args.scratch, args.scratch_reserve)
 
 process = filtering.FilteringInput(args)
 process.filtering()
+if args.trace:
+    telemetry.summary(args.trace)
@@ -0,0 +1,192 @@
+import argparse
+import os
+import shlex
+import sys
+
+import minhash
+import staging
+import telemetry
+import scheduler
+import polisher
+from Assembler import AssemblySample, FastqFasta
+from cache import ResultCache
+from dag import StageGraph
+from discovery import SampleTable
+from planner import Planner
+from filtering import FilteringSample
+
+parser = argparse.ArgumentParser(description="Runs basecalling, filtering, assembly and polishing of every sample as a dependency graph: each sample moves to its next stage as soon as its previous one is done, without waiting for the others.")
+parser.add_argument("-fast5", metavar="DIR PATH", nargs="+", dest="fast5", default=None, help="Fast5 directories of sequencing runs to basecall with GuppyClass.py first. The barcodes of a run go on to filtering as soon as the run is basecalled, while the next run uses the GPU.")
+parser.add_argument("-guppy", metavar="ARGS", dest="guppy", default="", help="Arguments of GuppyClass.py for -fast5 (-flowcell, -kit, -barcodekit...), in quotes.")
+parser.add_argument("-basecall_output", metavar="DIR PATH", dest="basecall_output", default=None, help="Directory the runs are basecalled in, one <run> directory each. Required with -fast5.")
+parser.add_argument("-longreads", metavar="DIR PATH", type=str, dest="long", default=None, help="Directory with the basecalled long reads, one fastq(.gz) per sample.")
+parser.add_argument("-shortreads", metavar="DIR PATH", type=str, dest="sr", default=None, help="Directory with the Illumina R1/R2 reads.")
+parser.add_argument("-assembly_type", metavar="[contig, long, short]", choices=["contig", "long", "short"], required=True, type=str, dest="type", help="Contig for hybrid assembly, long for long read assembly, and short for short read assembly.")
+parser.add_argument("-minreads", metavar="READ CUTOFF", type=str, dest="minr", default="1000", help="Shasta minimum read length. Default 1000.")
+parser.add_argument("-minlen", metavar="NUM", type=str, dest="minlen", default="1000", help="Filtlong minimum read length. Default 1000.")
+parser.add_argument("-genomesize", metavar="NUM", type=int, dest="genomesize", default=None, help="Genome size, for the filtlong target bases.")
+parser.add_argument("-depth", metavar="X", type=float, default=None, dest="depth", help="Subsample the reads to this coverage of -genomesize before assembly. Default: use every read.")
+parser.add_argument("-engine", metavar="[filtlong, native]", choices=["filtlong", "native"], default="filtlong", dest="engine", help="Long read filter. Default filtlong.")
+parser.add_argument("-trimmer", metavar="[porechop, native]", choices=["porechop", "native"], default="porechop", dest="trimmer", help="Long read adapter trimmer. Default porechop.")
+parser.add_argument("-filter", action="store_true", default=False, dest="shortreads", help="Trim the short reads with bbduk before using them.")
+parser.add_argument("-direct", metavar="[fifo, temp]", choices=["fifo", "temp"], default=None, type=str, dest="direct", help="Stream long reads into shasta instead of writing a fasta file next to them.")
+parser.add_argument("-fasta_level", metavar="LEVEL", type=int, default=None, dest="fasta_level", help="Write the fasta made for shasta as BGZF with this compression level.")
+parser.add_argument("-sharded", metavar="JOBS", type=int, dest="sharded", default=0, help="Only re-polish the contigs pilon still changes, with JOBS per-contig pilon in parallel.")
+parser.add_argument("-medaka_jobs", metavar="JOBS", type=int, dest="medaka_jobs", default=0, help="Run JOBS medaka consensus in parallel on contig batches, after a single alignment.")
+parser.add_argument("-converge", metavar="CHANGES", type=int, dest="converge", default=None, help="Stop polishing with pilon once a round makes at most CHANGES changes.")
+parser.add_argument("-basecall_jobs", metavar="INT", type=int, default=1, dest="basecall_jobs", help="Runs basecalled at the same time. Default 1.")
+parser.add_argument("-filter_jobs", metavar="INT", type=int, default=2, dest="filter_jobs", help="Samples filtered at the same time. Default 2.")
+parser.add_argument("-assembly_jobs", metavar="INT", type=int, default=1, dest="assembly_jobs", help="Samples assembled at the same time. Default 1.")
+parser.add_argument("-polish_jobs", metavar="INT", type=int, default=1, dest="polish_jobs", help="Samples polished at the same time. Default 1.")
+parser.add_argument("-threads", metavar="INT", type=int, default=None, dest="threads", help="Threads shared by the running assemblies. Default: all available cores.")
+parser.add_argument("-memory", metavar="GB", type=int, default=None, dest="memory", help="Memory (GB) shared by the running assemblies. Default: all of the node's memory.")
+parser.add_argument("-cache", metavar="PATH", type=str, default=None, dest="cache", help="Directory caching the results of every stage, so reruns skip the work already done.")
+parser.add_argument("-cache_size", metavar="GB", type=float, default=None, dest="cache_size", help="Maximum size of the cache directory, least recently used results are evicted first.")
+parser.add_argument("-sample_pattern", metavar="REGEX", type=str, default=None, dest="sample_pattern", help="Regular expression matched at the start of read file names, with a named group sample (and optionally read).")
+parser.add_argument("-sample_cache", metavar="PATH", type=str, default=None, dest="sample_cache", help="JSON file caching the directory listings and the sample table.")
+parser.add_argument("-scratch", metavar="PATH", type=str, default=None, dest="scratch", help="Node-local scratch directory (local disk or tmpfs): tools run there on copies of their inputs and only their final outputs are moved back. Stages without enough free space run in place.")
+parser.add_argument("-scratch_reserve", metavar="GB", type=float, default=1, dest="scratch_reserve", help="Free space (GB) always left on the scratch file system. Default 1.")
+parser.add_argument("-check_pairs", metavar="[warn, repair]", choices=["warn", "repair"], default=None, dest="check_pairs", help="Compare MinHash sketches of the long and short reads of every sample, warn when long reads match another sample's short reads better than their own, and with repair re-pair them.")
+parser.add_argument("-sketch_cache", metavar="PATH", type=str, default=None, dest="sketch_cache", help="JSON file caching the sketches of the read files for -check_pairs.")
+parser.add_argument("-trace", metavar="PATH", type=str, default=None, dest="trace", help="Append the resource usage of every tool run to this JSONL file, and print a summary at the end.")
+args = parser.parse_args()
+if args.fast5 and not args.basecall_output:
+    parser.error("-fast5 needs -basecall_output.")
+if args.fast5 and args.type == "short":
+    parser.error("-fast5 basecalls long reads, which short read assemblies do not use.")
+telemetry.configure(args.trace)
+staging.configure(args.scratch, args.scratch_reserve)
+
+cache = ResultCache(args.cache, args.cache_size) if args.cache else None
+budget = scheduler.ResourceBudget(args.threads, args.memory)
+# tools are sized from their inputs, within the share of the node of each concurrent job of their stage
+assembly_planner = Planner(budget.threads, budget.memory, args.assembly_jobs)
+polish_planner = Planner(budget.threads, budget.memory, args.polish_jobs)
+table = SampleTable(args.sample_pattern, args.sample_cache)
+if args.long:
+    table.add_long_reads(args.long)
+if args.sr:
+    table.add_short_reads(args.sr)
+if args.check_pairs and args.long and args.sr:
+    minhash.check_pairs(table.samples, args.check_pairs, minhash.SketchCache(args.sketch_cache))
+table.save()
+
+
+def filter_reads(name, entry):
+    """
+    Filters the long reads of the sample (and trims its short reads first with -filter).
+    """
+    sample = FilteringSample(name)
+    sample.longread = entry["longread"]
+    sample.sr1, sample.sr2 = entry["r1"], entry["r2"]
+    sample.minlen = args.minlen
+    sample.genomesize = args.genomesize
+    sample.engine = args.engine
+    sample.trimmer = args.trimmer
+    sample.cache = cache
+    if args.shortreads and sample.sr1 and sample.sr2:
+        sample.bbduk()
+        entry["r1"], entry["r2"] = sample.sr1, sample.sr2
+    if sample.longread:
+        sample.filtlong()
+
+
+def assemble(name, entry):
+    """
+    Assembles the filtered reads of the sample, in its own assembly_<sample> directory next to them.
+    """
+    sample = AssemblySample(args)
+    sample.name = name
+    sample.r1, sample.r2 = entry["r1"], entry["r2"]
+    sample.budget = budget
+    sample.exclusive = False
+    sample.cache = cache
+    sample.planner = assembly_planner
+    if args.type != "short":
+        filtered = "{}/filtered_{}".format(os.path.dirname(entry["longread"]), name)
+        entry["dir"] = "{}/assembly_{}".format(os.path.dirname(entry["longread"]), name)
+        os.makedirs(entry["dir"], exist_ok=True)
+        sample.longread = entry["dir"]
+        sample.fasta = "{}/assembly_{}.fasta".format(entry["dir"], name)
+        if args.direct:
+            sample.fastq = filtered  # streamed into shasta, no fasta is written
+        else:
+            sample.fasta = FastqFasta.fasta_file(filtered, sample.fasta, args.fasta_level, sample.target_bases)
+    entry["assembly"] = sample.assembly_run()
+
+
+def polish(name, entry):
+    """
+    Polishes the assembly of the sample: pilon with short reads, medaka otherwise.
+    """
+    sample = polisher.Sample(name)
+    sample.sr1, sample.sr2 = entry["r1"], entry["r2"]
+    sample.cache = cache
+    sample.sharded = args.sharded
+    sample.medaka_jobs = args.medaka_jobs
+    sample.planner = polish_planner
+    sample.converge = args.converge
+    if args.type == "short":
+        sample.short = entry["assembly"]  # skesa moves it to the directory of the sample when there is one
+        sample.dir = os.path.dirname(entry["assembly"])
+    else:
+        sample.dir = entry["dir"]
+        sample.lr = "{}/filtered_{}".format(os.path.dirname(entry["longread"]), name)
+        found = SampleTable()
+        assembler, assembly = found.assembly(sample.dir, found.listing(sample.dir)[1])
+        if assembler in ("spades", "skesa"):
+            sample.short = assembly
+        else:
+            sample.long = assembly
+    sample.polishing()
+
+
+def basecall(run, output):
+    """
+    Basecalls a sequencing run with GuppyClass.py (guppy, barcode renaming and concatenation), then adds the stages
+    of each of its barcodes to the graph. With several runs, samples are named <run>_<barcode>, and short reads are
+    still found by barcode (or -rosetta) name.
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "GuppyClass.py")] + \
+        shlex.split(args.guppy) + ["-fast5", run, "-output", output]
+    telemetry.run(command, stage="basecall", check=True)
+    found = SampleTable(args.sample_pattern)
+    pass_dir = os.path.join(output, "pass")
+    barcodes = [d for d in found.listing(pass_dir)[1] if d != "unclassified"]
+    for barcode in barcodes:
+        found.add_long_reads(os.path.join(pass_dir, barcode))
+    if not barcodes:
+        found.add_long_reads(pass_dir)  # without barcoding, the whole run is one sample
+    for barcode, entry in sorted(found.samples.items()):
+        short = table.samples.get(barcode, {})
+        entry["r1"], entry["r2"] = short.get("r1"), short.get("r2")
+        add_sample("{}_{}".format(os.path.basename(run), barcode) if len(args.fast5) > 1 else barcode, entry)
+
+
+def add_sample(name, entry):
+    """
+    Adds the filter, assembly and polish stages of a sample to the graph.
+    """
+    if args.type == "short" and not (entry["r1"] and entry["r2"]):
+        return
+    if args.type != "short" and not entry["longread"]:
+        return
+    filtered = graph.add(name, "filter", lambda: filter_reads(name, entry))
+    assembled = graph.add(name, "assembly", lambda: assemble(name, entry), after=[filtered])
+    graph.add(name, "polish", lambda: polish(name, entry), after=[assembled])
+
+
+graph = StageGraph({"basecall": args.basecall_jobs, "filter": args.filter_jobs, "assembly": args.assembly_jobs,
+                    "polish": args.polish_jobs})
+for run in args.fast5 if args.fast5 else []:
+    run = run.rstrip("/")
+    graph.add(os.path.basename(run), "basecall",
+              lambda r=run: basecall(r, os.path.join(args.basecall_output, os.path.basename(r))))
+for name, entry in sorted(table.samples.items()):
+    add_sample(name, entry)
+
+graph.wait()
+failed = graph.summary()
+if args.trace:
+    telemetry.summary(args.trace)
+sys.exit(1 if failed else 0)
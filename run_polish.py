@@ -1,5 +1,7 @@
 import argparse
 import polisher
+import staging
+import telemetry
 
 parser = argparse.ArgumentParser(description="Assumes that corresponding assembly script was used for assembly of the genome. Polishing done with either short or long reads.")
 
@@ -7,7 +9,33 @@ parser.add_argument("-illumina ", metavar='PATH',
                     type=str, dest="shortdir", help='Directory with all short reads.')
 parser.add_argument("-minion", metavar="PATH",
                     type=str, dest="longdir", help="Directory with output(s) from Assembly.py")
+parser.add_argument("-cache", metavar="PATH",
+                    type=str, dest="cache", default=None, help="Directory caching polishing rounds, so reruns resume where they stopped.")
+parser.add_argument("-cache_size", metavar="GB",
+                    type=float, dest="cache_size", default=None, help="Maximum size of the cache directory, least recently used results are evicted first.")
+parser.add_argument("-sharded", metavar="JOBS",
+                    type=int, dest="sharded", default=0, help="After the first pilon round, only re-polish the contigs that still change, with JOBS per-contig pilon in parallel.")
+parser.add_argument("-medaka_jobs", metavar="JOBS",
+                    type=int, dest="medaka_jobs", default=0, help="Split the draft into contig batches and run JOBS medaka consensus in parallel, after a single alignment.")
+parser.add_argument("-converge", metavar="CHANGES",
+                    type=int, dest="converge", default=None, help="Stop polishing with pilon once a round makes at most CHANGES changes and leaves the contig count, length and N50 (almost) unchanged, instead of waiting for a round without changes.")
+parser.add_argument("-sample_pattern", metavar="REGEX",
+                    type=str, dest="sample_pattern", default=None, help="Regular expression matched at the start of read file names, with a named group sample (and optionally read). Default: the name up to the first _ or .")
+parser.add_argument("-sample_cache", metavar="PATH",
+                    type=str, dest="sample_cache", default=None, help="JSON file caching the directory listings and the sample table, so later steps only rescan directories that changed.")
+parser.add_argument("-scratch", metavar="PATH",
+                    type=str, dest="scratch", default=None, help="Node-local scratch directory (local disk or tmpfs): tools run there on copies of their inputs and only their final outputs are moved back. Stages without enough free space run in place.")
+parser.add_argument("-scratch_reserve", metavar="GB",
+                    type=float, dest="scratch_reserve", default=1, help="Free space (GB) always left on the scratch file system. Default 1.")
+parser.add_argument("-samples", metavar="NAME",
+                    nargs="+", dest="samples", default=None, help="Only process these samples (names as found by the sample table). Used by the work queue workers to run one sample per task. Default: every sample.")
+parser.add_argument("-trace", metavar="PATH",
+                    type=str, dest="trace", default=None, help="Append the wall time, cpu time, peak RSS and I/O of every tool run to this JSONL file, and print a summary of the top consumers at the end.")
 args = parser.parse_args()
+telemetry.configure(args.trace)
+staging.configure(args.scratch, args.scratch_reserve)
 
-assmb = polish_run.InputArg(args)
+assmb = polisher.InputArg(args)
 assmb.run_polishing()
+if args.trace:
+    telemetry.summary(args.trace)
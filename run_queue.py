@@ -0,0 +1,50 @@
+import argparse
+import os
+import shlex
+import sys
+
+from discovery import SampleTable
+from workqueue import WorkQueue
+
+# Stages a sample goes through, in order, with the entry point each task runs for one sample (-samples).
+STAGES = (("filter", "run_filtering.py"), ("assembly", "run_assembly.py"), ("polish", "run_polish.py"))
+
+parser = argparse.ArgumentParser(description="Fills a work queue on the shared run directory with one task per sample and stage, so that workers (run_worker.py) on any number of nodes can drain the batch together. Each task runs the stage's entry point on its sample only, once the previous stage of the same sample is done.")
+parser.add_argument("-queue", metavar="DIR PATH", dest="queue", required=True, help="Queue directory, on the shared run directory.")
+parser.add_argument("-longreads", metavar="DIR PATH", dest="long", default=None, help="Directory with the basecalled long reads, one fastq(.gz) per sample. Samples are found in it.")
+parser.add_argument("-shortreads", metavar="DIR PATH", dest="sr", default=None, help="Directory with the Illumina R1/R2 reads. Samples are found in it too.")
+parser.add_argument("-sample_pattern", metavar="REGEX", dest="sample_pattern", default=None, help="Regular expression matched at the start of read file names, with a named group sample (and optionally read).")
+parser.add_argument("-filter", metavar="ARGS", dest="filter", default=None, help="Arguments of run_filtering.py, in quotes. Without it, there is no filtering task.")
+parser.add_argument("-assembly", metavar="ARGS", dest="assembly", default=None, help="Arguments of run_assembly.py, in quotes. Without it, there is no assembly task.")
+parser.add_argument("-polish", metavar="ARGS", dest="polish", default=None, help="Arguments of run_polish.py, in quotes. Without it, there is no polishing task.")
+parser.add_argument("-status", action="store_true", default=False, dest="status", help="Only print the progress of the queue.")
+parser.add_argument("-retry", action="store_true", default=False, dest="retry", help="Requeue the failed tasks (and the ones skipped because of them).")
+args = parser.parse_args()
+
+queue = WorkQueue(args.queue)
+if args.retry:
+    print("{} tasks requeued.".format(queue.reset()))
+if args.status or args.retry:
+    queue.status()
+    sys.exit(0)
+
+table = SampleTable(args.sample_pattern)
+if args.long:
+    table.add_long_reads(args.long)
+if args.sr:
+    table.add_short_reads(args.sr)
+if not table.samples:
+    sys.exit("No samples found, give -longreads and/or -shortreads.")
+
+here = os.path.dirname(os.path.abspath(__file__))
+stages = [(stage, script, getattr(args, stage)) for stage, script in STAGES if getattr(args, stage) is not None]
+if not stages:
+    sys.exit("No stage to run, give -filter, -assembly and/or -polish.")
+for name in sorted(table.samples):
+    after = []
+    for stage, script, arguments in stages:
+        command = [sys.executable, os.path.join(here, script)] + shlex.split(arguments) + ["-samples", name]
+        after = [queue.add(name, stage, command, after)]
+print("{} tasks queued for {} samples in {}.".format(len(table.samples) * len(stages), len(table.samples),
+                                                      args.queue))
+queue.status()
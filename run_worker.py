@@ -0,0 +1,102 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import time
+
+import telemetry
+from workqueue import WorkQueue, LEASE
+
+parser = argparse.ArgumentParser(description="Drains a work queue made by run_queue.py: claims one task at a time, runs it, and keeps its lease alive with heartbeats. Start any number of workers on any number of nodes sharing the queue directory; the tasks of a worker that dies are requeued once its lease expires.")
+parser.add_argument("-queue", metavar="DIR PATH", dest="queue", required=True, help="Queue directory, on the shared run directory.")
+parser.add_argument("-workers", metavar="INT", type=int, dest="workers", default=1, help="Workers started on this node. Default 1.")
+parser.add_argument("-lease", metavar="SECONDS", type=int, dest="lease", default=LEASE, help="Seconds a task stays claimed without a heartbeat before it is requeued. Default {}.".format(LEASE))
+parser.add_argument("-heartbeat", metavar="SECONDS", type=float, dest="heartbeat", default=None, help="Seconds between two heartbeats. Default: a fifth of -lease.")
+parser.add_argument("-poll", metavar="SECONDS", type=float, dest="poll", default=30, help="Seconds between two looks for work while every remaining task waits for others. Default 30.")
+parser.add_argument("-wait", action="store_true", default=False, dest="wait", help="Keep waiting for new tasks once the queue is drained, instead of exiting.")
+parser.add_argument("-trace", metavar="PATH", dest="trace", default=None, help="Append the wall time, cpu time, peak RSS and I/O of every task to this JSONL file.")
+args = parser.parse_args()
+telemetry.configure(args.trace)
+heartbeat = args.heartbeat if args.heartbeat else args.lease / 5
+
+
+def stop(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def run_task(queue, lease):
+    """
+    Runs the command of a claimed task in its own process group, with a heartbeat every -heartbeat seconds. The
+    command is killed if the lease is lost (the worker stalled and another one took the task over).
+
+    :return: None
+    """
+    task = lease.task
+    print("{}: running {} (attempt {}).".format(lease.worker, task["id"], lease.attempt))
+    start = time.time()
+    with open(queue.log_path(task["id"], lease.attempt), "w") as log:
+        monitor = telemetry.start(task["command"], task["stage"], task["sample"], cwd=task["cwd"], stdout=log,
+                                  stderr=subprocess.STDOUT, start_new_session=True)
+        try:
+            beat = time.time()
+            while not monitor.done():
+                time.sleep(min(1.0, heartbeat))
+                if time.time() - beat >= heartbeat:
+                    beat = time.time()
+                    if not lease.heartbeat():
+                        print("{}: lost the lease of {}, stopping it.".format(lease.worker, task["id"]))
+                        os.killpg(monitor.process.pid, signal.SIGTERM)
+                        monitor.wait()
+                        return
+        except BaseException:
+            # the worker is stopping: stop the task, and let the next worker requeue it
+            if not monitor.done():
+                os.killpg(monitor.process.pid, signal.SIGTERM)
+                monitor.wait()
+            lease.expire()
+            raise
+    returncode = monitor.wait()
+    state = "done" if returncode == 0 else "failed"
+    queue.finish(task, state, lease.worker, returncode=returncode, wall=round(time.time() - start, 2), lease=lease)
+    print("{}: {} {} in {:.0f} s.".format(lease.worker, task["id"], state, time.time() - start))
+
+
+def work(number):
+    """
+    Claims and runs tasks until the queue is drained (or forever with -wait).
+
+    :param number: (int) number of the worker on this node
+    :return: None
+    """
+    signal.signal(signal.SIGTERM, stop)
+    worker = "{}:{}:{}".format(socket.gethostname(), os.getpid(), number)
+    queue = WorkQueue(args.queue, args.lease)
+    while True:
+        lease = queue.claim(worker)
+        if lease is not None:
+            run_task(queue, lease)
+            continue
+        if queue.finished() and not args.wait:
+            print("{}: no task left.".format(worker))
+            return
+        time.sleep(args.poll)
+
+
+if args.workers == 1:
+    work(0)
+else:
+    signal.signal(signal.SIGTERM, stop)
+    workers = [multiprocessing.Process(target=work, args=(n,)) for n in range(args.workers)]
+    for w in workers:
+        w.start()
+    try:
+        for w in workers:
+            w.join()
+    except BaseException:
+        for w in workers:
+            w.terminate()  # each worker stops its task and gives it back to the queue
+            w.join()
+        raise
+    WorkQueue(args.queue, args.lease).status()
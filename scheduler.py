@@ -0,0 +1,123 @@
+import os
+import subprocess
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import telemetry
+
+
+def total_memory():
+    """
+    :return: (int) total physical memory of the node, in GB
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 ** 3)
+
+
+class ResourceBudget:
+    """
+    A global thread and memory (GB) budget shared by all the tool invocations of a batch. Each invocation reserves
+    what it declared it needs, and waits until the budget can hold it, so concurrent samples never oversubscribe
+    the node.
+    """
+
+    def __init__(self, threads=None, memory=None):
+        self.threads = int(threads) if threads else len(os.sched_getaffinity(0))
+        self.memory = int(memory) if memory else total_memory()
+        self.free_threads = self.threads
+        self.free_memory = self.memory
+        self.condition = threading.Condition()
+
+    def clamp(self, threads, memory):
+        """
+        A job asking for more than the whole budget is shrunk to the budget, otherwise it could never start.
+
+        :return: tuple (threads, memory)
+        """
+        return min(int(threads), self.threads), min(int(memory), self.memory)
+
+    @contextmanager
+    def reserve(self, threads, memory):
+        """
+        Blocks until the requested threads and memory are available, and holds them for the duration of the
+        with block.
+
+        :param threads: (int) number of threads the tool will use
+        :param memory: (int) peak memory of the tool, in GB
+        :return: tuple (threads, memory) that were actually reserved
+        """
+        threads, memory = self.clamp(threads, memory)
+        with self.condition:
+            self.condition.wait_for(lambda: self.free_threads >= threads and self.free_memory >= memory)
+            self.free_threads -= threads
+            self.free_memory -= memory
+        try:
+            yield threads, memory
+        finally:
+            with self.condition:
+                self.free_threads += threads
+                self.free_memory += memory
+                self.condition.notify_all()
+
+
+def run(cmd, cost=None, budget=None):
+    """
+    Runs a tool invocation inside the budget, recording its resource usage in the telemetry trace. The return code
+    is checked, so a failing tool fails its sample.
+
+    :param cmd: list, command to be run
+    :param cost: tuple (threads, memory in GB) declared by the tool invocation
+    :param budget: ResourceBudget or None to run without any reservation
+    :return: subprocess.CompletedProcess
+    """
+    if budget is None or cost is None:
+        return telemetry.run(cmd, check=True)
+    with budget.reserve(*cost):
+        return telemetry.run(cmd, check=True)
+
+
+class SampleScheduler:
+    """
+    Runs one job per sample, several at a time. Resource packing is done by the ResourceBudget the jobs reserve
+    from, the number of jobs only bounds how many samples are in flight. A failing sample does not stop the batch,
+    its error is kept for the summary.
+    """
+
+    def __init__(self, jobs=1, budget=None):
+        self.jobs = max(1, int(jobs))
+        self.budget = budget if budget else ResourceBudget()
+        self.results = {}
+
+    def _run_one(self, name, job):
+        try:
+            with telemetry.context(sample=name):
+                job()
+            self.results[name] = None
+        except subprocess.CalledProcessError as e:
+            self.results[name] = "{} exited with status {}".format(" ".join(map(str, e.cmd[:2])), e.returncode)
+        except Exception as e:
+            self.results[name] = "{}: {}".format(type(e).__name__, e)
+            traceback.print_exc()
+
+    def run(self, jobs):
+        """
+        :param jobs: dictionary {sample name: callable with no arguments}
+        :return: dictionary {sample name: None if successful, otherwise the error message}
+        """
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for name, job in jobs.items():
+                pool.submit(self._run_one, name, job)
+        return self.results
+
+    def summary(self):
+        """
+        Prints which samples succeeded and which failed, with the reason.
+
+        :return: (int) number of failed samples
+        """
+        failed = {k: v for k, v in self.results.items() if v is not None}
+        print("{} of {} samples completed successfully.".format(len(self.results) - len(failed), len(self.results)))
+        for name in sorted(failed):
+            print("  {} failed: {}".format(name, failed[name]))
+        return len(failed)
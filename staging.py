@@ -0,0 +1,201 @@
+import atexit
+import os
+import shutil
+import signal
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Scratch directory tools are staged in (node-local disk or tmpfs), None to run them in place.
+ROOT = None
+# Free space (bytes) always left on the scratch file system.
+RESERVE = 1024 ** 3
+PREFIX = "staging_"
+
+_lock = threading.Lock()
+_reserved = 0  # bytes promised to the areas in use, not written yet
+_active = set()  # scratch directories in use, removed at exit whatever happens
+
+
+def configure(root, reserve_gb=1):
+    """
+    Enables staging in root, and removes the scratch directories left behind by processes that no longer run.
+    SIGTERM (sent by schedulers on timeouts) is turned into a normal exit, so scratch directories are cleaned up.
+
+    :param root: (str) scratch directory, None to run the tools in place
+    :param reserve_gb: (float) free space (GB) left on the scratch file system
+    :return: None
+    """
+    global ROOT, RESERVE
+    if not root:
+        ROOT = None
+        return
+    os.makedirs(root, exist_ok=True)
+    ROOT = os.path.abspath(root)
+    RESERVE = int(reserve_gb * 1024 ** 3)
+    clean_stale(ROOT)
+    atexit.register(_cleanup)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _terminate)
+
+
+def _terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _cleanup():
+    for directory in list(_active):
+        shutil.rmtree(directory, ignore_errors=True)
+    _active.clear()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clean_stale(root):
+    """
+    Removes the scratch directories of dead processes (killed before they could clean up).
+
+    :param root: (str) scratch directory
+    :return: None
+    """
+    with os.scandir(root) as entries:
+        for e in entries:
+            parts = e.name.split("_")
+            if not e.name.startswith(PREFIX) or len(parts) < 3 or not parts[1].isdigit():
+                continue
+            if not _alive(int(parts[1])):
+                print("Removing the stale scratch directory {}.".format(e.path))
+                shutil.rmtree(e.path, ignore_errors=True)
+
+
+def size(*paths):
+    """
+    :param paths: files or directories, None entries are ignored
+    :return: (int) their total size in bytes
+    """
+    total = 0
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(directory, f)) for f in files)
+        else:
+            total += os.path.getsize(path)
+    return total
+
+
+def _copy(source, destination):
+    if os.path.isdir(source):
+        shutil.copytree(source, destination)
+    else:
+        shutil.copyfile(source, destination)
+
+
+def _move_back(source, destination, exclude):
+    """
+    Moves a staged output to its final location: copied next to it first, then renamed over it, so the final path
+    only ever holds a complete output.
+    """
+    destination = destination.rstrip("/")
+    partial = "{}.staging".format(destination)
+    _remove(partial)  # left by an interrupted move
+    if os.path.isdir(source):
+        shutil.copytree(source, partial, ignore=shutil.ignore_patterns(*exclude) if exclude else None)
+    else:
+        shutil.copyfile(source, partial)
+    if os.path.isdir(destination):
+        _remove(destination)  # os.replace can not replace a directory
+    os.replace(partial, destination)
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class Area:
+    """
+    Scratch directory of one staged tool run. path maps the inputs and outputs of the tool to their scratch
+    locations. When staging is off (or there is not enough space), it maps every path to itself and the tool runs
+    in place.
+    """
+
+    def __init__(self, directory=None):
+        self.dir = directory
+
+    def path(self, original):
+        """
+        :param original: (str) path of an input or output of the tool
+        :return: (str) where the tool should use it
+        """
+        if self.dir is None or original is None:
+            return original
+        return os.path.join(self.dir, os.path.basename(original.rstrip("/")))
+
+    def location(self, original_dir):
+        """
+        :param original_dir: (str) directory the tool writes its files to when it runs in place
+        :return: (str) directory it should write them to
+        """
+        return original_dir if self.dir is None else self.dir
+
+
+@contextmanager
+def staged(name, inputs=(), outputs=(), need=0, exclude=()):
+    """
+    Runs the body of the with block in a scratch directory: inputs are copied in first, and once the body
+    succeeded, the outputs are moved back to their final paths. The scratch directory is removed in every case,
+    including failures and SIGTERM. Without a configured scratch directory, or if it lacks the space for the
+    inputs and need, the body runs in place.
+
+    :param name: (str) name of the stage, used in the directory name
+    :param inputs: list of files or directories to copy to the scratch directory
+    :param outputs: list of final paths of the outputs (files or directories) the tool writes at Area.path(output)
+    :param need: (int) bytes the tool writes in the scratch directory, on top of the copied inputs
+    :param exclude: names (glob patterns) of the files of output directories that are not moved back
+    :return: Area
+    """
+    global _reserved
+    if ROOT is None:
+        yield Area()
+        return
+    inputs = [i for i in inputs if i]
+    need = int(need) + size(*inputs)
+    with _lock:
+        free = shutil.disk_usage(ROOT).free - _reserved - RESERVE
+        if need > free:
+            print("{}: {:.1f} GB needed in {}, {:.1f} GB free, running in place.".format(
+                name, need / 1024 ** 3, ROOT, max(free, 0) / 1024 ** 3))
+            need = None
+        else:
+            _reserved += need
+    if need is None:
+        yield Area()
+        return
+
+    directory = tempfile.mkdtemp(prefix="{}{}_{}_".format(PREFIX, os.getpid(), name.replace("_", "-")), dir=ROOT)
+    _active.add(directory)
+    area = Area(directory)
+    try:
+        for i in inputs:
+            _copy(i, area.path(i))
+        yield area
+        for output in outputs:
+            if os.path.lexists(area.path(output)):
+                _move_back(area.path(output), output, exclude)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        _active.discard(directory)
+        with _lock:
+            _reserved -= need
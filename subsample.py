@@ -0,0 +1,160 @@
+import heapq
+
+import numpy as np
+
+import fastx
+from bgzf import BgzfWriter
+from readstats import block_stats
+
+# Default seed of the random keys, so that reruns keep the same reads (and find their assemblies in the cache).
+SEED = 1
+
+
+def target_bases(genomesize, depth):
+    """
+    :param genomesize: (int) genome size, None if unknown
+    :param depth: (float) coverage to keep, None to keep every read
+    :return: (int) number of bases to keep, None when there is nothing to subsample to
+    """
+    if not genomesize or not depth:
+        return None
+    return int(float(genomesize) * float(depth))
+
+
+def paired_blocks(r1, r2):
+    """
+    Streams two paired fastq(.gz) files together.
+
+    :return: generator of tuples (R1 lines, R2 lines) holding the same number of records
+    """
+    blocks2 = fastx.fastq_blocks(r2)
+    pending = []
+    for lines1 in fastx.fastq_blocks(r1):
+        while len(pending) < len(lines1):
+            more = next(blocks2, None)
+            if more is None:
+                raise ValueError("{} has fewer reads than {}".format(r2, r1))
+            pending.extend(more)
+        yield lines1, pending[:len(lines1)]
+        pending = pending[len(lines1):]
+    if pending or next(blocks2, None) is not None:
+        raise ValueError("{} has more reads than {}".format(r2, r1))
+
+
+class Subsampler:
+    """
+    Keeps about target_bases of a read set in one streaming pass, with a weighted reservoir (Efraimidis-Spirakis):
+    each read draws a key u ** (1 / weight), u uniform in [0, 1), and the reads with the largest keys are kept until
+    they hold the target number of bases. A read's weight is its length times its mean identity, so longer and better
+    reads are favoured, while short read pairs (all of the same length) are subsampled almost uniformly.
+
+    Memory is bounded by the target, not by the input: keys are drawn for a whole block at once, and only the reads
+    whose key beats the smallest key kept so far are looked at. Pairs are kept or dropped together, so R1 and R2
+    stay in sync. The kept reads are written in their input order.
+    """
+
+    def __init__(self, target_bases, seed=SEED):
+        """
+        :param target_bases: (int) number of bases to keep
+        :param seed: (int) seed of the random keys, None for a different subsample at every run
+        """
+        self.target_bases = int(target_bases)
+        self.rng = np.random.default_rng(seed)
+        self.heap = []  # (log key, read number, records, bases) of the kept reads, smallest key first
+        self.bases = 0
+        self.threshold = -np.inf  # largest key dropped so far: no later read with a smaller key can be kept
+        self.reads = 0
+        self.total_bases = 0
+
+    def add(self, records, lengths, qualities):
+        """
+        Offers one block of reads to the reservoir.
+
+        :param records: list of the records of the block (bytes, or tuples of bytes for pairs)
+        :param lengths: numpy array of the bases of each record
+        :param qualities: numpy array of the mean quality of each record
+        :return: None
+        """
+        identities = 1 - 10 ** (-qualities / 10)
+        weights = np.maximum(lengths * identities, 1e-9)
+        # log(u ** (1 / w)) = log(u) / w, compared in log space to keep the precision of very long reads
+        keys = np.log(self.rng.random(len(records))) / weights
+        for i in np.nonzero(keys > self.threshold)[0].tolist():
+            if keys[i] <= self.threshold:
+                continue
+            heapq.heappush(self.heap, (keys[i], self.reads + i, records[i], int(lengths[i])))
+            self.bases += int(lengths[i])
+            while self.bases - self.heap[0][3] >= self.target_bases:
+                key, _, _, bases = heapq.heappop(self.heap)
+                self.bases -= bases
+                self.threshold = key
+        self.reads += len(records)
+        self.total_bases += int(lengths.sum())
+
+    def run(self, path):
+        """
+        Streams the reads of a fastq(.gz) file through the reservoir.
+
+        :return: Subsampler
+        """
+        for lines in fastx.fastq_blocks(path):
+            lengths, qualities = block_stats(lines)
+            records = [b"\n".join(lines[i:i + 4]) + b"\n" for i in range(0, len(lines), 4)]
+            self.add(records, lengths, qualities)
+        return self
+
+    def run_pairs(self, r1, r2):
+        """
+        Streams paired fastq(.gz) files through the reservoir, a pair being kept or dropped as a whole.
+
+        :return: Subsampler
+        """
+        for lines1, lines2 in paired_blocks(r1, r2):
+            lengths1, qualities1 = block_stats(lines1)
+            lengths2, qualities2 = block_stats(lines2)
+            lengths = lengths1 + lengths2
+            qualities = (qualities1 * lengths1 + qualities2 * lengths2) / np.maximum(lengths, 1)
+            records = [(b"\n".join(lines1[i:i + 4]) + b"\n", b"\n".join(lines2[i:i + 4]) + b"\n")
+                       for i in range(0, len(lines1), 4)]
+            self.add(records, lengths, qualities)
+        return self
+
+    def kept(self):
+        """
+        :return: list of the kept records, in input order
+        """
+        return [entry[2] for entry in sorted(self.heap, key=lambda entry: entry[1])]
+
+    def write(self, output):
+        """
+        :param output: (str) path of the BGZF compressed fastq to write
+        :return: None
+        """
+        with BgzfWriter(output) as ftw:
+            for record in self.kept():
+                ftw.write(record)
+
+    def write_fasta(self, output):
+        """
+        :param output: binary file object the kept reads are written to, as fasta
+        :return: None
+        """
+        kept = self.kept()
+        for i in range(0, len(kept), 10000):
+            output.write(fastx.fastq_to_fasta_block(b"".join(kept[i:i + 10000]).rstrip(b"\n").split(b"\n")))
+
+    def write_pairs(self, output1, output2):
+        """
+        :param output1: (str) path of the BGZF compressed R1 fastq to write
+        :param output2: (str) path of the BGZF compressed R2 fastq to write
+        :return: None
+        """
+        with BgzfWriter(output1) as ftw1, BgzfWriter(output2) as ftw2:
+            for record1, record2 in self.kept():
+                ftw1.write(record1)
+                ftw2.write(record2)
+
+    def report(self, name):
+        print("{}: kept {} of {} reads, {} of {} bases ({:.0%}).".format(
+            name, len(self.heap), self.reads, self.bases, self.total_bases,
+            self.bases / self.total_bases if self.total_bases else 1))
@@ -0,0 +1,213 @@
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+# Trace every monitored process is appended to, set by configure. Nothing is written while it is None.
+TRACE = None
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def configure(path):
+    """
+    Sets the JSONL file the stages of this run are appended to.
+
+    :param path: (str) path of the trace, None to stop tracing
+    :return: None
+    """
+    global TRACE
+    TRACE = path
+    if path and os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+@contextmanager
+def context(sample=None, stage=None):
+    """
+    Sets the sample (and stage) the processes started by this thread are recorded under, for the duration of the
+    with block.
+    """
+    previous = getattr(_local, "context", {})
+    current = dict(previous)
+    if sample is not None:
+        current["sample"] = sample
+    if stage is not None:
+        current["stage"] = stage
+    _local.context = current
+    try:
+        yield
+    finally:
+        _local.context = previous
+
+
+def current():
+    """
+    :return: dictionary with the sample and stage set by context in this thread
+    """
+    return dict(getattr(_local, "context", {}))
+
+
+def record(entry):
+    """
+    Appends one entry to the trace.
+
+    :param entry: dictionary
+    :return: None
+    """
+    if TRACE is None:
+        return
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    with _lock:
+        with open(TRACE, "a") as ftw:
+            ftw.write(line)
+
+
+class StageMonitor:
+    """
+    Follows one process: samples /proc/<pid>/io while it runs, and collects its resource usage with wait4 once it
+    exits. The process is recorded in the trace, under the sample and stage of the thread that started it.
+    """
+
+    def __init__(self, name, process, interval=1.0, sample=None):
+        """
+        :param name: (str) name of the stage
+        :param process: subprocess.Popen of the stage
+        :param interval: (float) longest time between two samples, short-lived processes are sampled more often
+        :param sample: (str) sample the process belongs to, defaults to the one set by context
+        """
+        self.context = current()
+        self.name = name if name else self.context.get("stage")
+        self.sample = sample if sample else self.context.get("sample")
+        self.process = process
+        self.interval = interval
+        self.start = time.time()
+        self.io = {}
+        self.usage = None
+        self.wall = None
+        self.thread = threading.Thread(target=self._follow, daemon=True)
+        self.thread.start()
+
+    def _read_io(self):
+        try:
+            with open("/proc/{}/io".format(self.process.pid)) as ftr:
+                io = dict(line.split(": ") for line in ftr.read().splitlines())
+            self.io = {k: int(v) for k, v in io.items()}
+        except (OSError, ValueError):
+            pass
+
+    def _follow(self):
+        delay = 0.01
+        while True:
+            self._read_io()
+            pid, status, usage = os.wait4(self.process.pid, os.WNOHANG)
+            if pid:
+                break
+            time.sleep(delay)
+            delay = min(2 * delay, self.interval)
+        self.wall = time.time() - self.start
+        self.usage = usage
+        self.process.returncode = os.waitstatus_to_exitcode(status)
+        entry = self.stats()
+        entry.update({"sample": self.sample, "command": self.process.args if isinstance(self.process.args, list)
+                      else [self.process.args], "start": round(self.start, 3)})
+        record(entry)
+
+    def done(self):
+        """
+        :return: (bool) True once the process exited. Use this rather than Popen.poll, which would reap the process.
+        """
+        return not self.thread.is_alive()
+
+    def wait(self):
+        self.thread.join()
+        return self.process.returncode
+
+    def stats(self):
+        """
+        :return: dictionary with the wall time, cpu time, peak memory and bytes read and written by the stage
+        """
+        written = self.io.get("wchar", 0)
+        return {"stage": self.name,
+                "returncode": self.process.returncode,
+                "wall": round(self.wall, 2),
+                "cpu": round(self.usage.ru_utime + self.usage.ru_stime, 2),
+                "peak_rss_mb": round(self.usage.ru_maxrss / 1024, 1),
+                "bytes_read": self.io.get("rchar", 0),
+                "bytes_written": written,
+                "disk_read": self.io.get("read_bytes", 0),
+                "disk_written": self.io.get("write_bytes", 0),
+                "bytes_per_sec": round(written / self.wall) if self.wall else 0}
+
+
+def start(cmd, stage=None, sample=None, **kwargs):
+    """
+    Starts a monitored process.
+
+    :param cmd: list, command to be run
+    :param stage: (str) stage name, defaults to the one set by context, then to the name of the tool
+    :param sample: (str) sample name, defaults to the one set by context
+    :param kwargs: passed to subprocess.Popen
+    :return: StageMonitor, whose wait() returns the exit code
+    """
+    stage = stage if stage else current().get("stage", os.path.basename(str(cmd[0])))
+    return StageMonitor(stage, subprocess.Popen(cmd, **kwargs), sample=sample)
+
+
+def run(cmd, stage=None, sample=None, check=False, **kwargs):
+    """
+    Drop-in replacement for subprocess.run (without output capture) that records the resource usage of the process.
+
+    :param cmd: list, command to be run
+    :param stage: (str) stage name, see start
+    :param sample: (str) sample name, see start
+    :param check: (bool) raise subprocess.CalledProcessError if the process fails
+    :return: subprocess.CompletedProcess
+    """
+    returncode = start(cmd, stage, sample, **kwargs).wait()
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return subprocess.CompletedProcess(cmd, returncode)
+
+
+def load(path):
+    """
+    :param path: (str) path to a JSONL trace
+    :return: list of dictionaries, one per process
+    """
+    with open(path) as ftr:
+        return [json.loads(line) for line in ftr if line.strip()]
+
+
+def summary(path, top=10):
+    """
+    Prints the total use of each stage, and the processes using the most time, cpu, memory and I/O.
+
+    :param path: (str) path to a JSONL trace
+    :param top: (int) number of processes listed per resource
+    :return: dictionary {stage: totals}
+    """
+    entries = load(path)
+    stages = {}
+    for e in entries:
+        s = stages.setdefault(e["stage"], {"runs": 0, "failed": 0, "wall": 0, "cpu": 0, "peak_rss_mb": 0,
+                                           "bytes_read": 0, "bytes_written": 0})
+        s["runs"] += 1
+        s["failed"] += e["returncode"] != 0
+        for k in ("wall", "cpu", "bytes_read", "bytes_written"):
+            s[k] += e.get(k, 0)
+        s["peak_rss_mb"] = max(s["peak_rss_mb"], e.get("peak_rss_mb", 0))
+
+    print("stage\truns\tfailed\twall (s)\tcpu (s)\tpeak RSS (MB)\tread (MB)\twritten (MB)")
+    for name, s in sorted(stages.items(), key=lambda x: -x[1]["wall"]):
+        print("{}\t{runs}\t{failed}\t{wall:.1f}\t{cpu:.1f}\t{peak_rss_mb:.0f}\t{r:.1f}\t{w:.1f}".format(
+            name, r=s["bytes_read"] / 1e6, w=s["bytes_written"] / 1e6, **s))
+
+    for key, label in (("wall", "wall time (s)"), ("cpu", "cpu time (s)"), ("peak_rss_mb", "peak RSS (MB)"),
+                       ("bytes_written", "bytes written")):
+        print("\nTop {} by {}:".format(min(top, len(entries)), label))
+        for e in sorted(entries, key=lambda x: -x.get(key, 0))[:top]:
+            print("  {}\t{}\t{}".format(e.get(key, 0), e.get("sample"), e["stage"]))
+    return stages
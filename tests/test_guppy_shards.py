@@ -0,0 +1,87 @@
+import argparse
+import gzip
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+# fast5 file: size in bytes. The stub basecaller puts each read in the barcode of the first number of the file name.
+FAST5 = {"s1_a.fast5": 5000, "s1_b.fast5": 1000, "s2_a.fast5": 3000, "sub/s2_b.fast5": 2000, "s3_a.fast5": 4000}
+
+
+@unittest.skipUnless(importlib.util.find_spec("pandas"), "GuppyClass needs pandas")
+class ShardedBasecallingTest(unittest.TestCase):
+    """
+    Runs GuppyClass.py -shards with the stub guppy_basecaller of tests/stubs on the CPU.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fast5 = os.path.join(self.tmp.name, "fast5")
+        self.output = os.path.join(self.tmp.name, "output")
+        for name, size in FAST5.items():
+            path = os.path.join(self.fast5, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as ftw:
+                ftw.write(b"\0" * size)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def basecall(self, shards, **env):
+        environment = dict(os.environ, PATH=os.path.join(HERE, "stubs") + os.pathsep + os.environ["PATH"], **env)
+        return subprocess.run([sys.executable, os.path.join(ROOT, "GuppyClass.py"), "-fast5", self.fast5,
+                               "-output", self.output, "-flowcell", "FLO-MIN106", "-kit", "SQK-LSK109",
+                               "-barcodekit", "EXP-NBD104", "-shards", str(shards), "-devices", "cpu", "-t", "1",
+                               "-workflow_cache", os.path.join(self.tmp.name, "workflows.json")],
+                              env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def test_shards_are_balanced(self):
+        from GuppyClass import GuppyBaseCallerRun
+        run = GuppyBaseCallerRun.__new__(GuppyBaseCallerRun)
+        run.input, run.output = self.fast5, self.output
+        run.args = argparse.Namespace(recursive="Y")
+        inputs = run.shards(2)
+        loads = [sum(os.path.getsize(os.path.join(d, f)) for f in os.listdir(d)) for d in inputs]
+        self.assertEqual(sorted(loads), [7000, 8000])
+        self.assertEqual(sorted(f for d in inputs for f in os.listdir(d)),
+                         sorted(n.replace("/", "_") for n in FAST5))
+
+    def test_sharded_run_is_merged(self):
+        result = self.basecall(3)
+        self.assertEqual(result.returncode, 0, result.stdout.decode())
+        self.assertFalse(os.path.exists(os.path.join(self.output, "shards")))
+
+        reads = {}
+        for barcode in os.listdir(os.path.join(self.output, "pass")):
+            directory = os.path.join(self.output, "pass", barcode)
+            self.assertEqual(os.listdir(directory), ["pass_{}.fastq.gz".format(barcode)])  # chunks were removed
+            with gzip.open(os.path.join(directory, "pass_{}.fastq.gz".format(barcode)), "rt") as ftr:
+                reads[barcode] = sorted(line[1:].strip() for i, line in enumerate(ftr) if i % 4 == 0)
+        self.assertEqual(reads, {"barcode01": ["s1_a.fast5", "s1_b.fast5"],
+                                 "barcode02": ["s2_a.fast5", "sub_s2_b.fast5"],  # named after its shard link
+                                 "barcode03": ["s3_a.fast5"]})
+
+        with open(os.path.join(self.output, "sequencing_summary.txt")) as ftr:
+            summary = ftr.read().splitlines()
+        self.assertEqual(summary[0].split("\t")[0], "filename")
+        self.assertEqual(len(summary), 1 + len(FAST5))
+        logs = sorted(f for f in os.listdir(self.output) if f.endswith(".log"))
+        self.assertEqual(logs, ["shard{}_guppy_basecaller_log-stub.log".format(i) for i in range(3)])
+        with open(os.path.join(self.output, logs[0])) as ftr:
+            self.assertIn("--cpu_threads_per_caller", ftr.read())
+
+    def test_failed_shard_is_not_merged(self):
+        result = self.basecall(2, STUB_GUPPY_FAIL="3")
+        self.assertNotEqual(result.returncode, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.output, "pass")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from workqueue import WorkQueue
+
+# Task command: appends "<sample> <stage>" to the record file, after sleeping for the given seconds. Its pid is written
+# to <record>.<sample>.<stage>.pid first.
+TASK = """
+import os, sys, time
+record, sample, stage, delay = sys.argv[1:]
+with open("{}.{}.{}.pid".format(record, sample, stage), "w") as ftw:
+    ftw.write(str(os.getpid()))
+time.sleep(float(delay))
+fd = os.open(record, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+os.write(fd, "{} {}\\n".format(sample, stage).encode())
+os.close(fd)
+"""
+
+
+class WorkQueueTest(unittest.TestCase):
+    """
+    Drains a queue in a temporary directory with several local workers (run_worker.py) and short leases.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmp.name, "queue")
+        self.record = os.path.join(self.tmp.name, "record.txt")
+        self.workers = []
+
+    def tearDown(self):
+        for worker in self.workers:
+            if worker.poll() is None:
+                worker.kill()
+                worker.wait()
+        self.tmp.cleanup()
+
+    def command(self, sample, stage, delay=0.0):
+        return [sys.executable, "-c", TASK, self.record, sample, stage, str(delay)]
+
+    def start_worker(self, *arguments):
+        worker = subprocess.Popen([sys.executable, os.path.join(ROOT, "run_worker.py"), "-queue", self.directory,
+                                   "-poll", "0.1"] + list(arguments),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.workers.append(worker)
+        return worker
+
+    def records(self):
+        if not os.path.isfile(self.record):
+            return []
+        with open(self.record) as ftr:
+            return [tuple(line.split()) for line in ftr]
+
+    def wait_for(self, condition, timeout=60):
+        end = time.time() + timeout
+        while not condition():
+            self.assertLess(time.time(), end, "timed out")
+            time.sleep(0.05)
+
+    def test_local_workers_drain_the_queue(self):
+        queue = WorkQueue(self.directory)
+        samples = ["S{}".format(i) for i in range(6)]
+        for sample in samples:
+            first = queue.add(sample, "filter", self.command(sample, "filter", 0.2))
+            queue.add(sample, "assembly", self.command(sample, "assembly", 0.1), [first])
+        for _ in range(3):
+            self.start_worker("-lease", "2", "-heartbeat", "0.2")
+        for worker in self.workers:
+            self.assertEqual(worker.wait(timeout=120), 0)
+
+        records = self.records()
+        self.assertEqual(sorted(records), sorted((s, t) for s in samples for t in ("filter", "assembly")))
+        for sample in samples:
+            self.assertLess(records.index((sample, "filter")), records.index((sample, "assembly")))
+        self.assertEqual(set(queue.states().values()), {"done"})
+
+    def test_task_of_a_dead_worker_is_taken_over(self):
+        queue = WorkQueue(self.directory, lease=1)
+        task_id = queue.add("S1", "polish", self.command("S1", "polish", 2))
+        pid = "{}.S1.polish.pid".format(self.record)
+        dead = self.start_worker("-lease", "1", "-heartbeat", "0.2")
+        self.wait_for(lambda: os.path.isfile(pid) and os.path.getsize(pid))
+        with open(pid) as ftr:
+            task = int(ftr.read())
+        # the node goes down: the worker and its task die without a word
+        dead.send_signal(signal.SIGKILL)
+        dead.wait()
+        os.kill(task, signal.SIGKILL)
+
+        self.assertEqual(self.start_worker("-lease", "1", "-heartbeat", "0.2").wait(timeout=60), 0)
+        self.assertEqual(self.records(), [("S1", "polish")])
+        with open(queue.result_path(task_id)) as ftr:
+            result = json.load(ftr)
+        self.assertEqual((result["state"], result["attempt"]), ("done", 2))
+
+    def test_attempts_are_counted_across_takeovers(self):
+        queue = WorkQueue(self.directory, lease=0.2, attempts=2)
+        task_id = queue.add("S1", "filter", self.command("S1", "filter"))
+        first = queue.claim("a")
+        self.assertEqual(first.attempt, 1)
+        time.sleep(0.3)
+        second = queue.claim("b")
+        self.assertEqual(second.attempt, 2)
+        # the first worker comes back: its heartbeat must neither succeed nor touch the new lease
+        self.assertFalse(first.heartbeat())
+        self.assertTrue(second.heartbeat())
+        with open(queue.lease_path(task_id, 2)) as ftr:
+            self.assertEqual(json.load(ftr)["worker"], "b")
+        queue.finish(first.task, "done", "a", returncode=0, lease=first)
+        self.assertEqual(queue.states()[task_id], "running")
+
+        time.sleep(0.3)
+        self.assertIsNone(queue.claim("c"))
+        self.assertEqual(queue.states()[task_id], "failed")
+        self.assertEqual(queue.reset(), 1)
+        self.assertEqual(queue.claim("d").attempt, 1)
+
+    def test_one_worker_wins_an_expired_lease(self):
+        queue = WorkQueue(self.directory, lease=0.2)
+        queue.add("S1", "filter", self.command("S1", "filter"))
+        queue.claim("dead")
+        time.sleep(0.3)
+        barrier = threading.Barrier(8)
+        leases = []
+
+        def claim(n):
+            barrier.wait()
+            leases.append(queue.claim("w{}".format(n)))
+
+        threads = [threading.Thread(target=claim, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        won = [lease for lease in leases if lease is not None]
+        self.assertEqual(len(won), 1)
+        self.assertEqual(won[0].attempt, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
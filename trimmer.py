@@ -0,0 +1,265 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import fastx
+from bgzf import BgzfWriter
+
+# ONT adapters and native barcodes searched at the ends and in the middle of the reads (from porechop's set).
+ADAPTERS = {
+    "SQK-NSK007 top": "AATGTACTTCGTTCAGTTACGTATTGCT",
+    "SQK-NSK007 bottom": "GCAATACGTAACTGAACGAAGT",
+    "SQK-MAP006 top": "GGTTGTTTCTGTTGGTGCTGATATTGCT",
+    "SQK-MAP006 bottom": "GCAATATCAGCACCAACAGAAA",
+    "Rapid": "GTTTTCGCATTTATCGTGAAACGCTTTCGCGTTTTTCGTGCGCCGCTTCA",
+    "PCR adapter 1": "ACTTGCCTGTCGCTCTATCTTC",
+    "PCR adapter 2": "TTTCTGTTGGTGCTGATATTGC",
+    "NB01": "CACAAAGACACCGACAACTTTCTT",
+    "NB02": "ACAGACGACTACAAACGGAATCGA",
+    "NB03": "CCTGGTAACTGGGACACAAGACTC",
+    "NB04": "TAGGGAAACACGATAGAATCCGAA",
+    "NB05": "AAGGTTACACAAACCCTGGACAAG",
+    "NB06": "GACTACTTTCTGCCTTTGCGAGAA",
+    "NB07": "AAGGATTCATTCCCACGGTAACAC",
+    "NB08": "ACGTAACTTGGTTTGTTCCCTGAA",
+    "NB09": "AACCAAGACTCGCTGTGCCTAGTT",
+    "NB10": "GAGAGGACAAAGGTTTCAACGCTT",
+    "NB11": "TCCATTCCCTCCGATAGATGAAAC",
+    "NB12": "TCCGATTCTGCTTCTTTCTACCTG",
+}
+# k-mer length used for matching: short enough to tolerate nanopore errors, long enough to be rare by chance.
+K = 10
+# Base -> 2 bit code, 4 for anything else (N).
+CODES = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(b"ACGT"):
+    CODES[_b] = _i
+    CODES[ord(chr(_b).lower())] = _i
+
+_kmers = None  # adapter k-mers of the worker processes, set by _init
+
+
+def reverse_complement(seq):
+    return seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+
+def adapter_kmers(adapters=None, k=K):
+    """
+    :param adapters: iterable of adapter sequences, defaults to ADAPTERS
+    :param k: (int) k-mer length
+    :return: numpy boolean array indexed by 2 bit encoded k-mer, True for the k-mers of the adapters on both strands
+    """
+    kmers = set()
+    for adapter in (adapters if adapters is not None else ADAPTERS.values()):
+        for seq in (adapter, reverse_complement(adapter)):
+            codes = CODES[np.frombuffer(seq.encode(), dtype=np.uint8)].astype(np.uint32)
+            for i in range(len(codes) - k + 1):
+                value = 0
+                for c in codes[i:i + k]:
+                    value = (value << 2) | int(c)
+                kmers.add(value)
+    table = np.zeros(4 ** k, dtype=bool)
+    table[list(kmers)] = True
+    return table
+
+
+def kmer_hits(seqs, kmers, k=K):
+    """
+    Finds the adapter k-mers in a batch of reads at once: the reads are concatenated, encoded and hashed as one
+    array, and the hits are mapped back to their reads.
+
+    :param seqs: list of sequences (bytes)
+    :param kmers: adapter k-mer table, from adapter_kmers
+    :return: list (one per read) of arrays of hit positions in the read
+    """
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])) if len(seqs) else np.zeros(0, dtype=np.int64)
+    codes = CODES[np.frombuffer(b"".join(seqs), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return [np.zeros(0, dtype=np.int64) for _ in seqs]
+    values = np.zeros(n, dtype=np.uint32)
+    invalid = np.zeros(n, dtype=bool)
+    for j in range(k):
+        window = codes[j:j + n]
+        values = (values << 2) | (window & 3)
+        invalid |= window == 4
+    positions = np.nonzero(kmers[values] & ~invalid)[0]
+    reads = np.searchsorted(starts, positions, side="right") - 1
+    relative = positions - starts[reads]
+    inside = relative <= lengths[reads] - k  # drop k-mers spanning two reads
+    positions, reads, relative = positions[inside], reads[inside], relative[inside]
+    bounds = np.searchsorted(reads, np.arange(len(seqs) + 1))
+    return [relative[bounds[i]:bounds[i + 1]] for i in range(len(seqs))]
+
+
+def clusters(hits, gap):
+    """
+    :param hits: sorted array of hit positions
+    :param gap: (int) largest distance between two hits of the same cluster
+    :return: list of arrays of hit positions, one per cluster
+    """
+    if not len(hits):
+        return []
+    return np.split(hits, np.nonzero(np.diff(hits) > gap)[0] + 1)
+
+
+def adapter_clusters(hits, min_hits, gap, spread=0):
+    """
+    :param spread: (int) smallest distance between the first and last hit of a cluster. A random match of the read
+        with an adapter is a short run of consecutive k-mers, a real adapter usually spreads its hits further.
+    :return: list of the clusters of hits that look like an adapter
+    """
+    return [c for c in clusters(hits, gap) if len(c) >= min_hits and c[-1] - c[0] >= spread]
+
+
+def trim_coordinates(length, hits, end_size=150, min_hits=3, middle_hits=6, min_split=1000, k=K):
+    """
+    Adapters are clusters of hits, so isolated hits (random matches) never move the trimming points. Splitting a
+    read takes more evidence than trimming its ends.
+
+    :param length: (int) read length
+    :param hits: sorted array of adapter k-mer positions in the read
+    :return: list of (start, end) pieces of the read to keep: ends trimmed past the adapters, and the read split
+        around adapters found in its middle (chimeras), pieces shorter than min_split dropped after a split
+    """
+    start, end = 0, length
+    head = adapter_clusters(hits[hits < end_size], min_hits, 2 * k)
+    tail = adapter_clusters(hits[hits >= length - end_size - k], min_hits, 2 * k)
+    if head:
+        start = int(head[-1].max()) + k + 2  # past the barcode following the adapter, if there is one
+    if tail:
+        end = int(tail[0].min()) - 2
+    middle = hits[(hits >= end_size) & (hits < length - end_size - k)]
+    adapters = adapter_clusters(middle, middle_hits, 50, spread=6)
+    if adapters:
+        pieces = []
+        left = start
+        for cluster in adapters:
+            pieces.append((left, int(cluster.min()) - 10))
+            left = int(cluster.max()) + k + 10
+        pieces.append((left, end))
+        return [(s, e) for s, e in pieces if e - s >= min_split]
+    return [(start, end)] if end > start else []
+
+
+def trim_block(lines):
+    """
+    Trims a block of fastq records (worker function of the pool).
+
+    :param lines: list of fastq lines, as produced by fastx.fastq_blocks
+    :return: numpy array (rows: record index in the block, start, end, piece number) of the kept pieces
+    """
+    seqs = lines[1::4]
+    rows = []
+    for r, hits in enumerate(kmer_hits(seqs, _kmers)):
+        pieces = trim_coordinates(len(seqs[r]), hits)
+        split = len(pieces) > 1
+        for p, (s, e) in enumerate(pieces):
+            rows.append((r, s, e, p + 1 if split else 0))
+    return np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+
+def apply(lines, rows):
+    """
+    :param lines: list of fastq lines of a block
+    :param rows: pieces of the block, from trim_block
+    :return: list of the lines of the trimmed records. Pieces of split reads are named <read ID>_<piece number>.
+    """
+    out = []
+    for r, s, e, p in rows.tolist():
+        header = lines[4 * r]
+        if p:
+            name, _, rest = header.partition(b" ")
+            header = b"%s_%d%s" % (name, p, b" " + rest if rest else b"")
+        out.extend((header, lines[4 * r + 1][s:e], b"+", lines[4 * r + 3][s:e]))
+    return out
+
+
+def _init(kmers):
+    global _kmers
+    _kmers = kmers
+
+
+class Trimmer:
+    """
+    In-process replacement for porechop: adapters and barcodes are found with vectorized k-mer matching (numpy) on
+    batches of reads, trimmed at the read ends and split out of the middle of chimeric reads. Batches are trimmed on
+    a process pool.
+
+    The trimmed reads are produced as a stream of blocks, so they can go straight into the filter. The trimming
+    coordinates (a few bytes per read) are kept, and replay streams the same trimmed reads again without searching
+    the adapters twice, for the second pass of a two-pass filter.
+    """
+
+    def __init__(self, processes=None, adapters=None):
+        """
+        :param processes: (int) worker processes, defaults to the number of available cores
+        :param adapters: iterable of adapter sequences, defaults to ADAPTERS
+        """
+        self.processes = processes if processes else len(os.sched_getaffinity(0))
+        self.kmers = adapter_kmers(adapters)
+        self.coordinates = []
+        self.reads = 0
+        self.trimmed = 0
+        self.split = 0
+
+    def trim(self, path):
+        """
+        First pass: trims the reads of path.
+
+        :param path: (str) fastq(.gz) file
+        :return: generator of lists of lines of trimmed fastq records
+        """
+        self.coordinates = []
+        self.reads = self.trimmed = self.split = 0
+        with ProcessPoolExecutor(self.processes, initializer=_init, initargs=(self.kmers,)) as pool:
+            blocks = fastx.fastq_blocks(path)
+            pending = []
+            for lines in blocks:
+                pending.append((lines, pool.submit(trim_block, lines)))
+                # keep a bounded number of blocks in flight, in order
+                while len(pending) > 2 * self.processes:
+                    yield self._collect(*pending.pop(0))
+            while pending:
+                yield self._collect(*pending.pop(0))
+
+    def _collect(self, lines, future):
+        rows = future.result()
+        self.coordinates.append(rows)
+        records = len(lines) // 4
+        lengths = np.array([len(s) for s in lines[1::4]], dtype=np.int64)
+        self.reads += records
+        self.split += int(np.count_nonzero(rows[:, 3] == 1))
+        unsplit = rows[rows[:, 3] == 0]
+        self.trimmed += int(np.count_nonzero((unsplit[:, 1] > 0) | (unsplit[:, 2] < lengths[unsplit[:, 0]])))
+        return apply(lines, rows)
+
+    def replay(self, path):
+        """
+        Second pass: the same trimmed reads as the last trim(path), from the kept coordinates.
+
+        :param path: (str) fastq(.gz) file given to trim
+        :return: generator of lists of lines of trimmed fastq records
+        """
+        for lines, rows in zip(fastx.fastq_blocks(path), self.coordinates):
+            yield apply(lines, rows)
+
+    def write(self, path, output, compresslevel=6):
+        """
+        Trims path into a BGZF compressed fastq.
+
+        :param path: (str) fastq(.gz) file
+        :param output: (str) path of the trimmed fastq.gz
+        :param compresslevel: (int) compression level
+        :return: None
+        """
+        with BgzfWriter(output, level=compresslevel) as ftw:
+            for lines in self.trim(path):
+                if lines:
+                    ftw.write(b"\n".join(lines + [b""]))
+        self.report(path)
+
+    def report(self, path):
+        print("{}: {} reads, {} trimmed at their ends, {} split on middle adapters.".format(
+            path, self.reads, self.trimmed, self.split))
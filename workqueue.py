@@ -0,0 +1,324 @@
+import json
+import os
+import re
+import socket
+import time
+
+# Seconds a claimed task stays leased without a heartbeat before other workers requeue it.
+LEASE = 600
+# Times a task is claimed again after its worker died, before it is given up.
+ATTEMPTS = 3
+
+
+def _write_json(path, data):
+    """
+    Writes a JSON file atomically (temporary file, then rename), so readers on other nodes never see half of it.
+    """
+    tmp = "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+    with open(tmp, "w") as ftw:
+        json.dump(data, ftw, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    """
+    :return: the content of a JSON file, None if it does not exist (or was just removed)
+    """
+    try:
+        with open(path) as ftr:
+            return json.load(ftr)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class Lease:
+    """
+    A claimed task. The worker holding it must call heartbeat more often than the lease duration. Every attempt at a
+    task has its own lease file, only ever written by the worker of that attempt: the lease is lost once another
+    worker created the lease file of the next attempt.
+    """
+
+    def __init__(self, queue, task, worker, attempt):
+        self.queue = queue
+        self.task = task
+        self.worker = worker
+        self.attempt = attempt
+        self.claimed = time.time()
+        self.path = queue.lease_path(task["id"], attempt)
+
+    def write(self, expires=None):
+        """
+        :param expires: (float) time the lease expires at, defaults to the lease duration from now
+        """
+        _write_json(self.path, {"worker": self.worker, "attempt": self.attempt, "claimed": self.claimed,
+                                "expires": time.time() + self.queue.lease if expires is None else expires})
+
+    def held(self):
+        """
+        :return: (bool) True if the lease still belongs to this worker
+        """
+        return not os.path.lexists(self.queue.lease_path(self.task["id"], self.attempt + 1))
+
+    def heartbeat(self):
+        """
+        Extends the lease.
+
+        :return: (bool) False if the lease was lost (it expired and another worker took the task over)
+        """
+        if not self.held():
+            return False
+        self.write()
+        # the task may have been taken over while the lease was written, when it was about to expire
+        return self.held()
+
+    def expire(self):
+        """
+        Gives the task up without a result (the worker is stopping): the next worker looking for work requeues it.
+
+        :return: None
+        """
+        if self.held():
+            self.write(expires=0)
+
+
+class WorkQueue:
+    """
+    Per-sample, per-stage tasks kept as files in a directory of the shared run directory, so that any number of
+    workers on any number of nodes can drain the same batch. Nothing but atomic file creation (O_EXCL) and rename
+    is needed from the file system, which NFS provides.
+
+    - tasks/<id>.json: the task (sample, stage, command, working directory, tasks it runs after)
+    - leases/<id>.<attempt>.json: one per attempt at the task, created with O_EXCL so only one worker wins each
+      attempt. It holds the worker and until when the claim holds; the worker renews it with heartbeats. An expired
+      lease is taken over by the next worker looking for work, which creates the lease of the next attempt (the task
+      is requeued). Lease files are only removed by reset, so they also count the attempts.
+    - results/<id>.json: final state (done, failed or skipped), worker, exit code and wall time.
+    - logs/<id>.<attempt>.log: output of the command.
+    """
+
+    def __init__(self, directory, lease=LEASE, attempts=ATTEMPTS):
+        """
+        :param directory: (str) queue directory, created if needed
+        :param lease: (int) seconds a claim holds without a heartbeat
+        :param attempts: (int) claims of a task whose workers died, before it is marked failed
+        """
+        self.directory = directory
+        self.lease = lease
+        self.attempts = attempts
+        for sub in ("tasks", "leases", "results", "logs"):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    @staticmethod
+    def task_id(sample, stage):
+        return "{}.{}".format(sample, stage).replace("/", "_")
+
+    def lease_path(self, task_id, attempt):
+        return os.path.join(self.directory, "leases", "{}.{}.json".format(task_id, attempt))
+
+    def result_path(self, task_id):
+        return os.path.join(self.directory, "results", "{}.json".format(task_id))
+
+    def log_path(self, task_id, attempt):
+        return os.path.join(self.directory, "logs", "{}.{}.log".format(task_id, attempt))
+
+    def add(self, sample, stage, command, after=(), cwd=None):
+        """
+        Adds a task, or replaces the task of the same sample and stage (its result is kept).
+
+        :param sample: (str) sample name
+        :param stage: (str) stage name
+        :param command: list, command the worker runs
+        :param after: list of task ids that must be done first
+        :param cwd: (str) working directory of the command, defaults to the current one
+        :return: (str) task id
+        """
+        task_id = WorkQueue.task_id(sample, stage)
+        _write_json(os.path.join(self.directory, "tasks", "{}.json".format(task_id)),
+                    {"id": task_id, "sample": sample, "stage": stage, "command": list(command),
+                     "after": list(after), "cwd": os.path.abspath(cwd if cwd else os.getcwd()),
+                     "submitted": time.time()})
+        return task_id
+
+    def tasks(self):
+        """
+        :return: list of the tasks, in submission order
+        """
+        tasks = []
+        with os.scandir(os.path.join(self.directory, "tasks")) as entries:
+            for e in entries:
+                if e.name.endswith(".json"):
+                    task = _read_json(e.path)
+                    if task is not None:
+                        tasks.append(task)
+        return sorted(tasks, key=lambda t: (t["submitted"], t["id"]))
+
+    def last_attempts(self):
+        """
+        :return: dictionary {task id: number of its last attempt}, for the tasks claimed at least once
+        """
+        attempts = {}
+        with os.scandir(os.path.join(self.directory, "leases")) as entries:
+            for e in entries:
+                match = re.fullmatch(r"(.+)\.(\d+)\.json", e.name)
+                if match:
+                    attempts[match.group(1)] = max(attempts.get(match.group(1), 0), int(match.group(2)))
+        return attempts
+
+    def last_lease(self, task_id, attempt):
+        """
+        :return: dictionary, the lease of the last attempt at the task
+        """
+        lease = _read_json(self.lease_path(task_id, attempt))
+        if lease is None:
+            # just created by a worker that did not write it yet (or died before): it holds from its creation
+            try:
+                created = os.stat(self.lease_path(task_id, attempt)).st_mtime
+            except FileNotFoundError:
+                created = 0
+            lease = {"worker": None, "attempt": attempt, "claimed": created, "expires": created + self.lease}
+        return lease
+
+    def states(self, tasks=None, attempts=None):
+        """
+        :param attempts: dictionary {task id: last attempt}, read before the tasks, defaults to WorkQueue.last_attempts
+        :return: dictionary {task id: state}, state being waiting, ready, running, expired, done, failed or skipped
+        """
+        attempts = attempts if attempts is not None else self.last_attempts()
+        tasks = tasks if tasks is not None else self.tasks()
+        states = {}
+        now = time.time()
+        for task in tasks:
+            result = _read_json(self.result_path(task["id"]))
+            if result is not None:
+                states[task["id"]] = result["state"]
+            elif task["id"] in attempts:
+                lease = self.last_lease(task["id"], attempts[task["id"]])
+                states[task["id"]] = "running" if lease["expires"] > now else "expired"
+            else:
+                states[task["id"]] = "ready"
+        for task in tasks:
+            if states[task["id"]] == "ready" and any(states.get(a) != "done" for a in task["after"]):
+                states[task["id"]] = "waiting"
+        return states
+
+    def claim(self, worker):
+        """
+        Claims the first task that is ready (its dependencies are done) or whose lease expired. Tasks that depend on
+        a failed task are marked skipped on the way.
+
+        :param worker: (str) name of the worker
+        :return: Lease, None if no task can be claimed right now
+        """
+        # the attempts are read first: a task claimed after this point has a newer lease, and can not be claimed
+        attempts = self.last_attempts()
+        tasks = self.tasks()
+        states = self.states(tasks, attempts)
+        for task in tasks:
+            state = states[task["id"]]
+            if state == "waiting" and any(states.get(a) in ("failed", "skipped") for a in task["after"]):
+                self.finish(task, "skipped", worker, error="a task it runs after failed")
+                states[task["id"]] = "skipped"
+                continue
+            if state == "ready":
+                lease = self._create(task, worker, attempts.get(task["id"], 0) + 1)
+            elif state == "expired":
+                lease = self._take_over(task, worker, attempts[task["id"]])
+            else:
+                continue
+            if lease is not None:
+                return lease
+        return None
+
+    def _create(self, task, worker, attempt):
+        try:
+            fd = os.open(self.lease_path(task["id"], attempt), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None  # claimed by another worker in the meantime
+        os.close(fd)
+        lease = Lease(self, task, worker, attempt)
+        lease.write()
+        if os.path.exists(self.result_path(task["id"])):
+            return None  # the worker of the previous attempt finished it after all
+        return lease
+
+    def _take_over(self, task, worker, attempt):
+        # only one worker can create the lease of the next attempt, the others lose the race here
+        lease = self._create(task, worker, attempt + 1)
+        if lease is None:
+            return None
+        print("{}: the lease of {} expired, requeued.".format(task["id"],
+                                                              self.last_lease(task["id"], attempt)["worker"]))
+        if attempt >= self.attempts:
+            self.finish(task, "failed", worker, error="its worker died {} times".format(attempt), lease=lease)
+            return None
+        return lease
+
+    def finish(self, task, state, worker, returncode=None, wall=None, error=None, lease=None):
+        """
+        Records the final state of a task. A worker that lost its lease records nothing: the task is the one of the
+        worker that took it over.
+
+        :return: None
+        """
+        if lease is not None and not lease.held():
+            return
+        _write_json(self.result_path(task["id"]),
+                    {"state": state, "worker": worker, "returncode": returncode, "wall": wall, "error": error,
+                     "attempt": lease.attempt if lease else None, "finished": time.time()})
+
+    def reset(self, states=("failed", "skipped")):
+        """
+        Requeues the tasks in the given final states, with their attempts counted from 0 again.
+
+        :return: (int) number of tasks requeued
+        """
+        count = 0
+        attempts = self.last_attempts()
+        for task_id, state in self.states(attempts=attempts).items():
+            if state in states:
+                # leases first: without its result, the task must not look claimed
+                for attempt in range(1, attempts.get(task_id, 0) + 1):
+                    if os.path.lexists(self.lease_path(task_id, attempt)):
+                        os.remove(self.lease_path(task_id, attempt))
+                os.remove(self.result_path(task_id))
+                count += 1
+        return count
+
+    def finished(self):
+        """
+        :return: (bool) True once every task is done, failed or skipped
+        """
+        return all(s in ("done", "failed", "skipped") for s in self.states().values())
+
+    def progress(self):
+        """
+        :return: dictionary {stage: {state: number of tasks}}
+        """
+        tasks = self.tasks()
+        states = self.states(tasks)
+        progress = {}
+        for task in tasks:
+            counts = progress.setdefault(task["stage"], {})
+            counts[states[task["id"]]] = counts.get(states[task["id"]], 0) + 1
+        return progress
+
+    def status(self):
+        """
+        Prints the progress of every stage, the running tasks and their workers, and the failed tasks.
+
+        :return: None
+        """
+        order = ("done", "running", "ready", "waiting", "expired", "failed", "skipped")
+        for stage, counts in self.progress().items():
+            print("{}: {}".format(stage, ", ".join("{} {}".format(counts[s], s) for s in order if s in counts)))
+        attempts = self.last_attempts()
+        for task in self.tasks():
+            result = _read_json(self.result_path(task["id"]))
+            if result is None and task["id"] in attempts:
+                lease = self.last_lease(task["id"], attempts[task["id"]])
+                print("  {} {} on {} (attempt {}, for {:.0f} s)".format(
+                    task["id"], "running" if lease["expires"] > time.time() else "expired", lease["worker"],
+                    lease["attempt"], time.time() - lease["claimed"]))
+            elif result is not None and result["state"] != "done":
+                print("  {} {}: {}".format(task["id"], result["state"], result["error"] if result["error"] else
+                                            "exit code {}".format(result["returncode"])))